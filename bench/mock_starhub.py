@@ -0,0 +1,197 @@
+"""
+Local stand-in for login.starhubgee.com.sg and fapi.starhub.com
+"""
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+MSSO_PATH = '/msso/mapp/api/login'
+ESSO_PATH = '/MyStarhub/login/esso'
+ALL_USAGE_PATH = '/MyStarhub/usage'
+USAGE_PATH = re.compile(r'^/MyStarhub/usage/data/(\d+)$')
+
+
+def _date_json(value):
+    return {'year': value.year, 'month': value.month, 'day': value.day,
+            'hour': getattr(value, 'hour', 0), 'minute': getattr(value, 'minute', 0),
+            'second': getattr(value, 'second', 0)}
+
+
+def usage_detail(phone_number, today=None, quota_gb=20, seed=None):
+    """usageDetail payload shaped like StarHub's, with one entry per day
+
+    The billing cycle starts on the 1st, daily usage is random but
+    reproducible for a given seed.
+    """
+    today = today or date.today()
+    rng = random.Random(seed if seed is not None else phone_number)
+    start = today.replace(day=1)
+    days = []
+    used_mb = 0.
+    day = start
+    while day <= today:
+        usage_mb = round(rng.uniform(50, 900), 2)
+        used_mb += usage_mb
+        days.append({'usageDate': _date_json(day), 'usage': usage_mb,
+                     'totalVolumeUsage': usage_mb, 'totalVolumeUsageUOM': 'MB'})
+        day += timedelta(days=1)
+    quota_mb = quota_gb * 1024.
+    processed = datetime.combine(today, datetime.min.time()) + timedelta(hours=6)
+    return {
+        'usageServiceId': str(phone_number),
+        'fromDateTime': _date_json(datetime.combine(start, datetime.min.time())),
+        'lastProcessedDateTime': _date_json(processed),
+        'usagePercentage': round(100 * used_mb / quota_mb),
+        'totalFreeUnits': quota_gb,
+        'totalFreeUnitsUOM': 'GB',
+        'totalUsage': round(used_mb, 2),
+        'totalUsageUOM': 'MB',
+        'usageDifference': round(quota_mb - used_mb, 2),
+        'differenceUOM': 'MB',
+        'dailyUsage': {'day': days},
+    }
+
+
+class MockStarHub:
+    """Threaded HTTP server answering the endpoints StarHubApi calls
+
+    Only the latest issued u_token is accepted, like StarHub which
+    invalidates the previous one on every ESSO login.
+
+    Args:
+        phone_numbers: Lines on the mock account
+        latency: Seconds every response is delayed by
+        jitter: Seconds randomly added to latency
+        unauthorized_rate: Fraction of usage requests answered with 401
+        error_rate: Fraction of requests answered with 500
+        host: Interface to listen on
+        port: Port to listen on, 0 picks a free one
+    """
+
+    def __init__(self, phone_numbers, latency=0.05, jitter=0., unauthorized_rate=0.,
+                 error_rate=0., host='127.0.0.1', port=0):
+        self.payloads = {str(number): usage_detail(number) for number in phone_numbers}
+        self.latency = latency
+        self.jitter = jitter
+        self.unauthorized_rate = unauthorized_rate
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self._utoken_serial = 0
+        self.calls = {}
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._server.daemon_threads = True
+        # Clients giving up on a slow response (timeouts) are expected
+        self._server.handle_error = lambda request, client_address: None
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def point(self, api):
+        """Redirect a StarHubApi instance to this server"""
+        api.msso_login_url = self.url + MSSO_PATH
+        api.fapi_login_url = self.url + ESSO_PATH
+        api.fapi_all_usage_url = self.url + ALL_USAGE_PATH + '?type=local'
+        api.fapi_specific_usage_url = self.url + '/MyStarhub/usage/data/{phone_number}?usageOption=LOCAL'
+        return api
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='mock_starhub', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls = {}
+
+    @property
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _count(self, endpoint):
+        with self._lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+
+    def _issue_utoken(self):
+        with self._lock:
+            self._utoken_serial += 1
+            return 'utoken-{}'.format(self._utoken_serial)
+
+    def _is_current_utoken(self, utoken):
+        with self._lock:
+            return utoken == 'utoken-{}'.format(self._utoken_serial)
+
+    def _respond(self, method, path, headers):
+        """(status, payload) for a request"""
+        path = path.split('?', 1)[0]
+        if method == 'POST' and path == MSSO_PATH:
+            self._count('msso_login')
+            return 200, {'ret_code': 1000, 'ret_msg': 'Success', 'user_token': 'user-token'}
+        if method == 'POST' and path == ESSO_PATH:
+            self._count('esso_login')
+            return 200, {'userDetails': {'utoken': self._issue_utoken()}}
+
+        match = USAGE_PATH.match(path)
+        if method == 'GET' and (match or path == ALL_USAGE_PATH):
+            self._count('usage' if match else 'all_usage')
+            if not self._is_current_utoken(headers.get('Authorization')) \
+                    or random.random() < self.unauthorized_rate:
+                return 401, {'message': 'Unauthorized'}
+            if match:
+                usage_dict = self.payloads.get(match.group(1))
+                if usage_dict is None:
+                    return 404, {'message': 'Not found'}
+                details = [usage_dict]
+            else:
+                details = list(self.payloads.values())
+            return 200, {'mainContext': {'present': {'any': [{'dataUsages': {'usageDetail': details}}]}}}
+
+        self._count('unknown')
+        return 404, {'message': 'Not found'}
+
+    def _handler_class(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self, method):
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    self.rfile.read(length)
+                delay = mock.latency + random.uniform(0, mock.jitter)
+                if delay:
+                    time.sleep(delay)
+                if random.random() < mock.error_rate:
+                    mock._count('injected_500')
+                    status, payload = 500, {'message': 'Internal Server Error'}
+                else:
+                    status, payload = mock._respond(method, self.path, self.headers)
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_POST(self):
+                self._handle('POST')
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,261 @@
+"""
+Offline benchmark of the bot's handlers against MockStarHub
+
+Drives usage_handler, history_handler and callback_handler from main.py
+with a stream of fake Telegram updates and reports throughput, latency
+percentiles, upstream calls per request and memory use.
+
+    python bench/run_bench.py --requests 500 --concurrency 8 --latency 0.05
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import main  # noqa: E402
+from mock_starhub import MockStarHub  # noqa: E402
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.username = 'bench{}'.format(user_id)
+
+
+class FakePhotoSize:
+    def __init__(self, file_id):
+        self.file_id = file_id
+
+
+class FakeMessage:
+    """Records what the handlers send instead of calling Telegram"""
+    _file_ids = 0
+
+    def __init__(self, chat_id, text=''):
+        self.chat_id = chat_id
+        self.text = text
+        self.sent = []
+        self.photo = None
+
+    def reply_text(self, text=None, **kwargs):
+        self.sent.append(text)
+        return FakeMessage(self.chat_id, text)
+
+    def reply_photo(self, photo=None, **kwargs):
+        FakeMessage._file_ids += 1
+        message = FakeMessage(self.chat_id)
+        message.photo = [FakePhotoSize('file-{}'.format(FakeMessage._file_ids))]
+        self.sent.append(message)
+        return message
+
+    def edit_text(self, text=None, **kwargs):
+        self.text = text
+        return self
+
+    def delete(self):
+        return True
+
+
+class FakeCallbackQuery:
+    def __init__(self, data, message):
+        self.data = data
+        self.message = message
+
+    def answer(self, *args, **kwargs):
+        return True
+
+    def edit_message_text(self, text=None, **kwargs):
+        return self.message.edit_text(text)
+
+    def edit_message_media(self, *args, **kwargs):
+        return self.message.reply_photo()
+
+    def edit_message_caption(self, *args, **kwargs):
+        return self.message
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        return self.message
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeUpdate:
+    def __init__(self, user_id, message=None, callback_query=None):
+        self.effective_user = FakeUser(user_id)
+        self.effective_chat = FakeChat(user_id)
+        self.message = message
+        self.callback_query = callback_query
+        self.effective_message = message or callback_query.message
+
+
+class FakeContext:
+    def __init__(self, args=None):
+        self.args = args or []
+        self.bot = None
+
+
+def update_stream(phone_numbers, count, users, fresh_ratio, mix, seed=0):
+    """(name, handler, update, context) tuples in a reproducible order"""
+    rng = random.Random(seed)
+    kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+    for _ in range(count):
+        user_id = rng.randrange(users) + 1
+        number = str(rng.choice(phone_numbers))
+        kind = rng.choice(kinds)
+        args = [number] + (['fresh'] if rng.random() < fresh_ratio else [])
+        if kind == 'usage':
+            update = FakeUpdate(user_id, message=FakeMessage(user_id, '/usage ' + ' '.join(args)))
+            yield kind, main.usage_handler, update, FakeContext(args)
+        elif kind == 'history':
+            update = FakeUpdate(user_id, message=FakeMessage(user_id, '/history ' + ' '.join(args)))
+            yield kind, main.history_handler, update, FakeContext(args)
+        else:
+            callback_type = rng.choice(('u-', 'h-'))
+            query = FakeCallbackQuery(callback_type + number, FakeMessage(user_id))
+            yield kind, main.callback_handler, FakeUpdate(user_id, callback_query=query), FakeContext()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def write_config(directory, phone_numbers, args):
+    config = {
+        'telegram_token': 'bench',
+        'user_id': 'bench@example.com',
+        'user_password': 'bench',
+        'token_cache_path': None,
+        'usage_cache_ttl': args.cache_ttl,
+        'http_timeout': 10,
+        'prefetch_enabled': False,
+        'history_db_path': os.path.join(directory, 'history.sqlite3'),
+        'alerts_path': os.path.join(directory, 'alerts.json'),
+        'whitelisted_user_names': list(range(1, args.users + 1)),
+        'phone_numbers': phone_numbers,
+    }
+    path = os.path.join(directory, 'config.json')
+    with open(path, 'w') as f:
+        json.dump(config, f)
+    return path
+
+
+def run(args):
+    phone_numbers = [90000000 + i for i in range(args.numbers)]
+    mock = MockStarHub(phone_numbers, latency=args.latency, jitter=args.jitter,
+                       unauthorized_rate=args.unauthorized_rate,
+                       error_rate=args.error_rate).start()
+    mix = {'usage': args.usage_weight, 'history': args.history_weight, 'callback': args.callback_weight}
+
+    with tempfile.TemporaryDirectory() as directory:
+        main.init(write_config(directory, phone_numbers, args))
+        for api in main.accounts.accounts.values():
+            mock.point(api)
+        try:
+            if args.warmup:
+                for _, handler, update, context in update_stream(phone_numbers, args.warmup, args.users,
+                                                                 args.fresh_ratio, mix, seed=args.seed + 1):
+                    handler(update, context)
+            mock.reset_calls()
+
+            stream = list(update_stream(phone_numbers, args.requests, args.users,
+                                        args.fresh_ratio, mix, seed=args.seed))
+            latencies = {}
+            failures = {}
+
+            def handle(item):
+                kind, handler, update, context = item
+                started = time.perf_counter()
+                try:
+                    handler(update, context)
+                except Exception:
+                    failures[kind] = failures.get(kind, 0) + 1
+                latencies.setdefault(kind, []).append(time.perf_counter() - started)
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(handle, stream))
+            elapsed = time.perf_counter() - started
+            _, peak_bytes = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            main.chart_renderer.shutdown()
+            if main.history_store:
+                main.history_store.close()
+            mock.stop()
+
+    all_latencies = sorted(latency for values in latencies.values() for latency in values)
+    return {
+        'requests': args.requests,
+        'concurrency': args.concurrency,
+        'elapsed_s': elapsed,
+        'throughput_rps': args.requests / elapsed if elapsed else 0.,
+        'p50_ms': percentile(all_latencies, .5) * 1000,
+        'p99_ms': percentile(all_latencies, .99) * 1000,
+        'by_handler': {kind: {'count': len(values),
+                              'p50_ms': percentile(sorted(values), .5) * 1000,
+                              'p99_ms': percentile(sorted(values), .99) * 1000,
+                              'failures': failures.get(kind, 0)}
+                       for kind, values in sorted(latencies.items())},
+        'upstream_calls': dict(mock.calls),
+        'upstream_calls_per_request': mock.total_calls / float(args.requests),
+        'traced_peak_mb': peak_bytes / 1024. / 1024.,
+        'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+    }
+
+
+def print_report(result):
+    print('Requests:          {requests} at concurrency {concurrency}'.format(**result))
+    print('Throughput:        {throughput_rps:.1f} req/s ({elapsed_s:.2f}s)'.format(**result))
+    print('Latency:           p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms'.format(**result))
+    for kind, stats in result['by_handler'].items():
+        print('  {:<16} {count:>5} requests, p50 {p50_ms:.1f} ms, p99 {p99_ms:.1f} ms, '
+              '{failures} failed'.format(kind, **stats))
+    print('Upstream calls:    {upstream_calls_per_request:.3f} per request'.format(**result))
+    for endpoint, count in sorted(result['upstream_calls'].items()):
+        print('  {:<16} {:>5}'.format(endpoint, count))
+    print('Memory:            {traced_peak_mb:.1f} MB traced peak, {max_rss_mb:.1f} MB max RSS'.format(**result))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--users', type=int, default=5)
+    parser.add_argument('--numbers', type=int, default=3, help='Phone numbers on the mock account')
+    parser.add_argument('--latency', type=float, default=0.05, help='Mock StarHub latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.)
+    parser.add_argument('--unauthorized-rate', type=float, default=0., help='Fraction of 401 usage responses')
+    parser.add_argument('--error-rate', type=float, default=0., help='Fraction of 500 responses')
+    parser.add_argument('--fresh-ratio', type=float, default=0.1, help="Fraction of requests asking for 'fresh'")
+    parser.add_argument('--cache-ttl', type=int, default=300)
+    parser.add_argument('--usage-weight', type=int, default=3)
+    parser.add_argument('--history-weight', type=int, default=1)
+    parser.add_argument('--callback-weight', type=int, default=2)
+    parser.add_argument('--warmup', type=int, default=10, help='Untimed requests sent first')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    results = run(arguments)
+    if arguments.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
@@ -0,0 +1,386 @@
+"""
+StarHub accounts, each with its own session, tokens and request queue
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+import metrics
+from starhub_api import StarHubApi
+from state_backend import create_backend
+from usage_cache import UsageCache
+
+# config.json keys passed on to StarHubApi, either at the top level (shared
+# by every account) or inside an account entry
+API_SETTINGS = ('utoken_ttl', 'token_cache_path', 'usage_cache_ttl', 'usage_cache_size',
+                'http_timeout', 'http_pool_size', 'batch_concurrency',
+                'retry_max_attempts', 'retry_base_delay', 'retry_max_delay',
+                'circuit_failure_threshold', 'circuit_reset_timeout', 'utoken_lease_ttl')
+
+
+def account_settings(config):
+    """Settings of every account described by config.json
+
+    config['accounts'] lists the accounts, each with a name, user_id,
+    user_password, phone_numbers and optionally its own API_SETTINGS.
+    Without it, the top level user_id, user_password and phone_numbers
+    describe a single account, as before multi-account support.
+
+    Returns:
+        list of dicts with the name, phone_numbers and the StarHubApi
+        keyword arguments ('api') of each account
+    """
+    shared = {key: config[key] for key in API_SETTINGS if key in config}
+    entries = config.get('accounts') or [{'name': 'default',
+                                          'user_id': config['user_id'],
+                                          'user_password': config['user_password'],
+                                          'phone_numbers': config['phone_numbers']}]
+    settings = []
+    for entry in entries:
+        name = entry.get('name') or entry['user_id']
+        api_settings = dict(shared)
+        api_settings.update((key, entry[key]) for key in API_SETTINGS if key in entry)
+        # Accounts sharing a token file would overwrite each other's tokens
+        if len(entries) > 1 and api_settings.get('token_cache_path') and 'token_cache_path' not in entry:
+            root, ext = os.path.splitext(api_settings['token_cache_path'])
+            api_settings['token_cache_path'] = '{}-{}{}'.format(root, name, ext)
+        api_settings.update(user_id=entry['user_id'], user_password=entry['user_password'])
+        settings.append({'name': name, 'phone_numbers': list(entry['phone_numbers']), 'api': api_settings})
+    return settings
+
+
+# State of a shard worker process, see _init_shard
+_shard_apis = {}
+_shard_events = []
+
+
+def _init_shard(settings, state_url):
+    state = create_backend(state_url)
+    for account in settings:
+        api = StarHubApi(state=state, **account['api'])
+        api.add_usage_listener(lambda phone_number, usage_dict: _shard_events.append((phone_number, usage_dict)))
+        _shard_apis[account['name']] = api
+
+
+def _shard_call(name, method, args, kwargs):
+    """Runs in the shard process, returns (result, usage fetched meanwhile)"""
+    del _shard_events[:]
+    result = getattr(_shard_apis[name], method)(*args, **kwargs)
+    return result, list(_shard_events)
+
+
+class ShardedAccount:
+    """Proxy to a StarHubApi living in a shard worker process
+
+    Offers the StarHubApi methods used by the bot. Usage fetched by the
+    worker is mirrored into a local usage cache, so cache hits never leave
+    this process, and handed to the local usage listeners.
+
+    Args:
+        executor: Single process executor of the account's shard
+        name: Account name
+        api_settings: StarHubApi keyword arguments of the account
+    """
+
+    def __init__(self, executor, name, api_settings):
+        self.logger = logging.getLogger('accounts')
+        self.executor = executor
+        self.name = name
+        self.http_timeout = api_settings.get('http_timeout', 10)
+        self.usage_cache = UsageCache(ttl=api_settings.get('usage_cache_ttl', 300),
+                                      max_entries=api_settings.get('usage_cache_size', 64))
+        self._usage_listeners = []
+
+    def add_usage_listener(self, listener):
+        self._usage_listeners.append(listener)
+
+    def _call(self, method, *args, **kwargs):
+        result, events = self.executor.submit(_shard_call, self.name, method, args, kwargs).result()
+        for phone_number, usage_dict in events:
+            self.usage_cache.put(phone_number, usage_dict)
+            for listener in self._usage_listeners:
+                try:
+                    listener(str(phone_number), usage_dict)
+                except Exception:
+                    self.logger.exception('Usage listener %r failed', listener)
+        return result
+
+    def _cached(self, phone_number, fresh, max_age):
+        if fresh:
+            return None
+        usage_dict = self.usage_cache.get(phone_number, max_age=max_age)
+        if usage_dict is not None:
+            metrics.USAGE_CACHE_REQUESTS.inc('hit')
+        return usage_dict
+
+    def get_phone_data_usage(self, phone_number, fresh=False, max_age=None):
+        usage_dict = self._cached(phone_number, fresh, max_age)
+        if usage_dict is None:
+            usage_dict = self._call('get_phone_data_usage', phone_number, fresh=fresh, max_age=max_age)
+            self.usage_cache.put(phone_number, usage_dict)
+        return usage_dict
+
+    def get_phone_data_usage_batch(self, phone_numbers, fresh=False, timeout=None, max_age=None):
+        usage_by_number = {}
+        missing_numbers = []
+        for phone_number in phone_numbers:
+            usage_dict = self._cached(phone_number, fresh, max_age)
+            if usage_dict is None:
+                missing_numbers.append(phone_number)
+            else:
+                usage_by_number[str(phone_number)] = usage_dict
+        errors_by_number = {}
+        if missing_numbers:
+            fetched, errors_by_number = self._call('get_phone_data_usage_batch', missing_numbers,
+                                                   fresh=fresh, timeout=timeout, max_age=max_age)
+            for phone_number, usage_dict in fetched.items():
+                self.usage_cache.put(phone_number, usage_dict)
+            usage_by_number.update(fetched)
+        return usage_by_number, errors_by_number
+
+    def get_all_usage(self):
+        return self._call('get_all_usage')
+
+    def shutdown(self):
+        # The shard process is shut down with its executor by AccountRegistry
+        pass
+
+
+class AccountRegistry:
+    """Routes every phone number to the StarHub account owning it
+
+    Each account has its own StarHubApi, hence its own session, token
+    state, usage cache and batch executor, so logging in on one account
+    never invalidates another account's u_token. With shards > 0 the
+    accounts are spread round-robin over that many worker processes, and
+    an account stuck on a slow or locked out login only holds up its own
+    shard.
+
+    Offers the StarHubApi methods used by the bot, so it can stand in for
+    a StarHubApi (e.g. for UsagePrefetcher).
+
+    The accounts and their phone numbers can be changed with reload().
+
+    Args:
+        settings: Output of account_settings
+        shards: Number of worker processes, 0 keeps every account in this process
+        state: state_backend backend shared by the accounts, shard workers
+            connect to the same backend through its url
+    """
+
+    def __init__(self, settings, shards=0, state=None):
+        self.logger = logging.getLogger('accounts')
+        self._executors = []
+        self._api_settings = {account['name']: account['api'] for account in settings}
+        self._usage_listeners = []
+        self.sharded = bool(shards)
+        self.state = state = state if state is not None else create_backend()
+
+        accounts = {}
+        if shards:
+            shards = min(shards, len(settings))
+            assigned = [settings[index::shards] for index in range(shards)]
+            for shard_settings in assigned:
+                # spawn for the same reason as the chart workers
+                executor = ProcessPoolExecutor(max_workers=1,
+                                               mp_context=multiprocessing.get_context('spawn'),
+                                               initializer=_init_shard,
+                                               initargs=([{'name': account['name'], 'api': account['api']}
+                                                          for account in shard_settings], state.url))
+                self._executors.append(executor)
+                for account in shard_settings:
+                    accounts[account['name']] = ShardedAccount(executor, account['name'], account['api'])
+        else:
+            for account in settings:
+                accounts[account['name']] = StarHubApi(state=state, **account['api'])
+
+        # (accounts by name, account name by phone number, phone numbers),
+        # replaced as a whole by reload() and read once per call
+        self._routes = (accounts,) + self._number_owners(settings)
+        self.http_timeout = max(api.http_timeout for api in accounts.values())
+        self._fan_out_lock = threading.Lock()
+        self._fan_out_size = max(1, len(accounts))
+        self._fan_out = self._create_fan_out(self._fan_out_size)
+
+    @property
+    def accounts(self):
+        return self._routes[0]
+
+    @property
+    def phone_numbers(self):
+        return self._routes[2]
+
+    @staticmethod
+    def _create_fan_out(size):
+        return ThreadPoolExecutor(max_workers=size, thread_name_prefix='accounts')
+
+    def _submit(self, calls):
+        """Submit (key, fn, args, kwargs) calls to the fan out pool
+
+        Returns:
+            dict mapping each future to its key
+        """
+        # Under the lock, so reload() never shuts the pool down in between
+        with self._fan_out_lock:
+            return {self._fan_out.submit(fn, *args, **kwargs): key for key, fn, args, kwargs in calls}
+
+    @staticmethod
+    def _number_owners(settings):
+        owners = {}
+        phone_numbers = []
+        for account in settings:
+            for phone_number in account['phone_numbers']:
+                owners[str(phone_number)] = account['name']
+                phone_numbers.append(phone_number)
+        return owners, phone_numbers
+
+    def reload(self, settings):
+        """Switch to new account settings without a restart
+
+        Accounts whose settings did not change keep their StarHubApi, hence
+        their tokens and usage cache. In-process accounts are created,
+        replaced or dropped as needed, the replaced and dropped ones are shut
+        down. Sharded accounts can only be dropped or have their phone
+        numbers changed, other changes are logged and wait for a restart.
+
+        Returns:
+            Names of the accounts whose change requires a restart
+        """
+        accounts = dict(self.accounts)
+        api_settings = dict(self._api_settings)
+        created = []
+        retired = []
+        pending = []
+        try:
+            for account in settings:
+                name = account['name']
+                if api_settings.get(name) == account['api']:
+                    continue
+                if self.sharded:
+                    pending.append(name)
+                    continue
+                api = StarHubApi(state=self.state, **account['api'])
+                created.append(name)
+                for listener in self._usage_listeners:
+                    api.add_usage_listener(listener)
+                if name in accounts:
+                    retired.append(accounts[name])
+                accounts[name] = api
+                api_settings[name] = account['api']
+        except Exception:
+            # Nothing was applied, the next reload starts over
+            for name in created:
+                accounts[name].shutdown()
+            raise
+
+        settings = [account for account in settings if account['name'] not in pending
+                    or account['name'] in accounts]
+        names = {account['name'] for account in settings}
+        removed = set(accounts) - names
+        for name in removed:
+            retired.append(accounts.pop(name))
+            del api_settings[name]
+
+        # A single assignment, so callers never mix the routes of two configs
+        self._routes = (accounts,) + self._number_owners(settings)
+        self._api_settings = api_settings
+        for name in created:
+            self.logger.info('Account %s (re)created', name)
+        for name in removed:
+            self.logger.info('Account %s removed', name)
+        if pending:
+            self.logger.warning('Restart required to apply the changes to accounts %s', ', '.join(pending))
+
+        # Sized for one call per account, so accounts are queried concurrently
+        if len(accounts) > self._fan_out_size:
+            self._fan_out_size = len(accounts)
+            with self._fan_out_lock:
+                previous, self._fan_out = self._fan_out, self._create_fan_out(self._fan_out_size)
+            previous.shutdown(wait=False)
+        for api in retired:
+            api.shutdown()
+        return pending
+
+    def has_number(self, phone_number):
+        return str(phone_number) in self._routes[1]
+
+    def account_for(self, phone_number):
+        """StarHubApi (or ShardedAccount) owning phone_number
+
+        Raises:
+            KeyError: phone_number is not configured
+        """
+        accounts, owners, _ = self._routes
+        return accounts[owners[str(phone_number)]]
+
+    def add_usage_listener(self, listener):
+        self._usage_listeners.append(listener)
+        for api in self.accounts.values():
+            api.add_usage_listener(listener)
+
+    def cached_usage(self, phone_number):
+        """Last fetched usage of phone_number, whatever its age"""
+        if not self.has_number(phone_number):
+            return None
+        return self.account_for(phone_number).usage_cache.get(phone_number, max_age=float('inf'))
+
+    def get_phone_data_usage(self, phone_number, fresh=False, max_age=None):
+        return self.account_for(phone_number).get_phone_data_usage(phone_number, fresh=fresh, max_age=max_age)
+
+    def get_phone_data_usage_batch(self, phone_numbers, fresh=False, timeout=None, max_age=None):
+        """StarHubApi.get_phone_data_usage_batch, each account queried concurrently
+
+        Numbers that are not configured are reported in errors_by_number
+        with a KeyError.
+        """
+        accounts, owners, _ = self._routes
+        numbers_by_account = {}
+        errors_by_number = {}
+        for phone_number in phone_numbers:
+            name = owners.get(str(phone_number))
+            if name is None:
+                # e.g. dropped by a config reload since the caller listed it
+                errors_by_number[str(phone_number)] = KeyError(phone_number)
+            else:
+                numbers_by_account.setdefault(name, []).append(phone_number)
+
+        futures = self._submit([(numbers, accounts[name].get_phone_data_usage_batch, (numbers,),
+                                 {'fresh': fresh, 'timeout': timeout, 'max_age': max_age})
+                                for name, numbers in numbers_by_account.items()])
+        usage_by_number = {}
+        for future in as_completed(futures):
+            try:
+                fetched, errors = future.result()
+            except Exception as ex:
+                fetched, errors = {}, {str(phone_number): ex for phone_number in futures[future]}
+            usage_by_number.update(fetched)
+            errors_by_number.update(errors)
+        return usage_by_number, errors_by_number
+
+    def get_all_usage(self):
+        """Usage of every line of every account
+
+        Accounts whose request fails are left out, the error is only
+        raised if every account failed.
+        """
+        futures = self._submit([(name, api.get_all_usage, (), {}) for name, api in self.accounts.items()])
+        usage_by_number = {}
+        error = None
+        for future in as_completed(futures):
+            try:
+                usage_by_number.update(future.result())
+            except Exception as ex:
+                self.logger.warning('All usage request failed for account %s: %s', futures[future], ex)
+                error = ex
+        if error is not None and not usage_by_number:
+            raise error
+        return usage_by_number
+
+    def shutdown(self):
+        self._fan_out.shutdown(wait=False)
+        for api in self.accounts.values():
+            api.shutdown()
+        for executor in self._executors:
+            executor.shutdown(wait=False)
@@ -0,0 +1,163 @@
+"""
+Per chat usage alerts pushed whenever fresh usage data comes in
+"""
+import json
+import logging
+import os
+import threading
+
+import billing_calendar
+from usage_parser import parse_usage_detail, sg_today
+
+# Alert kinds
+QUOTA = 'quota'
+DAILY = 'daily'
+
+
+class AlertEngine:
+    """Evaluates alert rules against every fetched usageDetail
+
+    Rules are indexed by phone number, so a refresh only evaluates the
+    chats watching that number, and a number is only rechecked when its
+    lastProcessedDateTime moved since the previous snapshot. Each alert
+    fires at most once per period (billing cycle for quota alerts, day for
+    daily alerts). Alerts are queued and sent in one message per chat by
+    flush().
+
+    Rules and fired alerts are persisted to path.
+
+    Args:
+        path: JSON file holding the rules
+        exclude_holidays: Passed to billing_calendar for the daily limit
+    """
+
+    def __init__(self, path, exclude_holidays=False):
+        self.logger = logging.getLogger('alerts')
+        self.path = path
+        self.exclude_holidays = exclude_holidays
+        self._lock = threading.Lock()
+        # {phone_number: {chat_id: {kind: threshold}}}
+        self._rules = {}
+        # {'chat_id:phone_number:kind': period last fired}
+        self._fired = {}
+        self._last_processed = {}
+        self._pending = {}
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as ex:
+            self.logger.warning('Unable to load alerts: %s', ex)
+            return
+        self._rules = {phone_number: {int(chat_id): rules for chat_id, rules in chats.items()}
+                       for phone_number, chats in state.get('rules', {}).items()}
+        self._fired = state.get('fired', {})
+
+    def _save(self):
+        if not self.path:
+            return
+        tmp_path = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump({'rules': self._rules, 'fired': self._fired}, f)
+            os.replace(tmp_path, self.path)
+        except OSError as ex:
+            self.logger.warning('Unable to save alerts: %s', ex)
+
+    def set_rule(self, chat_id, phone_number, kind, threshold=None):
+        with self._lock:
+            self._rules.setdefault(str(phone_number), {}).setdefault(chat_id, {})[kind] = threshold
+            # Re-evaluate the number on the next refresh
+            self._last_processed.pop(str(phone_number), None)
+            self._save()
+
+    def remove_rules(self, chat_id, phone_number=None):
+        with self._lock:
+            for number, chats in list(self._rules.items()):
+                if phone_number is None or number == str(phone_number):
+                    chats.pop(chat_id, None)
+                    if not chats:
+                        del self._rules[number]
+            self._save()
+
+    def rules_for(self, chat_id):
+        """{phone_number: {kind: threshold}} configured for chat_id"""
+        with self._lock:
+            return {number: dict(chats[chat_id])
+                    for number, chats in self._rules.items() if chat_id in chats}
+
+    def on_usage(self, phone_number, usage_dict):
+        """StarHubApi usage listener"""
+        phone_number = str(phone_number)
+        with self._lock:
+            chats = self._rules.get(phone_number)
+            if not chats:
+                return
+            processed = usage_dict.get('lastProcessedDateTime')
+            processed = tuple(sorted(processed.items())) if processed else None
+            if processed is not None and self._last_processed.get(phone_number) == processed:
+                return
+            self._last_processed[phone_number] = processed
+            chats = {chat_id: dict(rules) for chat_id, rules in chats.items()}
+
+        record = parse_usage_detail(usage_dict)
+        today = sg_today()
+        messages = []
+        for chat_id, rules in chats.items():
+            for kind, threshold in rules.items():
+                alert = self._evaluate(record, kind, threshold, today)
+                if alert is not None:
+                    period, text = alert
+                    messages.append((chat_id, '{}:{}:{}'.format(chat_id, phone_number, kind), period, text))
+
+        if not messages:
+            return
+        with self._lock:
+            for chat_id, fired_key, period, text in messages:
+                if self._fired.get(fired_key) == period:
+                    continue
+                self._fired[fired_key] = period
+                self._pending.setdefault(chat_id, []).append(text)
+            self._save()
+
+    def _evaluate(self, record, kind, threshold, today):
+        """(period, alert text) if the rule is triggered, else None"""
+        cycle_start = record.from_datetime.date()
+        if kind == QUOTA:
+            if not record.total_free_mb:
+                return None
+            used_percent = 100. * record.total_usage_mb / record.total_free_mb
+            if used_percent >= threshold:
+                return cycle_start.isoformat(), '{} has used {:.0f}% of its {} {} data'.format(
+                    record.service_id, used_percent, record.total_free_units, record.total_free_units_uom)
+        elif kind == DAILY:
+            cycle = billing_calendar.billing_cycle(cycle_start, self.exclude_holidays)
+            if not cycle.is_working_day(today):
+                return None
+            limit_mb = cycle.daily_limit_mb(record.usage_difference_mb, record.today_usage_mb, today)
+            if record.today_usage_mb > limit_mb:
+                return today.isoformat(), '{} used {:.2f} MB today, above the {:.2f} MB daily limit'.format(
+                    record.service_id, record.today_usage_mb, limit_mb)
+        return None
+
+    def flush(self, bot):
+        """Send the queued alerts, one message per chat"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for chat_id, texts in pending.items():
+            try:
+                bot.send_message(chat_id=chat_id,
+                                 text='\n'.join(['⚠️ Data usage alert'] + texts))
+            except Exception as ex:
+                self.logger.error('Unable to send alerts to %s: %s', chat_id, ex)
+
+    def flush_job(self, context):
+        """JobQueue callback for flush"""
+        self.flush(context.bot)
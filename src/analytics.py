@@ -0,0 +1,100 @@
+"""
+Vectorized usage analytics and end of cycle forecasting
+"""
+from datetime import timedelta
+
+import numpy as np
+
+# Two-sided 95% interval of a normal distribution
+Z_95 = 1.96
+
+# Days in the trailing average
+ROLLING_WINDOW = 7
+
+
+class UsageForecast:
+    """Outcome of forecast_cycle, all figures in MB"""
+    __slots__ = ('rolling_avg_mb', 'weekday_avg_mb', 'weekend_avg_mb',
+                 'projected_total_mb', 'projected_low_mb', 'projected_high_mb',
+                 'quota_mb', 'exhausted_on')
+
+    def __init__(self, rolling_avg_mb, weekday_avg_mb, weekend_avg_mb,
+                 projected_total_mb, projected_low_mb, projected_high_mb,
+                 quota_mb, exhausted_on):
+        self.rolling_avg_mb = rolling_avg_mb
+        self.weekday_avg_mb = weekday_avg_mb
+        self.weekend_avg_mb = weekend_avg_mb
+        self.projected_total_mb = projected_total_mb
+        self.projected_low_mb = projected_low_mb
+        self.projected_high_mb = projected_high_mb
+        self.quota_mb = quota_mb
+        self.exhausted_on = exhausted_on
+
+
+def rolling_mean(values, window):
+    """Trailing moving average, shorter series use all their values"""
+    window = max(1, min(window, len(values)))
+    cumulative = np.cumsum(np.insert(values, 0, 0.))
+    return (cumulative[window:] - cumulative[:-window]) / window
+
+
+def _mean_std(values):
+    if values.size == 0:
+        return 0., 0.
+    return float(values.mean()), float(values.std())
+
+
+def forecast_cycle(daily_usage, used_mb, quota_mb, today, cycle_end, window=ROLLING_WINDOW):
+    """Project the usage at the end of the billing cycle
+
+    Weekdays and weekends are modelled separately from the completed days
+    of daily_usage (which may span several cycles, e.g. from the history
+    store). Today's usage is still being counted and is left out.
+
+    Args:
+        daily_usage: DailyUsage records, oldest first
+        used_mb: Usage of the current cycle so far
+        quota_mb: Data included in the cycle
+        today: Current date
+        cycle_end: First day of the next billing cycle
+        window: Days in the rolling average
+    """
+    completed = [usage for usage in daily_usage if usage.date < today]
+    days = np.array([usage.date for usage in completed], dtype='datetime64[D]')
+    usage_mb = np.array([usage.volume_mb for usage in completed], dtype=float)
+    is_weekday = np.is_busday(days)
+
+    rolling = rolling_mean(usage_mb, window)
+    weekday_avg, weekday_std = _mean_std(usage_mb[is_weekday])
+    weekend_avg, weekend_std = _mean_std(usage_mb[~is_weekday])
+    # Without any weekend (or weekday) sample yet, assume days are alike
+    if not is_weekday.any():
+        weekday_avg, weekday_std = weekend_avg, weekend_std
+    if is_weekday.all():
+        weekend_avg, weekend_std = weekday_avg, weekday_std
+
+    # Expected usage of every remaining day of the cycle, today included
+    remaining = np.arange(np.datetime64(today, 'D'), np.datetime64(cycle_end, 'D'))
+    remaining_is_weekday = np.is_busday(remaining)
+    expected = np.where(remaining_is_weekday, weekday_avg, weekend_avg)
+    variance = np.where(remaining_is_weekday, weekday_std ** 2, weekend_std ** 2).sum()
+
+    projected_total = used_mb + float(expected.sum())
+    margin = Z_95 * float(np.sqrt(variance))
+
+    exhausted_on = None
+    cumulative = used_mb + np.cumsum(expected)
+    index = int(np.searchsorted(cumulative, quota_mb))
+    if index < remaining.size and quota_mb > used_mb:
+        exhausted_on = today + timedelta(days=index)
+    elif quota_mb <= used_mb:
+        exhausted_on = today
+
+    return UsageForecast(rolling_avg_mb=float(rolling[-1]) if rolling.size else 0.,
+                         weekday_avg_mb=weekday_avg,
+                         weekend_avg_mb=weekend_avg,
+                         projected_total_mb=projected_total,
+                         projected_low_mb=max(used_mb, projected_total - margin),
+                         projected_high_mb=projected_total + margin,
+                         quota_mb=quota_mb,
+                         exhausted_on=exhausted_on)
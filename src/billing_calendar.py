@@ -0,0 +1,108 @@
+"""
+Billing cycle calendar: weekday counting without enumerating days
+"""
+import bisect
+import calendar
+from datetime import date, timedelta
+from functools import lru_cache
+
+# Singapore public holidays as gazetted by MOM, including the Mondays
+# given in lieu of holidays falling on a Sunday. Extend yearly.
+SG_PUBLIC_HOLIDAYS = frozenset((
+    # 2024
+    date(2024, 1, 1), date(2024, 2, 10), date(2024, 2, 11), date(2024, 2, 12),
+    date(2024, 3, 29), date(2024, 4, 10), date(2024, 5, 1), date(2024, 5, 22),
+    date(2024, 6, 17), date(2024, 8, 9), date(2024, 10, 31), date(2024, 12, 25),
+    # 2025
+    date(2025, 1, 1), date(2025, 1, 29), date(2025, 1, 30), date(2025, 3, 31),
+    date(2025, 4, 18), date(2025, 5, 1), date(2025, 5, 3), date(2025, 5, 12),
+    date(2025, 6, 7), date(2025, 8, 9), date(2025, 10, 20), date(2025, 12, 25),
+    # 2026
+    date(2026, 1, 1), date(2026, 2, 17), date(2026, 2, 18), date(2026, 3, 21),
+    date(2026, 4, 3), date(2026, 5, 1), date(2026, 5, 27), date(2026, 5, 31),
+    date(2026, 6, 1), date(2026, 8, 9), date(2026, 8, 10), date(2026, 11, 8),
+    date(2026, 11, 9), date(2026, 12, 25),
+))
+
+# Only holidays falling on a weekday reduce the number of working days
+_WEEKDAY_HOLIDAYS = sorted(day for day in SG_PUBLIC_HOLIDAYS if day.weekday() < 5)
+
+
+def count_weekdays(start, end):
+    """Number of Monday-Friday dates in the closed interval [start, end]
+
+    Whole weeks contribute 5 weekdays each, so only the (at most 6)
+    remaining days need to be looked at.
+    """
+    if end < start:
+        return 0
+    full_weeks, remaining_days = divmod((end - start).days + 1, 7)
+    first_weekday = start.weekday()
+    partial = sum(1 for offset in range(remaining_days) if (first_weekday + offset) % 7 < 5)
+    return full_weeks * 5 + partial
+
+
+def count_weekday_holidays(start, end):
+    """Number of public holidays on a weekday in [start, end]"""
+    if end < start:
+        return 0
+    return bisect.bisect_right(_WEEKDAY_HOLIDAYS, end) - bisect.bisect_left(_WEEKDAY_HOLIDAYS, start)
+
+
+def add_months(day, months):
+    """Shift day by months, clamping to the end of shorter months"""
+    month_index = day.month - 1 + months
+    year = day.year + month_index // 12
+    month = month_index % 12 + 1
+    return date(year, month, min(day.day, calendar.monthrange(year, month)[1]))
+
+
+class BillingCycle:
+    """Working day calendar of one billing cycle
+
+    Args:
+        start: First day of the cycle
+        exclude_holidays: Treat Singapore public holidays as non-working
+    """
+    __slots__ = ('start', 'end', 'exclude_holidays', 'total_working_days')
+
+    def __init__(self, start, exclude_holidays=False):
+        self.start = start
+        # Half closed interval [start, end)
+        self.end = add_months(start, 1)
+        self.exclude_holidays = exclude_holidays
+        self.total_working_days = self.count_working_days(start, self.end - timedelta(days=1))
+
+    def count_working_days(self, start, end):
+        """Working days in the closed interval [start, end]"""
+        working_days = count_weekdays(start, end)
+        if self.exclude_holidays:
+            working_days -= count_weekday_holidays(start, end)
+        return working_days
+
+    def is_working_day(self, day):
+        if day.weekday() >= 5:
+            return False
+        return not (self.exclude_holidays and day in SG_PUBLIC_HOLIDAYS)
+
+    def working_days_left(self, today):
+        """Working days left in the cycle, including today"""
+        elapsed = self.count_working_days(self.start, today - timedelta(days=1))
+        return self.total_working_days - elapsed
+
+    def daily_limit_mb(self, data_left_mb, today_usage_mb, today):
+        """Data that can be used per working day for the rest of the cycle
+
+        (data left + data used today) / working days left (including today),
+        the data used today is only added back if today is a working day.
+        """
+        if self.is_working_day(today):
+            data_left_mb += today_usage_mb
+        working_days_left = self.working_days_left(today)
+        return data_left_mb / (working_days_left if (working_days_left > 0) else 1)
+
+
+@lru_cache(maxsize=128)
+def billing_cycle(start, exclude_holidays=False):
+    """Memoized BillingCycle starting on start (the usage fromDateTime)"""
+    return BillingCycle(start, exclude_holidays)
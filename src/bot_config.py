@@ -0,0 +1,179 @@
+"""
+config.json validated and compiled into the lookups the handlers use, reloaded when the file changes
+"""
+import json
+import logging
+import os
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from accounts import account_settings
+
+# Callback data prefixes of the inline keyboards
+KEYBOARD_TYPES = ('u-', 'h-')
+
+# Keys only read when the bot starts, changing them requires a restart
+RESTART_KEYS = ('telegram_token', 'state_backend', 'account_shards',
+                'chart_backend', 'chart_workers', 'chart_cache_size',
+                'history_db_path', 'prefetch_enabled', 'prefetch_min_interval', 'prefetch_max_interval',
+                'alerts_path', 'alert_flush_interval', 'exclude_public_holidays',
+                'rate_limit_user_per_minute', 'rate_limit_user_burst',
+                'rate_limit_number_per_minute', 'rate_limit_number_burst', 'duplicate_callback_window',
+                'webhook_url', 'webhook_port', 'webhook_workers', 'webhook_queue_size', 'webhook_drain_timeout',
+                'metrics_port', 'metrics_host', 'config_reload_interval')
+
+
+class ConfigError(Exception):
+    """config.json is missing, malformed or invalid"""
+
+
+class BotConfig:
+    """config.json compiled for the hot paths
+
+    Phone numbers and whitelisted users are held in sets and the inline
+    keyboards are built once. Instances are never modified, a reload
+    builds a new one which replaces the previous one in a single
+    assignment, so a handler always sees one consistent config.
+
+    Args:
+        raw: Parsed config.json
+
+    Raises:
+        ConfigError: raw is not a valid config
+    """
+
+    def __init__(self, raw):
+        if not isinstance(raw, dict):
+            raise ConfigError('config.json must hold an object')
+        if not isinstance(raw.get('telegram_token'), str) or not raw['telegram_token']:
+            raise ConfigError('telegram_token is required')
+        whitelist = raw.get('whitelisted_user_names')
+        if not isinstance(whitelist, list):
+            raise ConfigError('whitelisted_user_names must be a list')
+
+        try:
+            self.accounts = account_settings(raw)
+        except (KeyError, TypeError) as ex:
+            raise ConfigError('Invalid account, missing {}'.format(ex))
+
+        self.phone_numbers = []
+        owners = {}
+        for account in self.accounts:
+            for phone_number in account['phone_numbers']:
+                if not str(phone_number).isdigit():
+                    raise ConfigError('Invalid phone number: {!r}'.format(phone_number))
+                if str(phone_number) in owners:
+                    raise ConfigError('Phone number {} is listed by {} and {}'.format(
+                        phone_number, owners[str(phone_number)], account['name']))
+                owners[str(phone_number)] = account['name']
+                self.phone_numbers.append(phone_number)
+        if len({account['name'] for account in self.accounts}) < len(self.accounts):
+            raise ConfigError('Account names must be unique')
+
+        self.raw = raw
+        self._phone_number_set = frozenset(owners)
+        self._user_ids = frozenset(user for user in whitelist if isinstance(user, int))
+        self._user_names = frozenset(user for user in whitelist if isinstance(user, str))
+        self._keyboards = {
+            callback_type: InlineKeyboardMarkup(
+                [[InlineKeyboardButton(str(number), callback_data=callback_type + str(number))]
+                 for number in self.phone_numbers])
+            for callback_type in KEYBOARD_TYPES}
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def has_number(self, phone_number):
+        return str(phone_number) in self._phone_number_set
+
+    def is_whitelisted(self, user):
+        return user.id in self._user_ids or (user.username is not None and user.username in self._user_names)
+
+    def inline_keyboard(self, callback_type):
+        """Keyboard listing every phone number"""
+        return self._keyboards[callback_type]
+
+    def restart_required(self, other):
+        """RESTART_KEYS whose value differs in other"""
+        return [key for key in RESTART_KEYS if self.raw.get(key) != other.raw.get(key)]
+
+    def with_restart_keys_of(self, running):
+        """This config, with the RESTART_KEYS values of the running config
+
+        What a reload can apply, the values only read at startup stay those
+        the running objects were created with until the bot restarts.
+        """
+        raw = {key: value for key, value in self.raw.items() if key not in RESTART_KEYS}
+        raw.update((key, running.raw[key]) for key in RESTART_KEYS if key in running.raw)
+        return BotConfig(raw)
+
+
+def load_config(path):
+    """Read and compile config.json
+
+    Raises:
+        ConfigError: The file cannot be read or is not a valid config
+    """
+    try:
+        with open(path, 'r') as f:
+            raw = json.load(f)
+    except (OSError, ValueError) as ex:
+        raise ConfigError('Unable to load {}: {}'.format(path, ex))
+    return BotConfig(raw)
+
+
+class ConfigWatcher:
+    """Reloads config.json via the JobQueue whenever the file changes
+
+    An invalid file is logged and ignored, the current config stays in
+    use until the file is fixed. A config that failed to be applied is
+    tried again on the next check.
+
+    Args:
+        path: config.json
+        on_change: Called with the new BotConfig
+        interval: Seconds between two checks of the file
+    """
+
+    def __init__(self, path, on_change, interval=5):
+        self.logger = logging.getLogger('config')
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._signature = self._stat()
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def start(self, job_queue):
+        job_queue.run_repeating(self.check, self.interval, name='config_reload')
+
+    def check(self, context=None):
+        signature = self._stat()
+        if signature is None or signature == self._signature:
+            return
+        try:
+            new_config = load_config(self.path)
+        except ConfigError as ex:
+            # Not retried until the file changes again
+            self._signature = signature
+            self.logger.error('Keeping the current config: %s', ex)
+            return
+        try:
+            self.on_change(new_config)
+        except Exception:
+            # Retried on the next check
+            self.logger.exception('Unable to apply %s', self.path)
+            return
+        self._signature = signature
+        self.logger.info('Reloaded %s', self.path)
@@ -0,0 +1,152 @@
+"""
+Chart rendering with a cache of rendered images
+
+Backends:
+    png: Pure Python PNG, rendered in the calling thread in milliseconds
+    matplotlib: Higher fidelity charts, rendered in a worker process
+    sparkline: No image, a Unicode sparkline is sent along the text
+"""
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+import png_chart
+
+# Cache misses only, cached charts cost a dict lookup
+_RENDER_SECONDS = metrics.STAGE_SECONDS.labels('chart')
+
+BACKENDS = ('png', 'matplotlib', 'sparkline')
+SPARK_CHARS = '▁▂▃▄▅▆▇█'
+
+
+def sparkline(values):
+    """Unicode block characters tracing values, scaled to their maximum"""
+    peak = max(values) if values else 0
+    if not peak:
+        return SPARK_CHARS[0] * len(values)
+    return ''.join(SPARK_CHARS[min(len(SPARK_CHARS) - 1, int(value / peak * len(SPARK_CHARS)))]
+                   for value in values)
+
+
+def render_bar_chart(title, labels, heights):
+    """Render a bar chart to PNG bytes with matplotlib
+
+    Runs inside the worker process. Only the object-oriented Figure API is
+    used, so no global pyplot state is shared between charts.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    figure = Figure()
+    FigureCanvasAgg(figure)
+    axes = figure.subplots()
+    positions = range(len(heights))
+    axes.bar(positions, height=heights)
+    axes.set_xticks(positions)
+    axes.set_xticklabels(labels, rotation=90)
+    axes.set_title(title)
+
+    with io.BytesIO() as png:
+        figure.savefig(png, format='png')
+        return png.getvalue()
+
+
+class ChartRenderer:
+    """Renders charts off the dispatcher threads and caches the results
+
+    Rendered charts are cached per (phone number, hash of the chart data).
+    Once Telegram has stored an uploaded chart, its file_id is remembered
+    and handed out instead of the PNG so the image is not uploaded again.
+
+    Args:
+        max_workers: Number of rendering processes (matplotlib backend)
+        cache_size: Number of charts kept
+        render_timeout: Seconds to wait for a chart to be rendered
+        backend: One of BACKENDS
+
+    Raises:
+        ValueError: Unknown backend
+    """
+
+    def __init__(self, max_workers=1, cache_size=32, render_timeout=30, backend='png'):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown chart backend: {}'.format(backend))
+        self.logger = logging.getLogger('charts')
+        self.backend = backend
+        self.max_workers = max_workers
+        self.cache_size = cache_size
+        self.render_timeout = render_timeout
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                # spawn rather than fork, forking a process running the
+                # dispatcher threads can copy locks in a held state
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+            return self._executor
+
+    @property
+    def draws_images(self):
+        return self.backend != 'sparkline'
+
+    def get_bar_chart(self, phone_number, title, labels, heights):
+        """Return a bar chart ready to be passed to reply_photo
+
+        Only for backends that draw_images.
+
+        Returns:
+            (photo, chart_key) where photo is either a Telegram file_id or
+            a file-like PNG, and chart_key identifies the chart for
+            remember_file_id
+        """
+        digest = hashlib.sha1(json.dumps([title, labels, heights]).encode('utf-8')).hexdigest()
+        chart_key = (str(phone_number), digest)
+
+        with self._lock:
+            entry = self._cache.get(chart_key)
+            if entry is not None:
+                self._cache.move_to_end(chart_key)
+                return (entry['file_id'] or io.BytesIO(entry['png'])), chart_key
+
+        with _RENDER_SECONDS.time():
+            if self.backend == 'matplotlib':
+                png = self._get_executor().submit(render_bar_chart, title, labels, heights) \
+                    .result(timeout=self.render_timeout)
+            else:
+                png = png_chart.render_bar_chart(title, labels, heights)
+
+        with self._lock:
+            self._cache[chart_key] = {'png': png, 'file_id': None}
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return io.BytesIO(png), chart_key
+
+    def remember_file_id(self, chart_key, file_id):
+        """Reuse Telegram's copy of an uploaded chart from now on"""
+        with self._lock:
+            entry = self._cache.get(chart_key)
+            if entry is not None:
+                entry['file_id'] = file_id
+                # Telegram holds the image now, the bytes are not needed anymore
+                entry['png'] = None
+
+    def prewarm(self):
+        """Start the worker process and import matplotlib in it"""
+        if self.backend == 'matplotlib':
+            self._get_executor().submit(render_bar_chart, '', [], [])
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False)
+                self._executor = None
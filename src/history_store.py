@@ -0,0 +1,97 @@
+"""
+Local SQLite store of daily usage, kept across billing cycles
+"""
+import logging
+import os
+import sqlite3
+import threading
+from datetime import date
+
+from usage_parser import DailyUsage, parse_usage_detail
+
+
+class UsageHistoryStore:
+    """Accumulates the dailyUsage of every fetched usageDetail
+
+    StarHub only returns the current billing cycle, so each fetched
+    usageDetail is ingested here to build up long-term history. Rows are
+    unique per (phone_number, usage_date) and are only rewritten when the
+    reported usage changed. Payloads whose lastProcessedDateTime was
+    already ingested are skipped entirely. Both the 'usage' and the
+    totalVolumeUsage figures are kept, as in DailyUsage.
+
+    Args:
+        path: SQLite database file
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger('history_store')
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._last_ingested = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('''
+                CREATE TABLE IF NOT EXISTS daily_usage (
+                    phone_number TEXT NOT NULL,
+                    usage_date TEXT NOT NULL,
+                    usage_mb REAL NOT NULL,
+                    volume_mb REAL,
+                    PRIMARY KEY (phone_number, usage_date)
+                ) WITHOUT ROWID''')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(daily_usage)')]
+            if 'volume_mb' not in columns:
+                # Stores created before volume_mb, their rows read usage_mb instead
+                self._conn.execute('ALTER TABLE daily_usage ADD COLUMN volume_mb REAL')
+
+    def ingest(self, phone_number, usage_dict):
+        """Store the dailyUsage entries of usage_dict
+
+        Returns:
+            Number of rows inserted or updated
+        """
+        phone_number = str(phone_number)
+        record = parse_usage_detail(usage_dict)
+        processed = record.last_processed
+
+        with self._lock:
+            if self._last_ingested.get(phone_number) == processed:
+                return 0
+            rows = [(phone_number, usage.date.isoformat(), usage.usage_mb, usage.volume_mb)
+                    for usage in record.daily]
+            with self._conn:
+                before = self._conn.total_changes
+                self._conn.executemany('''
+                    INSERT INTO daily_usage (phone_number, usage_date, usage_mb, volume_mb)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (phone_number, usage_date)
+                    DO UPDATE SET usage_mb = excluded.usage_mb, volume_mb = excluded.volume_mb
+                    WHERE usage_mb != excluded.usage_mb OR volume_mb IS NOT excluded.volume_mb''', rows)
+                changed = self._conn.total_changes - before
+            self._last_ingested[phone_number] = processed
+        if changed:
+            self.logger.debug('Ingested %d daily usage rows for %s', changed, phone_number)
+        return changed
+
+    def query(self, phone_number, start_date, end_date):
+        """Daily usage of phone_number between start_date and end_date inclusive
+
+        Returns:
+            List of DailyUsage ordered by date
+        """
+        params = (str(phone_number), start_date.isoformat(), end_date.isoformat())
+        with self._lock:
+            rows = self._conn.execute('''
+                SELECT usage_date, usage_mb, COALESCE(volume_mb, usage_mb) FROM daily_usage
+                WHERE phone_number = ? AND usage_date BETWEEN ? AND ?
+                ORDER BY usage_date''', params).fetchall()
+        return [DailyUsage(date.fromisoformat(usage_date), usage_mb, volume_mb)
+                for usage_date, usage_mb, volume_mb in rows]
+
+    def close(self):
+        """Close the database, checkpointing its write-ahead log"""
+        with self._lock:
+            self._conn.close()
@@ -1,19 +1,37 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
-import json
+# Imported first so the time taken by the imports below is measured
+from startup import startup_timer
+
 import logging
 import textwrap
-import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 
-import arrow
-from dateutil import rrule
 from requests import RequestException
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, Filters, CallbackQueryHandler
-from matplotlib import pyplot as plt
-
-from starhub_api import StarHubApi
+from telegram import Bot, InputMediaPhoto, Update, InlineQueryResultArticle, InputTextMessageContent
+from telegram.error import BadRequest
+from telegram.ext import Updater, CommandHandler, MessageFilter, CallbackQueryHandler, TypeHandler, \
+    DispatcherHandlerStop, InlineQueryHandler
+from telegram.utils.request import Request
+
+import metrics
+
+import alerts
+from accounts import AccountRegistry
+import billing_calendar
+from bot_config import ConfigWatcher, load_config
+from charts import ChartRenderer, sparkline
+from history_store import UsageHistoryStore
+from prefetch import UsagePrefetcher
+from rate_limit import RateLimiter
 from starhub_api import StarHubApiException
+from state_backend import create_backend
+from usage_parser import parse_usage_detail, sg_today
+
+startup_timer.stop_import_profiling()
+startup_timer.mark('imports')
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s:%(lineno)d - %(levelname)s - %(message)s',
@@ -21,22 +39,191 @@ logging.basicConfig(
 )
 logger = logging.getLogger('starhub_bot')
 
-# Loading of config.json
-with open('config/config.json', 'r') as f:
-    config = json.load(f)
+_FORMAT_SECONDS = metrics.STAGE_SECONDS.labels('format')
+
+# Longest photo caption and text message Telegram accepts
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+
+# Set up by init(), so importing this module (e.g. from the chart worker
+# processes) neither reads config.json nor opens any resource
+config = None
+accounts = None
+chart_renderer = None
+history_store = None
+prefetcher = None
+alert_engine = None
+rate_limiter = None
+config_watcher = None
+
+# Phone numbers an inline query scheduled a background fetch for
+_inline_refreshing = set()
+_inline_refreshing_lock = threading.Lock()
+
+
+def init(config_path='config/config.json'):
+    """Load config.json and create the objects shared by the handlers"""
+    global config, accounts, chart_renderer, history_store, prefetcher, alert_engine, rate_limiter, \
+        config_watcher
+
+    # Loading of config.json, compiled for the handlers
+    config = load_config(config_path)
+
+    # Tokens, usage and rate limits, shared with the other replicas if any
+    state = create_backend(config.get('state_backend', 'memory'))
+
+    # One StarHubApi per StarHub account described in config.json
+    accounts = AccountRegistry(config.accounts,
+                               shards=config.get('account_shards', 0),
+                               state=state)
+
+    # Charts are rendered in a separate process and cached
+    chart_renderer = ChartRenderer(max_workers=config.get('chart_workers', 1),
+                                   cache_size=config.get('chart_cache_size', 32),
+                                   backend=config.get('chart_backend', 'png'))
+
+    # Long-term daily usage history, fed by every usage fetch
+    history_store = None
+    if config.get('history_db_path', 'data/history.sqlite3'):
+        history_store = UsageHistoryStore(config.get('history_db_path', 'data/history.sqlite3'))
+        accounts.add_usage_listener(history_store.ingest)
+
+    # Keeps the usage cache warm in the background, started in main()
+    prefetcher = None
+    if config.get('prefetch_enabled', True):
+        prefetcher = UsagePrefetcher(accounts, accounts.phone_numbers,
+                                     min_interval=config.get('prefetch_min_interval', 300),
+                                     max_interval=config.get('prefetch_max_interval', 3600),
+                                     batch_timeout=config.get('batch_timeout', 30))
+
+    # Usage alerts, evaluated whenever usage is fetched
+    alert_engine = alerts.AlertEngine(config.get('alerts_path', 'data/alerts.json'),
+                                      exclude_holidays=config.get('exclude_public_holidays', False))
+    accounts.add_usage_listener(alert_engine.on_usage)
+
+    # Applied to every update by throttle_handler
+    rate_limiter = RateLimiter(user_rate=config.get('rate_limit_user_per_minute', 10),
+                               user_burst=config.get('rate_limit_user_burst', 5),
+                               number_rate=config.get('rate_limit_number_per_minute', 6),
+                               number_burst=config.get('rate_limit_number_burst', 3),
+                               duplicate_window=config.get('duplicate_callback_window', 3),
+                               state=state)
+
+    # Applies changes to config.json without a restart, started in main()
+    config_watcher = None
+    if config.get('config_reload_interval', 5):
+        config_watcher = ConfigWatcher(config_path, apply_config,
+                                       interval=config.get('config_reload_interval', 5))
+
+
+def apply_config(new_config):
+    """Switch the handlers over to new_config
+
+    Accounts and phone numbers are updated first, so the keyboards of the
+    new config never list a number the accounts cannot serve yet.
+    """
+    global config
+
+    accounts.reload(new_config.accounts)
+    if prefetcher:
+        prefetcher.phone_numbers = accounts.phone_numbers
+    restart_keys = config.restart_required(new_config)
+    if restart_keys:
+        logger.warning('Restart required to apply %s', ', '.join(restart_keys))
+    config = new_config.with_restart_keys_of(config)
+
+
+def prewarm():
+    """Load what the first requests would otherwise wait for
+
+    Runs in the background once the bot is already accepting updates.
+    """
+    chart_renderer.prewarm()
+    import analytics  # noqa: F401
+
+
+# Stopping an update is how a request is throttled, not an error
+@metrics.track_handler('throttle', ignore=DispatcherHandlerStop)
+def throttle_handler(update, context):
+    """Rate limits commands and callback queries before any other handler
+
+    Duplicate callback queries are dropped. Throttled requests are answered
+    from the last cached snapshot of the phone number, if there is one.
+    Updates from users outside the whitelist are left to the filters, so
+    they neither consume a phone number's tokens nor learn the bot is up.
+    """
+    user = update.effective_user
+    query = update.callback_query
+    if user is None or not is_whitelisted(user):
+        return
+    if query:
+        if rate_limiter.is_duplicate_callback(user.id, query.data):
+            query.answer()
+            raise DispatcherHandlerStop()
+        phone_number = query.data[2:]
+    elif update.message and update.message.text and update.message.text.startswith('/'):
+        args = update.message.text.split()
+        phone_number = args[1] if len(args) > 1 and args[1].isdigit() else None
+    else:
+        return
+
+    retry_after = rate_limiter.allow(user.id, phone_number)
+    if not retry_after:
+        return
+
+    text = 'Too many requests, please try again in {:.0f}s'.format(max(1, retry_after))
+    snapshot = None
+    if phone_number is not None:
+        snapshot = accounts.cached_usage(phone_number)
+    if query:
+        query.answer(text=text)
+        if snapshot is not None and query.data.startswith('u-'):
+            edit_message(query, format_usage_message(parse_usage_detail(snapshot)),
+                         get_inline_keyboard('u-'))
+    elif snapshot is not None:
+        update.message.reply_text(
+            text=format_usage_message(parse_usage_detail(snapshot)) + '\n\n_Cached data_',
+            parse_mode='Markdown')
+    else:
+        update.message.reply_text(text)
+    raise DispatcherHandlerStop()
+
+
+def is_whitelisted(user):
+    return config.is_whitelisted(user)
 
-# Initializing StarHubApi using config.json
-api = StarHubApi(user_id=config['user_id'],
-                 user_password=config['user_password'])
 
+class WhitelistFilter(MessageFilter):
+    """Filters.user counterpart following config reloads"""
 
+    def filter(self, message):
+        return message.from_user is not None and is_whitelisted(message.from_user)
+
+
+@metrics.track_handler('start')
 def start_handler(update, context):
+    # Overview of every line, fetched concurrently
+    usage_by_number, errors_by_number = accounts.get_phone_data_usage_batch(
+        accounts.phone_numbers, timeout=config.get('batch_timeout', 30),
+        max_age=snapshot_max_age(accounts.phone_numbers))
+    update.message.reply_text(
+        text=format_all_usage_message(usage_by_number, errors_by_number),
+        parse_mode='Markdown')
+
     text = ["*Here's a few commands that you can use:*"]
-    for number in config['phone_numbers']:
+    for number in accounts.phone_numbers:
         text.append("/usage {}".format(str(number)))
+    text.append("/usage all")
+    text.append("/forecast")
+    text.append("/alert")
+    text.append('')
+    text.append("Add *fresh* after the number to skip cached data")
+    if history_store:
+        text.append("/history <number> DD/MM/YYYY [DD/MM/YYYY] shows stored history")
     update.message.reply_text('\n'.join(text), parse_mode='Markdown')
 
 
+@metrics.track_handler('usage')
 def usage_handler(update, context):
     """Callback function for 'usage' command"""
     args = context.args
@@ -44,18 +231,23 @@ def usage_handler(update, context):
     if not args:
         callback_type = 'u-'
         send_inline_keyboard(callback_type, update.message)
+    elif args[0].lower() == 'all':
+        # Send every line's data usage
+        usage_by_number, errors_by_number = fetch_all_lines()
+        update.message.reply_text(
+            text=format_all_usage_message(usage_by_number, errors_by_number),
+            parse_mode='Markdown')
     else:
-        if int(args[0]) not in config['phone_numbers']:
+        if not accounts.has_number(args[0]):
             update.message.reply_text('Phone number is not recognized')
         else:
             try:
                 # Send selected data usage
-                user_token = api.get_user_token()
-                u_token = api.get_utoken(user_token)
-                usage_dict = api.get_phone_data_usage(
-                    u_token, phone_number=int(args[0]))
+                usage_dict = accounts.get_phone_data_usage(
+                    phone_number=int(args[0]), fresh=is_fresh_requested(args),
+                    max_age=snapshot_max_age([args[0]]))
 
-                formatted_str = format_usage_message(usage_dict)
+                formatted_str = format_usage_message(parse_usage_detail(usage_dict))
 
                 # Send selected data usage
                 update.message.reply_text(
@@ -69,6 +261,7 @@ def usage_handler(update, context):
                 update.message.reply_text(text="Unexpected request exception")
 
 
+@metrics.track_handler('history')
 def history_handler(update, context):
     """Callback function for 'history' command"""
     args = context.args
@@ -77,23 +270,20 @@ def history_handler(update, context):
         callback_type = 'h-'
         send_inline_keyboard(callback_type, update.message)
     else:
-        if int(args[0]) not in config['phone_numbers']:
+        if not accounts.has_number(args[0]):
             update.message.reply_text('Phone number is not recognized')
+        elif history_store and len(args) > 1 and not is_fresh_requested(args):
+            send_stored_history(update, int(args[0]), args[1:])
         else:
             try:
                 # Send selected data usage history
-                user_token = api.get_user_token()
-                u_token = api.get_utoken(user_token)
-                usage_dict = api.get_phone_data_usage(
-                    u_token, phone_number=int(args[0]))
-
-                formatted_str = format_usage_history_message(usage_dict)
+                usage_dict = accounts.get_phone_data_usage(
+                    phone_number=int(args[0]), fresh=is_fresh_requested(args),
+                    max_age=snapshot_max_age([args[0]]))
+                record = parse_usage_detail(usage_dict)
 
-                # Send bar chart
-                generate_and_send_image_file(usage_dict, update)
-                # Send selected data usage
-                update.message.reply_text(
-                    text=formatted_str, parse_mode='Markdown')
+                # Send bar chart captioned with the selected data usage
+                send_usage_history(update.message, record.service_id, record.daily)
             except StarHubApiException as ex:
                 logger.error(ex)
                 update.message.reply_text(
@@ -103,167 +293,467 @@ def history_handler(update, context):
                 update.message.reply_text(text="Unexpected request exception")
 
 
+@metrics.track_handler('forecast')
+def forecast_handler(update, context):
+    """Callback function for 'forecast' command"""
+    args = context.args
+    if args and not accounts.has_number(args[0]):
+        update.message.reply_text('Phone number is not recognized')
+        return
+
+    numbers = [int(args[0])] if args else accounts.phone_numbers
+    usage_by_number, errors_by_number = accounts.get_phone_data_usage_batch(
+        numbers, timeout=config.get('batch_timeout', 30),
+        max_age=snapshot_max_age(numbers))
+
+    text = []
+    for number in numbers:
+        usage_dict = usage_by_number.get(str(number))
+        if usage_dict is None:
+            text.append('*Forecast for {}*\nUnable to retrieve data usage'.format(number))
+        else:
+            text.append(format_forecast_message(parse_usage_detail(usage_dict)))
+    update.message.reply_text(text='\n\n'.join(text), parse_mode='Markdown')
+
+
+ALERT_USAGE = textwrap.dedent("""
+    *Usage alerts*
+    /alert <number|all> quota <percent>
+    /alert <number|all> daily
+    /alert <number|all> off
+    """)
+
+
+@metrics.track_handler('alert')
+def alert_handler(update, context):
+    """Callback function for 'alert' command"""
+    chat_id = update.effective_chat.id
+    args = context.args
+    if not args:
+        rules = alert_engine.rules_for(chat_id)
+        text = [ALERT_USAGE]
+        for number, number_rules in sorted(rules.items()):
+            for kind, threshold in sorted(number_rules.items()):
+                text.append('{} {}{}'.format(number, kind, '' if threshold is None else ' {:g}%'.format(threshold)))
+        update.message.reply_text('\n'.join(text), parse_mode='Markdown')
+        return
+
+    if args[0].lower() == 'all':
+        numbers = accounts.phone_numbers
+    elif accounts.has_number(args[0]):
+        numbers = [int(args[0])]
+    else:
+        update.message.reply_text('Phone number is not recognized')
+        return
+
+    action = args[1].lower() if len(args) > 1 else ''
+    if action == 'off':
+        for number in numbers:
+            alert_engine.remove_rules(chat_id, number)
+        update.message.reply_text('Alerts removed')
+    elif action == alerts.QUOTA:
+        try:
+            threshold = float(args[2]) if len(args) > 2 else 80.
+        except ValueError:
+            threshold = None
+        if threshold is None or not 0 <= threshold <= 100:
+            update.message.reply_text(ALERT_USAGE, parse_mode='Markdown')
+            return
+        for number in numbers:
+            alert_engine.set_rule(chat_id, number, alerts.QUOTA, threshold)
+        update.message.reply_text('You will be alerted once {:g}% of the data is used'.format(threshold))
+    elif action == alerts.DAILY:
+        for number in numbers:
+            alert_engine.set_rule(chat_id, number, alerts.DAILY)
+        update.message.reply_text("You will be alerted when today's usage exceeds the daily limit")
+    else:
+        update.message.reply_text(ALERT_USAGE, parse_mode='Markdown')
+
+
+def send_stored_history(update, phone_number, date_args):
+    """Answer '/history <number> <from> [to]' from the local history store"""
+    try:
+        start_date = datetime.strptime(date_args[0], '%d/%m/%Y').date()
+        if len(date_args) > 1:
+            end_date = datetime.strptime(date_args[1], '%d/%m/%Y').date()
+        else:
+            end_date = sg_today()
+    except ValueError:
+        update.message.reply_text('Dates should be in the DD/MM/YYYY format')
+        return
+
+    daily_usage = history_store.query(phone_number, start_date, end_date)
+    if not daily_usage:
+        update.message.reply_text('No usage history stored for this period')
+        return
+
+    send_usage_history(update.message, phone_number, daily_usage)
+
+
+@metrics.track_handler('callback')
 def callback_handler(update, context):
-    """Callback function for CallbackQueryHandler"""
+    """Callback function for CallbackQueryHandler
+
+    The query is answered right away and the keyboard's message is edited
+    in place with the result, keeping the keyboard under it.
+    """
     query = update.callback_query
+    callback_type = query.data[:2]
+    reply_markup = get_inline_keyboard(callback_type)
 
-    # Show loading message
-    query.edit_message_text(
-        text='Please wait... ✋',
-        parse_mode='Markdown')
+    # Stops the loading animation on the button
+    query.answer()
 
-    try:
-        user_token = api.get_user_token()
-        u_token = api.get_utoken(user_token)
-        usage_dict = api.get_phone_data_usage(
-            u_token, phone_number=query.data[2:])
+    # The keyboard may predate a config change
+    if not accounts.has_number(query.data[2:]):
+        edit_message(query, 'Phone number is not recognized', reply_markup)
+        return
 
-        callback_type = query.data[:2]
+    try:
+        usage_dict = accounts.get_phone_data_usage(phone_number=query.data[2:],
+                                                   max_age=snapshot_max_age([query.data[2:]]))
+        record = parse_usage_detail(usage_dict)
 
         if callback_type == 'u-':
-            formatted_str = format_usage_message(usage_dict)
+            edit_message(query, format_usage_message(record), reply_markup)
         else:
-            # Send bar chart
-            generate_and_send_image_file(usage_dict, query)
-            # Send selected data usage
-            formatted_str = format_usage_history_message(usage_dict)
-
-        # Send selected data usage
-        query.message.reply_text(text=formatted_str, parse_mode='Markdown')
+            edit_usage_history(query, record.service_id, record.daily, reply_markup)
     except StarHubApiException as ex:
         logger.error(ex)
-        query.message.reply_text(
-            text=str(ex.user_message), parse_mode='Markdown')
+        edit_message(query, str(ex.user_message), reply_markup)
     except RequestException as ex:
         logger.error(ex)
-        update.message.reply_text(text="Unexpected request exception")
+        edit_message(query, 'Unexpected request exception', reply_markup)
 
-    # Delete loading message
-    query.message.delete()
 
-    # Show inline keyboard again
-    callback_type = query.data[:2]
-    send_inline_keyboard(callback_type, query.message)
+@metrics.track_handler('inline')
+def inline_query_handler(update, context):
+    """Answers '@bot <number prefix>' with the usage of the matching lines
+
+    Inline queries are sent on every keystroke, so results only come from
+    the usage cache, whatever its age, and Telegram is allowed to cache
+    them too. Lines without cached usage are fetched in the background
+    for the next query.
+    """
+    query = update.inline_query
+    cache_time = config.get('inline_cache_time', 60)
+    if not is_whitelisted(query.from_user):
+        query.answer([], cache_time=cache_time, is_personal=True)
+        return
+
+    prefix = query.query.strip()
+    results = []
+    missing_numbers = []
+    for phone_number in accounts.phone_numbers:
+        if not str(phone_number).startswith(prefix):
+            continue
+        usage_dict = accounts.cached_usage(phone_number)
+        if usage_dict is None:
+            missing_numbers.append(phone_number)
+            continue
+        record = parse_usage_detail(usage_dict)
+        results.append(InlineQueryResultArticle(
+            id=str(phone_number),
+            title='Data Usage for {}'.format(phone_number),
+            description='Used {r.total_usage} {r.total_usage_uom} of {r.total_free_units} '
+                        '{r.total_free_units_uom} ({r.usage_percentage}%)'.format(r=record),
+            input_message_content=InputTextMessageContent(format_usage_message(record),
+                                                          parse_mode='Markdown')))
+
+    if missing_numbers:
+        refresh_in_background(context.job_queue, missing_numbers)
+    if results:
+        query.answer(results, cache_time=cache_time, is_personal=True)
+    else:
+        # Not cached by Telegram, the usage may be cached by the next query
+        query.answer([], cache_time=0, is_personal=True,
+                     switch_pm_text='No usage cached yet, ask the bot', switch_pm_parameter='usage')
 
 
-def error_handler(update, context):
-    """Log Errors caused by Updates."""
-    logger.error('Telegram error handler: "%s"', context.error)
+def refresh_in_background(job_queue, phone_numbers):
+    """Fetch the usage of phone_numbers from the job queue's thread
+
+    Numbers already being fetched for an earlier inline query are skipped.
+    """
+    with _inline_refreshing_lock:
+        phone_numbers = [number for number in phone_numbers if number not in _inline_refreshing]
+        _inline_refreshing.update(phone_numbers)
+    if not phone_numbers:
+        return
 
+    def refresh(context):
+        try:
+            accounts.get_phone_data_usage_batch(phone_numbers, timeout=config.get('batch_timeout', 30),
+                                                max_age=snapshot_max_age(phone_numbers))
+        finally:
+            with _inline_refreshing_lock:
+                _inline_refreshing.difference_update(phone_numbers)
 
-def format_usage_message(usage_dict):
-    daily_usage = usage_dict['dailyUsage']['day']
-    usage_dict['C-todayUsage'] = daily_usage[-1]['usage']
+    job_queue.run_once(refresh, 0, name='inline_refresh')
 
-    # Parsing last processed date time
-    usage_dict['C-lastProcessedDateTime'] = datetime_json_to_arrow(usage_dict['lastProcessedDateTime']).format(
-        'DD/MM/YYYY HH:mm:ss A')
 
-    # Convert data units from GB/KB to MB (with 'N-' prefix)
-    usage_dict = normalize_data_uom(usage_dict)
+@metrics.track_handler('startup')
+def startup_handler(update, context):
+    """Callback function for 'startup' command"""
+    update.message.reply_text(
+        text='```\n{}\n```'.format(startup_timer.summary()), parse_mode='Markdown')
 
-    # Adding analysis
-    billing_start_date = datetime_json_to_arrow(usage_dict['fromDateTime'])
-    billing_end_date = billing_start_date.shift(months=1)
-    current_date = arrow.utcnow().to('Asia/Singapore')
 
-    # Half closed interval [a,b)
-    total_weekdays = num_weekdays(
-        billing_start_date, billing_end_date.shift(days=-1))
+def error_handler(update, context):
+    """Log Errors caused by Updates."""
+    logger.error('Telegram error handler: "%s"', context.error)
 
-    # Elapsed weekdays, Half closed interval [a,b)
-    elapsed_weekdays = num_weekdays(
-        billing_start_date, current_date.shift(days=-1))
 
-    weekdays_left = total_weekdays - elapsed_weekdays
+@_FORMAT_SECONDS.timed
+def format_usage_message(record):
+    # Adding analysis, the cycle's calendar is computed once per fromDateTime
+    cycle = billing_calendar.billing_cycle(record.from_datetime.date(),
+                                           config.get('exclude_public_holidays', False))
+    current_date = sg_today()
 
-    # Get avg data per day (MB)
-    # (total data left + data used today) / num of weekdays (inclusive of today)
-    # only add the data used today if today is a weekday (weekday() not 5 or 6)
-    if current_date.datetime.weekday() == 5 or current_date.datetime.weekday() == 6:
-        avg_data_mb = float(
-            (usage_dict['N-usageDifference'])) / (weekdays_left if (weekdays_left > 0) else 1)
-    else:
-        avg_data_mb = (float(usage_dict['N-usageDifference']) + float(usage_dict['C-todayUsage'])) / (
-            weekdays_left if (weekdays_left > 0) else 1)
+    weekdays_left = cycle.working_days_left(current_date)
 
-    usage_dict['C-avgData'] = avg_data_mb
-    usage_dict['C-avgDataUOM'] = 'MB'
-    usage_dict['C-weekdayLeft'] = weekdays_left
+    # Get avg data per day (MB)
+    avg_data_mb = cycle.daily_limit_mb(record.usage_difference_mb, record.today_usage_mb, current_date)
 
-    usage_dict['C-progressBar'] = generate_progress_bar(float(usage_dict['N-totalUsage']),
-                                                        float(
-                                                            usage_dict['N-totalFreeUnits']),
-                                                        suffix=str(
-                                                            usage_dict['usagePercentage']) + '%',
-                                                        length=20)
+    progress_bar = generate_progress_bar(record.total_usage_mb,
+                                         record.total_free_mb,
+                                         suffix=str(record.usage_percentage) + '%',
+                                         length=20)
 
     # Markdown formatting for Telegram message formatting
     telegram_format_message = textwrap.dedent("""
-        *Data Usage for {usageServiceId}*
+        *Data Usage for {r.service_id}*
 
-        *{C-progressBar}*
-        Total: *{totalFreeUnits} {totalFreeUnitsUOM}*
-        Used: *{totalUsage} {totalUsageUOM}*
-        Left: *{usageDifference} {differenceUOM}*
-        Used Today: *{C-todayUsage} MB*
+        *{progress_bar}*
+        Total: *{r.total_free_units} {r.total_free_units_uom}*
+        Used: *{r.total_usage} {r.total_usage_uom}*
+        Left: *{r.usage_difference} {r.difference_uom}*
+        Used Today: *{r.today_usage_mb} MB*
         
-        *{C-weekdayLeft}* weekdays left (including today)
+        *{weekdays_left}* weekdays left (including today)
         
         Estimated limit per day:
-        *{C-avgData:.2f} {C-avgDataUOM}*/day
+        *{avg_data_mb:.2f} MB*/day
         
-        {C-lastProcessedDateTime}
-        """.format(**usage_dict))
+        {last_processed}
+        """.format(r=record,
+                   progress_bar=progress_bar,
+                   weekdays_left=weekdays_left,
+                   avg_data_mb=avg_data_mb,
+                   last_processed=record.last_processed.strftime('%d/%m/%Y %H:%M:%S %p')))
 
     return telegram_format_message
 
 
-def format_usage_history_message(usage_dict):
-    daily_usage = usage_dict['dailyUsage']['day']
+@_FORMAT_SECONDS.timed
+def format_forecast_message(record):
+    # numpy is only loaded once a forecast is requested (or pre-warmed)
+    import analytics
 
-    text = ['*Usage History (Day)*', '']
+    today = sg_today()
+    cycle = billing_calendar.billing_cycle(record.from_datetime.date(),
+                                           config.get('exclude_public_holidays', False))
+
+    # Previous cycles from the history store sharpen the daily averages
+    daily_usage = record.daily
+    if history_store:
+        history_start = today - timedelta(days=config.get('forecast_history_days', 56))
+        daily_usage = history_store.query(record.service_id, history_start,
+                                          cycle.start - timedelta(days=1)) + daily_usage
+
+    forecast = analytics.forecast_cycle(daily_usage,
+                                        used_mb=record.total_usage_mb,
+                                        quota_mb=record.total_free_mb,
+                                        today=today,
+                                        cycle_end=cycle.end)
+
+    if forecast.exhausted_on is None:
+        quota_text = 'Data should last until the end of the cycle'
+    else:
+        quota_text = 'Data runs out around *{}*'.format(forecast.exhausted_on.strftime('%a %d/%m/%Y'))
+
+    return textwrap.dedent("""
+        *Forecast for {service_id}*
 
-    for usage in daily_usage:
-        date = datetime_json_to_arrow(usage['usageDate'])
-        text.append(
-            '{} - {} MB'.format(date.format('ddd DD/MM/YYYY'), str(usage['usage'])))
+        {window}-day average: *{f.rolling_avg_mb:.2f} MB*/day
+        Weekday average: *{f.weekday_avg_mb:.2f} MB*/day
+        Weekend average: *{f.weekend_avg_mb:.2f} MB*/day
+
+        Projected total: *{total:.2f} GB* of *{quota:.2f} GB*
+        95% range: {low:.2f} - {high:.2f} GB
+        {quota_text}
+        """.format(service_id=record.service_id,
+                   window=analytics.ROLLING_WINDOW,
+                   f=forecast,
+                   total=forecast.projected_total_mb / 1024,
+                   quota=forecast.quota_mb / 1024,
+                   low=forecast.projected_low_mb / 1024,
+                   high=forecast.projected_high_mb / 1024,
+                   quota_text=quota_text)).strip()
+
+
+def fetch_all_lines():
+    """Usage of every configured line
+
+    The all-usage endpoint is tried first, numbers it did not return (or
+    every number, if it failed) are fetched concurrently one by one.
+    """
+    try:
+        usage_by_number = dict(accounts.get_all_usage())
+    except (StarHubApiException, RequestException) as ex:
+        logger.warning('All usage request failed, fetching numbers one by one: %s', ex)
+        usage_by_number = {}
+
+    missing_numbers = [number for number in accounts.phone_numbers
+                       if str(number) not in usage_by_number]
+    fetched, errors_by_number = accounts.get_phone_data_usage_batch(
+        missing_numbers, timeout=config.get('batch_timeout', 30),
+        max_age=snapshot_max_age(missing_numbers))
+    usage_by_number.update(fetched)
+    return usage_by_number, errors_by_number
+
+
+@_FORMAT_SECONDS.timed
+def format_all_usage_message(usage_by_number, errors_by_number=None):
+    errors_by_number = errors_by_number or {}
+    text = ['*Data Usage for all lines*']
+
+    for number in accounts.phone_numbers:
+        usage_dict = usage_by_number.get(str(number))
+        text.append('')
+        text.append('*{}*'.format(number))
+        if usage_dict is None:
+            if str(number) in errors_by_number:
+                text.append('Unable to retrieve data usage')
+            else:
+                text.append('No data usage found')
+            continue
+
+        try:
+            record = parse_usage_detail(usage_dict)
+        except (KeyError, TypeError, ValueError) as ex:
+            # The all-usage payload may lack fields, one line must not break the summary
+            logger.warning('Unable to parse the usage of %s: %r', number, ex)
+            text.append('Unable to retrieve data usage')
+            continue
+        text.append('*{}*'.format(generate_progress_bar(record.total_usage_mb,
+                                                        record.total_free_mb,
+                                                        suffix=str(record.usage_percentage) + '%',
+                                                        length=20)))
+        text.append('Used: *{r.total_usage} {r.total_usage_uom}* of *{r.total_free_units} {r.total_free_units_uom}*'
+                    .format(r=record))
     return '\n'.join(text)
 
 
-def generate_and_send_image_file(usage_dict, update):
-    daily_usage = usage_dict['dailyUsage']['day']
-    bar_heights = []
-    bar_labels = []
-    for usage in daily_usage:
-        date = datetime_json_to_arrow(usage['usageDate'])
-        if usage['totalVolumeUsageUOM'] == 'KB':
-            # Convert KB to MB
-            bar_heights.append(kb_to_mb(usage['totalVolumeUsage']))
-        elif usage['totalVolumeUsageUOM'] == 'GB':
-            # Convert GB to MB
-            bar_heights.append(gb_to_mb(usage['totalVolumeUsage']))
+@_FORMAT_SECONDS.timed
+def format_usage_history_message(daily_usage, max_length=None, with_sparkline=False):
+    """Daily usage listing, the oldest days are left out past max_length"""
+    text = ['*Usage History (Day)*', '']
+    if with_sparkline:
+        text.insert(1, sparkline([usage.volume_mb for usage in daily_usage]))
+    lines = ['{} - {} MB'.format(usage.date.strftime('%a %d/%m/%Y'), usage.usage_mb)
+             for usage in daily_usage]
+
+    if max_length is not None:
+        # Room for the header and the note about the omitted days
+        budget = max_length - len('\n'.join(text)) - 40
+        kept = []
+        for line in reversed(lines):
+            budget -= len(line) + 1
+            if budget < 0:
+                break
+            kept.append(line)
+        if len(kept) < len(lines):
+            text.append('_{} earlier days are in the {}_'.format(
+                len(lines) - len(kept), 'sparkline' if with_sparkline else 'chart'))
+        lines = kept[::-1]
+    return '\n'.join(text + lines)
+
+
+def get_usage_chart(phone_number, daily_usage):
+    """(photo, chart_key) of the usage history bar chart"""
+    bar_heights = [usage.volume_mb for usage in daily_usage]
+    bar_labels = [usage.date.strftime('%d/%m') for usage in daily_usage]
+
+    return chart_renderer.get_bar_chart(
+        phone_number,
+        'Data Usage History {}'.format(phone_number),
+        bar_labels, bar_heights)
+
+
+def remember_chart(chart_key, message):
+    # Send Telegram's copy next time the same chart is requested
+    if message and getattr(message, 'photo', None):
+        chart_renderer.remember_file_id(chart_key, message.photo[-1].file_id)
+
+
+def send_usage_history(message, phone_number, daily_usage):
+    """Reply with the usage history chart captioned with the daily usage"""
+    if not chart_renderer.draws_images:
+        message.reply_text(text=format_usage_history_message(daily_usage, MESSAGE_LIMIT, with_sparkline=True),
+                           parse_mode='Markdown')
+        return
+    photo, chart_key = get_usage_chart(phone_number, daily_usage)
+    sent = message.reply_photo(photo=photo,
+                               caption=format_usage_history_message(daily_usage, CAPTION_LIMIT),
+                               parse_mode='Markdown')
+    remember_chart(chart_key, sent)
+
+
+def edit_usage_history(query, phone_number, daily_usage, reply_markup):
+    """Show the usage history chart in the callback query's message"""
+    if not chart_renderer.draws_images:
+        limit = CAPTION_LIMIT if query.message.photo else MESSAGE_LIMIT
+        edit_message(query, format_usage_history_message(daily_usage, limit, with_sparkline=True), reply_markup)
+        return
+    photo, chart_key = get_usage_chart(phone_number, daily_usage)
+    caption = format_usage_history_message(daily_usage, CAPTION_LIMIT)
+
+    if query.message.photo:
+        message = None
+        with ignore_not_modified():
+            message = query.edit_message_media(
+                media=InputMediaPhoto(photo, caption=caption, parse_mode='Markdown'),
+                reply_markup=reply_markup)
+    else:
+        # A text message cannot be turned into a photo, the photo replaces it
+        # and further taps edit the photo
+        message = query.message.reply_photo(photo=photo, caption=caption, parse_mode='Markdown',
+                                            reply_markup=reply_markup)
+        query.message.delete()
+    remember_chart(chart_key, message)
+
+
+def edit_message(query, text, reply_markup):
+    """Replace the text (or caption) of the callback query's message"""
+    with ignore_not_modified():
+        if query.message.photo:
+            query.edit_message_caption(caption=text, parse_mode='Markdown',
+                                       reply_markup=reply_markup)
         else:
-            bar_heights.append(usage['totalVolumeUsage'])
-        bar_labels.append(date.format('DD/MM'))
+            query.edit_message_text(text=text, parse_mode='Markdown',
+                                    reply_markup=reply_markup)
+
+
+@contextmanager
+def ignore_not_modified():
+    """Swallows the BadRequest Telegram raises for an edit changing nothing"""
+    try:
+        yield
+    except BadRequest as ex:
+        # Tapping the same number again yields the same message
+        if 'not modified' not in str(ex).lower():
+            raise
 
-    plt.bar(range(len(bar_heights)), height=bar_heights)
-    plt.xticks(range(len(bar_heights)), bar_labels, rotation=90)
-    plt.title('Data Usage History {}'.format(usage_dict['usageServiceId']))
 
-    with tempfile.TemporaryFile(suffix=".png") as tmpfile:
-        # File position is at the end of the file.
-        plt.savefig(tmpfile, format="png")
-        tmpfile.seek(0)  # Rewind the file. (0: the beginning of the file)
-        plt.clf()
-        update.message.reply_photo(photo=tmpfile)
+def get_inline_keyboard(callback_type):
+    """Keyboard listing every phone number, built once per config"""
+    return config.inline_keyboard(callback_type)
 
 
 def send_inline_keyboard(callback_type, message):
-    keyboard_btns = [[InlineKeyboardButton(str(number), callback_data=callback_type + str(number))] for number in
-                     config['phone_numbers']]
-    keyboard = keyboard_btns
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = get_inline_keyboard(callback_type)
 
     if callback_type == 'h-':
         message.reply_text(
@@ -273,51 +763,14 @@ def send_inline_keyboard(callback_type, message):
             text='[Current data usage] Please choose:', reply_markup=reply_markup)
 
 
-def datetime_json_to_arrow(date_json):
-    date_string = '{}/{}/{} {}:{}:{}'.format(
-        date_json['day'],
-        date_json['month'],
-        date_json['year'],
-        date_json['hour'],
-        date_json['minute'],
-        date_json['second'])
-    return arrow.get(date_string, 'D/M/YYYY h:m:s')
-
-
-# https://www.safaribooksonline.com/library/view/python-cookbook-2nd/0596007973/ch03s06.html
-def num_weekdays(start, end):
-    weekends = 5, 6  # saturdays and sundays/history
-    weekdays = [x for x in range(7) if x not in weekends]
-    days = rrule.rrule(rrule.DAILY, dtstart=start,
-                       until=end, byweekday=weekdays)
-    return days.count()
-
-
-def normalize_data_uom(usage_dict):
-    values_to_normalize = {
-        'usage': 'uom',
-        'freeUnits': 'freeUnitsUOM',
-        'totalUsage': 'totalUsageUOM',
-        'totalFreeUnits': 'totalFreeUnitsUOM',
-        'usageDifference': 'differenceUOM',
-        'dataShareUnits': 'dataShareUnitsUOM',
-        'usageDataShare': 'usageDataShareUOM',
-        'freeUsage': 'freeUsageUOM'
-    }
-
-    # Convert to MB
-    for value in values_to_normalize:
-        current_uom = usage_dict[values_to_normalize[value]]
-        if (current_uom is not None) and (current_uom == 'KB'):
-            # Convert KB to MB
-            usage_dict['N-' + value] = kb_to_mb(usage_dict[value])
-        elif (current_uom is not None) and (current_uom == 'GB'):
-            # Convert GB to MB
-            usage_dict['N-' + value] = gb_to_mb(usage_dict[value])
-        elif (current_uom is not None):
-            usage_dict['N-' + value] = usage_dict[value]
-
-    return usage_dict
+def snapshot_max_age(phone_numbers):
+    """While the prefetcher keeps phone_numbers fresh, its snapshot is served as is"""
+    return prefetcher.snapshot_max_age(phone_numbers) if prefetcher else None
+
+
+def is_fresh_requested(args):
+    """'/usage <number> fresh' bypasses the usage cache"""
+    return len(args) > 1 and args[1].lower() == 'fresh'
 
 
 # https://stackoverflow.com/questions/3173320/text-progress-bar-in-the-console
@@ -340,52 +793,122 @@ def generate_progress_bar(iteration, total, prefix='', suffix='', decimals=1, le
     # return '\r%s |%s| %s%% %s' % (prefix, bar, percent, suffix)
 
 
-def gb_to_mb(gb_data):
-    return 1024 * float(gb_data)
-
-
-def kb_to_mb(kb_data):
-    return (1. / 1024) * float(kb_data)
+class InstrumentedRequest(Request):
+    """Request recording the latency of every Bot API call"""
 
-
-def mb_to_gb(mb_data):
-    return float(mb_data) / 1024
+    def post(self, url, data, timeout=None):
+        with metrics.TELEGRAM_REQUEST_SECONDS.labels(url.rsplit('/', 1)[-1]).time():
+            return super().post(url, data, timeout=timeout)
 
 
 def main():
+    init()
+    startup_timer.mark('init')
+
     # Create the Updater and pass it your bot's token.
-    updater = Updater(config['telegram_token'], use_context=True)
+    # Sized for the dispatcher, job queue and webhook workers
+    request = InstrumentedRequest(con_pool_size=8 + config.get('webhook_workers', 4))
+    updater = Updater(bot=Bot(config['telegram_token'], request=request), use_context=True)
     dispatcher = updater.dispatcher
 
+    whitelisted = WhitelistFilter()
+    # Group -1 runs before the command handlers and can stop the update
+    dispatcher.add_handler(TypeHandler(Update, throttle_handler), group=-1)
     dispatcher.add_handler(
         CommandHandler('start', start_handler,
-                       filters=Filters.user(config['whitelisted_user_names'])))
+                       filters=whitelisted))
     dispatcher.add_handler(
         CommandHandler('usage', usage_handler,
                        pass_args=True,
-                       filters=Filters.user(config['whitelisted_user_names'])))
+                       filters=whitelisted))
     dispatcher.add_handler(
         CommandHandler('history', history_handler,
                        pass_args=True,
-                       filters=Filters.user(config['whitelisted_user_names'])))
+                       filters=whitelisted))
+    dispatcher.add_handler(
+        CommandHandler('forecast', forecast_handler,
+                       pass_args=True,
+                       filters=whitelisted))
+    dispatcher.add_handler(
+        CommandHandler('alert', alert_handler,
+                       pass_args=True,
+                       filters=whitelisted))
+    dispatcher.add_handler(
+        CommandHandler('startup', startup_handler,
+                       filters=whitelisted))
     dispatcher.add_handler(CallbackQueryHandler(callback_handler))
+    dispatcher.add_handler(InlineQueryHandler(inline_query_handler))
     dispatcher.add_error_handler(error_handler)
 
+    if prefetcher:
+        prefetcher.start(updater.job_queue)
+    if config_watcher:
+        config_watcher.start(updater.job_queue)
+    # Alerts raised since the previous run are sent together
+    updater.job_queue.run_repeating(alert_engine.flush_job,
+                                    interval=config.get('alert_flush_interval', 30),
+                                    name='alert_flush')
+    startup_timer.mark('dispatcher')
+
     # Start the Bot
     if config.get('webhook_url', None):
-        updater.start_webhook(listen="",
-                              port=80,
-                              url_path=config.get('telegram_token'))
-        updater.bot.set_webhook(config.get(
-            'webhook_url') + config.get('telegram_token'))
-        logger.info('Bot started using webhook')
+        run_webhook(updater)
     else:
         updater.start_polling()
         logger.info('Bot started using long polling')
-
-    # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT
-    updater.idle()
+        start_metrics_server()
+        startup_timer.mark('start')
+        logger.info(startup_timer.summary())
+
+        threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
+        # Run the bot until the user presses Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT
+        updater.idle()
+        shutdown(updater)
+        logger.info('Bot stopped')
+
+
+def shutdown(updater):
+    """Stop the job queue, then release the chart workers, the StarHub sessions and the history store"""
+    updater.job_queue.stop()
+    chart_renderer.shutdown()
+    accounts.shutdown()
+    if history_store:
+        history_store.close()
+
+
+def start_metrics_server():
+    """Serve /metrics on its own port, only if metrics_port is set"""
+    if config.get('metrics_port'):
+        metrics.start_http_server(config['metrics_port'], host=config.get('metrics_host', '127.0.0.1'))
+
+
+def run_webhook(updater):
+    """Serve updates through WebhookServer until SIGTERM/SIGINT"""
+    # aiohttp is only needed in webhook mode
+    from webhook_server import WebhookServer
+
+    server = WebhookServer(updater.dispatcher,
+                           url_path=config.get('telegram_token'),
+                           port=config.get('webhook_port', 80),
+                           workers=config.get('webhook_workers', 4),
+                           queue_size=config.get('webhook_queue_size', 100),
+                           drain_timeout=config.get('webhook_drain_timeout', 30))
+    # Updater.start_webhook is not used, so the job queue is started here
+    updater.job_queue.start()
+    updater.bot.set_webhook(config.get(
+        'webhook_url') + config.get('telegram_token'))
+    logger.info('Bot started using webhook')
+    start_metrics_server()
+    startup_timer.mark('start')
+    logger.info(startup_timer.summary())
+
+    threading.Thread(target=prewarm, name='prewarm', daemon=True).start()
+
+    server.run()
+    shutdown(updater)
+    logger.info('Webhook server stopped')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+"""
+Bar charts drawn straight to PNG, without matplotlib
+"""
+import struct
+import zlib
+
+# Palette indices
+WHITE, BAR, TEXT, AXIS = range(4)
+PALETTE = bytes((255, 255, 255,
+                 31, 119, 180,
+                 34, 34, 34,
+                 136, 136, 136))
+
+# 3x5 pixel glyphs, lower case is drawn as upper case
+FONT = {
+    '0': ('###', '#.#', '#.#', '#.#', '###'),
+    '1': ('.#.', '##.', '.#.', '.#.', '###'),
+    '2': ('###', '..#', '###', '#..', '###'),
+    '3': ('###', '..#', '.##', '..#', '###'),
+    '4': ('#.#', '#.#', '###', '..#', '..#'),
+    '5': ('###', '#..', '###', '..#', '###'),
+    '6': ('###', '#..', '###', '#.#', '###'),
+    '7': ('###', '..#', '..#', '.#.', '.#.'),
+    '8': ('###', '#.#', '###', '#.#', '###'),
+    '9': ('###', '#.#', '###', '..#', '###'),
+    'A': ('.#.', '#.#', '###', '#.#', '#.#'),
+    'B': ('##.', '#.#', '##.', '#.#', '##.'),
+    'C': ('.##', '#..', '#..', '#..', '.##'),
+    'D': ('##.', '#.#', '#.#', '#.#', '##.'),
+    'E': ('###', '#..', '##.', '#..', '###'),
+    'F': ('###', '#..', '##.', '#..', '#..'),
+    'G': ('.##', '#..', '#.#', '#.#', '.##'),
+    'H': ('#.#', '#.#', '###', '#.#', '#.#'),
+    'I': ('###', '.#.', '.#.', '.#.', '###'),
+    'J': ('..#', '..#', '..#', '#.#', '.#.'),
+    'K': ('#.#', '#.#', '##.', '#.#', '#.#'),
+    'L': ('#..', '#..', '#..', '#..', '###'),
+    'M': ('#.#', '###', '###', '#.#', '#.#'),
+    'N': ('##.', '#.#', '#.#', '#.#', '#.#'),
+    'O': ('.#.', '#.#', '#.#', '#.#', '.#.'),
+    'P': ('##.', '#.#', '##.', '#..', '#..'),
+    'Q': ('.#.', '#.#', '#.#', '##.', '.##'),
+    'R': ('##.', '#.#', '##.', '#.#', '#.#'),
+    'S': ('.##', '#..', '.#.', '..#', '##.'),
+    'T': ('###', '.#.', '.#.', '.#.', '.#.'),
+    'U': ('#.#', '#.#', '#.#', '#.#', '###'),
+    'V': ('#.#', '#.#', '#.#', '#.#', '.#.'),
+    'W': ('#.#', '#.#', '###', '###', '#.#'),
+    'X': ('#.#', '#.#', '.#.', '#.#', '#.#'),
+    'Y': ('#.#', '#.#', '.#.', '.#.', '.#.'),
+    'Z': ('###', '..#', '.#.', '#..', '###'),
+    '/': ('..#', '..#', '.#.', '#..', '#..'),
+    '.': ('...', '...', '...', '...', '.#.'),
+    '-': ('...', '...', '###', '...', '...'),
+    ':': ('...', '.#.', '...', '.#.', '...'),
+    '%': ('#.#', '..#', '.#.', '#..', '#.#'),
+}
+GLYPH_WIDTH, GLYPH_HEIGHT = 3, 5
+
+
+class _Canvas:
+    """Palette image as a list of rows, one byte per pixel"""
+
+    def __init__(self, width, height, background=WHITE):
+        self.width = width
+        self.height = height
+        self.rows = [bytearray([background]) * width for _ in range(height)]
+
+    def fill(self, x0, y0, x1, y1, color):
+        """Fill the rectangle [x0, x1) x [y0, y1), clipped to the canvas"""
+        x0, x1 = max(0, x0), min(self.width, x1)
+        if x1 <= x0:
+            return
+        span = bytes([color]) * (x1 - x0)
+        for y in range(max(0, y0), min(self.height, y1)):
+            self.rows[y][x0:x1] = span
+
+    def text(self, x, y, text, color=TEXT, scale=1, vertical=False):
+        """Draw text from (x, y), bottom to top when vertical"""
+        advance = (GLYPH_WIDTH + 1) * scale
+        length = text_width(text, scale)
+        for index, char in enumerate(text.upper()):
+            for gy, line in enumerate(FONT.get(char, ())):
+                for gx, pixel in enumerate(line):
+                    if pixel != '#':
+                        continue
+                    tx = index * advance + gx * scale
+                    ty = gy * scale
+                    if vertical:
+                        self.fill(x + ty, y + length - tx - scale, x + ty + scale, y + length - tx, color)
+                    else:
+                        self.fill(x + tx, y + ty, x + tx + scale, y + ty + scale, color)
+
+    def to_png(self):
+        raw = b''.join(b'\x00' + bytes(row) for row in self.rows)
+        return b''.join((
+            b'\x89PNG\r\n\x1a\n',
+            _chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 3, 0, 0, 0)),
+            _chunk(b'PLTE', PALETTE),
+            _chunk(b'IDAT', zlib.compress(raw, 9)),
+            _chunk(b'IEND', b''),
+        ))
+
+
+def _chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+
+def text_width(text, scale=1):
+    return max(0, len(text) * (GLYPH_WIDTH + 1) - 1) * scale
+
+
+def render_bar_chart(title, labels, heights, height=360, scale=2):
+    """Render a bar chart to PNG bytes
+
+    Bars are labelled vertically underneath, the y axis is marked at 0,
+    half and the highest value.
+    """
+    label_length = max([len(label) for label in labels] + [1])
+    top = GLYPH_HEIGHT * scale * 2 + 8
+    bottom = text_width('0' * label_length, scale) + 12
+    peak = max(heights) if heights else 0
+    ticks = [0, peak / 2., peak]
+    tick_labels = ['{:g}'.format(round(tick)) for tick in ticks]
+    left = max(text_width(label, scale) for label in tick_labels) + 12
+    slot = max(GLYPH_HEIGHT * scale + 4, 12)
+    width = max(left + slot * len(heights) + 12, text_width(title, scale) + 16, 160)
+
+    canvas = _Canvas(width, height)
+    canvas.text((width - text_width(title, scale)) // 2, 6, title, scale=scale)
+
+    plot_bottom = height - bottom
+    plot_height = plot_bottom - top
+    for tick, label in zip(ticks, tick_labels):
+        y = plot_bottom - (int(plot_height * tick / peak) if peak else 0)
+        canvas.fill(left - 4, y, left, y + 1, AXIS)
+        canvas.text(left - 6 - text_width(label, scale), y - GLYPH_HEIGHT * scale // 2, label, scale=scale)
+    canvas.fill(left, top, left + 1, plot_bottom + 1, AXIS)
+    canvas.fill(left, plot_bottom, width - 8, plot_bottom + 1, AXIS)
+
+    for index, (label, value) in enumerate(zip(labels, heights)):
+        x = left + 2 + index * slot
+        bar_height = int(round(plot_height * value / peak)) if peak else 0
+        canvas.fill(x + 1, plot_bottom - bar_height, x + slot - 1, plot_bottom, BAR)
+        canvas.text(x + (slot - GLYPH_HEIGHT * scale) // 2, plot_bottom + 6, label, scale=scale, vertical=True)
+    return canvas.to_png()
@@ -0,0 +1,121 @@
+"""
+Background refresh of usage data so commands are answered from a warm cache
+"""
+import logging
+import random
+import time
+from datetime import datetime, timedelta
+
+from usage_parser import SGT, parse_datetime
+
+
+class UsagePrefetcher:
+    """Periodically refreshes the usage of every phone number via the JobQueue
+
+    StarHub only reprocesses usage every so often. The gap between two
+    successive lastProcessedDateTime values is used as the update cadence
+    and the next refresh is scheduled shortly after the next update is
+    expected, clamped to [min_interval, max_interval] and jittered so
+    refreshes do not line up with other clients. Failed refreshes back off
+    exponentially up to max_interval.
+
+    Args:
+        api: StarHubApi whose usage cache is kept warm
+        phone_numbers: Phone numbers to refresh
+        min_interval: Minimum seconds between refreshes
+        max_interval: Maximum seconds between refreshes
+        jitter: Fraction of the delay randomly added or removed
+        grace: Seconds to wait after an expected StarHub update
+        batch_timeout: Seconds a refresh may take, numbers still pending
+            afterwards count as failed
+    """
+
+    def __init__(self, api, phone_numbers, min_interval=300, max_interval=3600, jitter=0.1, grace=120,
+                 batch_timeout=30):
+        self.logger = logging.getLogger('prefetch')
+        self.api = api
+        self.phone_numbers = phone_numbers
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.grace = grace
+        self.batch_timeout = batch_timeout
+        # {phone_number: monotonic time of its last successful refresh}
+        self._refreshed_at = {}
+        self._last_processed = {}
+        self._cadence = None
+        self._failures = 0
+
+    def snapshot_max_age(self, phone_numbers):
+        """Age up to which the usage of phone_numbers can be served instead of fetching
+
+        That is the age of their last successful refresh, which their
+        cached usage cannot be older than, as long as the refreshes are on
+        schedule.
+
+        Returns:
+            Seconds, or None (the usage cache's own ttl) if a number's last
+            refresh failed or is overdue
+        """
+        now = time.monotonic()
+        overdue = self.max_interval * (1 + self.jitter) + self.api.http_timeout * 2
+        ages = [now - self._refreshed_at.get(str(phone_number), float('-inf')) for phone_number in phone_numbers]
+        if not ages or max(ages) > overdue:
+            return None
+        return max(ages)
+
+    def start(self, job_queue, first=0):
+        job_queue.run_once(self._refresh, first, name='usage_prefetch')
+
+    def _refresh(self, context):
+        # Rescheduled whatever happens, a single bad refresh must not stop prefetching
+        try:
+            self._fetch()
+        except Exception:
+            self._failures += 1
+            self.logger.exception('Prefetch failed')
+        finally:
+            delay = self._next_delay()
+            self.logger.info('Next refresh in %ds', delay)
+            context.job_queue.run_once(self._refresh, delay, name='usage_prefetch')
+
+    def _fetch(self):
+        started = time.monotonic()
+        usage_by_number, errors_by_number = self.api.get_phone_data_usage_batch(
+            self.phone_numbers, fresh=True, timeout=self.batch_timeout)
+        for phone_number in usage_by_number:
+            self._refreshed_at[phone_number] = started
+        for phone_number in errors_by_number:
+            self._refreshed_at.pop(phone_number, None)
+
+        if usage_by_number:
+            self._failures = 0
+            self._observe(usage_by_number)
+        if errors_by_number:
+            self._failures += 1
+            self.logger.warning('Prefetch failed for %s', ', '.join(errors_by_number))
+        self.logger.info('Prefetched %d numbers', len(usage_by_number))
+
+    def _observe(self, usage_by_number):
+        """Learn StarHub's processing cadence from lastProcessedDateTime"""
+        for phone_number, usage_dict in usage_by_number.items():
+            if not usage_dict.get('lastProcessedDateTime'):
+                continue
+            processed = parse_datetime(usage_dict['lastProcessedDateTime']).replace(tzinfo=SGT)
+            previous = self._last_processed.get(phone_number)
+            if previous is not None and processed > previous:
+                self._cadence = (processed - previous).total_seconds()
+            self._last_processed[phone_number] = processed
+
+    def _next_delay(self):
+        if self._failures:
+            delay = min(self.min_interval * 2 ** (self._failures - 1), self.max_interval)
+        elif self._cadence and self._last_processed:
+            latest = max(self._last_processed.values())
+            expected = latest + timedelta(seconds=self._cadence + self.grace)
+            delay = (expected - datetime.now(SGT)).total_seconds()
+        else:
+            delay = self.min_interval
+
+        delay = min(max(delay, self.min_interval), self.max_interval)
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
@@ -0,0 +1,144 @@
+"""
+Token bucket rate limiting of users and phone numbers
+"""
+import threading
+import time
+
+
+class TokenBucket:
+    """Allows bursts of capacity requests, refilled at rate per second"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = now
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def consume(self, now):
+        """Take a token, False if the bucket is empty"""
+        self._refill(now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self, now):
+        """Seconds until a token is available"""
+        self._refill(now)
+        return max(0., (1 - self.tokens) / self.rate) if self.rate else float('inf')
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class RateLimiter:
+    """Per user and per phone number token buckets, plus callback dedupe
+
+    A request is allowed only if both the user's and (when it targets a
+    phone number) the number's bucket have a token, so a number's upstream
+    load stays bounded however many users ask for it.
+
+    Args:
+        user_rate: Requests per minute a user is refilled with
+        user_burst: Requests a user can make in a burst
+        number_rate: Requests per minute a phone number is refilled with
+        number_burst: Requests a phone number can get in a burst
+        duplicate_window: Seconds within which an identical callback query
+            from the same user is considered a duplicate
+        max_buckets: Buckets kept before full (idle) ones are dropped
+        state: state_backend backend. When it is shared by several replicas,
+            the limits are enforced across all of them with fixed one minute
+            windows of user_rate and number_rate requests instead of token
+            buckets (bursts are then only bounded by the per minute rate).
+    """
+
+    def __init__(self, user_rate=10, user_burst=5, number_rate=6, number_burst=3,
+                 duplicate_window=3, max_buckets=1024, state=None):
+        self.user_rate = user_rate / 60.
+        self.user_burst = user_burst
+        self.number_rate = number_rate / 60.
+        self.number_burst = number_burst
+        self.duplicate_window = duplicate_window
+        self.max_buckets = max_buckets
+        self.state = state if state is not None and state.shared else None
+        self._user_limit = user_rate
+        self._number_limit = number_rate
+        self._lock = threading.Lock()
+        self._user_buckets = {}
+        self._number_buckets = {}
+        self._callbacks = {}
+
+    @staticmethod
+    def _bucket(buckets, key, rate, capacity, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, capacity, now)
+        return bucket
+
+    def _prune(self, now):
+        for buckets in (self._user_buckets, self._number_buckets):
+            if len(buckets) > self.max_buckets:
+                for key in [key for key, bucket in buckets.items() if bucket.is_full(now)]:
+                    del buckets[key]
+        if len(self._callbacks) > self.max_buckets:
+            self._callbacks = {key: seen_at for key, seen_at in self._callbacks.items()
+                               if now - seen_at < self.duplicate_window}
+
+    def allow(self, user_id, phone_number=None):
+        """Consume a token for the request
+
+        Returns:
+            0 if the request is allowed, otherwise the seconds to wait
+        """
+        if self.state is not None:
+            return self._allow_shared(user_id, phone_number)
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            user_bucket = self._bucket(self._user_buckets, user_id,
+                                       self.user_rate, self.user_burst, now)
+            number_bucket = None
+            if phone_number is not None:
+                number_bucket = self._bucket(self._number_buckets, str(phone_number),
+                                             self.number_rate, self.number_burst, now)
+
+            if not user_bucket.consume(now):
+                return user_bucket.retry_after(now)
+            if number_bucket is not None and not number_bucket.consume(now):
+                # Give the user's token back, the request is not served
+                user_bucket.tokens += 1
+                return number_bucket.retry_after(now)
+            return 0
+
+    def _allow_shared(self, user_id, phone_number):
+        now = time.time()
+        window = int(now // 60)
+        retry_after = 60 - now % 60
+        user_key = 'rate:user:{}:{}'.format(user_id, window)
+        if self.state.incr(user_key, ttl=60) > self._user_limit:
+            return retry_after
+        if phone_number is not None and self.state.incr(
+                'rate:number:{}:{}'.format(phone_number, window), ttl=60) > self._number_limit:
+            # Give the user's request back, the request is not served
+            self.state.decr(user_key)
+            return retry_after
+        return 0
+
+    def is_duplicate_callback(self, user_id, data):
+        """True if user_id sent the same callback data within duplicate_window"""
+        if self.state is not None:
+            return not self.state.add('callback:{}:{}'.format(user_id, data), 1, ttl=self.duplicate_window)
+        now = time.monotonic()
+        key = (user_id, data)
+        with self._lock:
+            seen_at = self._callbacks.get(key)
+            if seen_at is not None and now - seen_at < self.duplicate_window:
+                return True
+            self._callbacks[key] = now
+            return False
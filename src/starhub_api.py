@@ -1,8 +1,22 @@
 """
 Based on StarHub's mobile application (iOS v5.1.15) as at 9 May 2020
 """
+import copyreg
+import json
 import logging
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
 import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+from usage_cache import UsageCache
 
 
 class StarHubApiException(Exception):
@@ -20,9 +34,138 @@ class StarHubApiException(Exception):
         self.http_code = http_code
         self.api_name = api_name
         self.response_body = response_body
-        self.user_message = user_message + 'HTTP Code: ' + self.http_code
+        self.user_message = user_message
+        if http_code is not None:
+            self.user_message = '{}. HTTP Code: {}'.format(user_message, http_code)
         super().__init__(self.user_message)
 
+    def __reduce__(self):
+        # self.args only holds the message, rebuild from __dict__ so the
+        # exception survives the trip back from a shard worker process
+        return copyreg.__newobj__, (type(self), self.user_message), self.__dict__
+
+
+class CircuitOpenError(StarHubApiException):
+    """Raised instead of calling StarHub while the circuit breaker is open"""
+
+    def __init__(self, api_name):
+        super().__init__(None, api_name, None,
+                         'StarHub is unavailable at the moment, please try again later')
+
+
+class RetryPolicy:
+    """Bounded retries with exponential backoff and full jitter
+
+    Args:
+        max_attempts: Attempts made per request, the first one included
+        base_delay: Upper bound of the delay before the first retry (s)
+        max_delay: Upper bound of any delay (s)
+    """
+
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=4):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        """Seconds to wait after the given (1-based) failed attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Stops calling StarHub after consecutive failures
+
+    After failure_threshold consecutive failures (network errors or 5xx
+    responses) the circuit opens and calls fail fast with CircuitOpenError.
+    Once reset_timeout seconds have passed, a single call is let through as
+    a trial: its success closes the circuit, its failure keeps it open for
+    another reset_timeout.
+
+    Args:
+        failure_threshold: Consecutive failures opening the circuit
+        reset_timeout: Seconds before a trial call is allowed
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def is_open(self):
+        with self._lock:
+            return self._opened_at is not None
+
+    def check(self, api_name):
+        """Raise CircuitOpenError unless a call may go through"""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            now = time.monotonic()
+            if now - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(api_name)
+            # Let this call through as the trial, the others keep failing fast
+            self._opened_at = now
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        """Returns True if this failure opened the circuit"""
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold and self._opened_at is None:
+                self._opened_at = time.monotonic()
+                return True
+            return False
+
+
+class SingleFlight:
+    """Coalesce concurrent calls sharing the same key into a single call
+
+    The first caller for a key performs the call while every other caller
+    arriving before it completes waits and receives the same result
+    (or exception).
+    """
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = self._Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
 
 class StarHubApi:
     """Represents StarHub API"""
@@ -33,45 +176,393 @@ class StarHubApi:
     user_agent_str = '870330a7f6fe26b489e0f353753504ad'
     x_sh_msa_version = '5.1.15'  # Corresponds to the StarHub's iOS app version
 
-    def __init__(self, user_id, user_password):
+    def __init__(self, user_id, user_password, utoken_ttl=1800, token_cache_path=None,
+                 usage_cache_ttl=300, usage_cache_size=64, http_timeout=10, http_pool_size=10,
+                 batch_concurrency=4, retry_max_attempts=3, retry_base_delay=0.5, retry_max_delay=4,
+                 circuit_failure_threshold=5, circuit_reset_timeout=60, state=None, utoken_lease_ttl=30):
+        """
+        Args:
+            user_id: StarHub ID (email) used for the MSSO login
+            user_password: Encrypted StarHub password
+            utoken_ttl: Seconds before a cached u_token is proactively refreshed
+            token_cache_path: Optional JSON file used to persist tokens across restarts
+            usage_cache_ttl: Seconds for which fetched usage data is served from cache
+            usage_cache_size: Maximum number of phone numbers kept in the usage cache
+            http_timeout: Seconds to wait for StarHub before giving up on a request
+            http_pool_size: Keep-alive connections kept open per StarHub host
+            batch_concurrency: Maximum parallel requests made by get_phone_data_usage_batch
+            retry_max_attempts: Attempts per request on 401, 5xx and network errors
+            retry_base_delay: Backoff before the first retry, doubled on every retry (s)
+            retry_max_delay: Longest backoff between two attempts (s)
+            circuit_failure_threshold: Consecutive failures after which StarHub is
+                no longer called until circuit_reset_timeout has passed
+            circuit_reset_timeout: Seconds the circuit breaker stays open
+            state: state_backend backend holding the tokens and the last fetched
+                usage. With a backend shared by several replicas, only the replica
+                holding the refresh lease logs in, the others adopt its u_token.
+            utoken_lease_ttl: Seconds a replica may hold the u_token refresh lease
+        """
         self.logger = logging.getLogger('starhub_api')
         self.user_id = user_id
         self.user_password = user_password
+        self.utoken_ttl = utoken_ttl
+        self.token_cache_path = token_cache_path
         self.user_token = None
         self.u_token = None
+        self.u_token_issued_at = None
+        self._token_lock = threading.RLock()
+        self._flight = SingleFlight()
+        self.usage_cache = UsageCache(ttl=usage_cache_ttl,
+                                      max_entries=usage_cache_size)
+        self.http_timeout = http_timeout
+        self.session = self._create_session(http_pool_size)
+        self.batch_concurrency = batch_concurrency
+        self._batch_executor = None
+        self._batch_executor_lock = threading.Lock()
+        self._usage_listeners = []
+        self.retry_policy = RetryPolicy(max_attempts=retry_max_attempts,
+                                        base_delay=retry_base_delay,
+                                        max_delay=retry_max_delay)
+        self.circuit_breaker = CircuitBreaker(failure_threshold=circuit_failure_threshold,
+                                              reset_timeout=circuit_reset_timeout)
+        self.state = state
+        self.utoken_lease_ttl = utoken_lease_ttl
+        self._tokens_key = 'tokens:' + user_id
+        self._lease_key = 'lease:utoken:' + user_id
+        self._replica_id = uuid.uuid4().hex
+        self._load_tokens()
 
-    def get_user_token(self):
-        """Retrieve user_token from MSSO login endpoint
+    def add_usage_listener(self, listener):
+        """Call listener(phone_number, usage_dict) whenever usage is fetched
 
-        user_token will be cached as it will not expire
-        This is tested on 8 December 2019
+        Listeners run on the fetching thread and must treat usage_dict as
+        read-only. Exceptions raised by a listener are logged and ignored.
+        """
+        self._usage_listeners.append(listener)
+
+    @property
+    def _state_shared(self):
+        return self.state is not None and self.state.shared
+
+    def _on_usage_fetched(self, phone_number, usage_dict):
+        self.usage_cache.put(phone_number, usage_dict)
+        if self._state_shared:
+            self.state.set('usage:' + str(phone_number), {'fetched_at': time.time(), 'usage': usage_dict})
+        for listener in self._usage_listeners:
+            try:
+                listener(str(phone_number), usage_dict)
+            except Exception:
+                self.logger.exception('Usage listener %r failed', listener)
+
+    @staticmethod
+    def _create_session(pool_size):
+        """requests.Session keeping the TCP/TLS connections to StarHub alive
+
+        Mounting a larger HTTPAdapter lets every dispatcher worker hold its
+        own pooled connection instead of handshaking on each request.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def _send(self, endpoint, method, url, **kwargs):
+        """session.request recording latency and status code metrics"""
+        started = time.perf_counter()
+        try:
+            res = self.session.request(method, url, timeout=self.http_timeout, **kwargs)
+        except requests.RequestException:
+            metrics.STARHUB_RESPONSES.inc(endpoint, 'error')
+            raise
+        finally:
+            metrics.STARHUB_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+        metrics.STARHUB_RESPONSES.inc(endpoint, res.status_code)
+        return res
+
+    def _send_with_retry(self, endpoint, send, on_unauthorized=None):
+        """Call send() until it gets a response worth returning
+
+        send() performs one attempt and returns its requests.Response.
+        401 responses call on_unauthorized() before the next attempt, 5xx
+        responses and network errors are retried after a backoff, at most
+        retry_policy.max_attempts attempts are made in total. The last
+        response (or exception) is returned (or raised) once attempts run
+        out.
 
         Raises:
-            StarHubApiError: Error associated with accessing StarHub's API
+            CircuitOpenError: StarHub is considered down
         """
-        if self.user_token:
-            return self.user_token
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_circuit(endpoint)
+            try:
+                res = send()
+            except requests.RequestException:
+                if not self._should_retry(endpoint, attempt, None):
+                    raise
+            else:
+                if not self._should_retry(endpoint, attempt, res.status_code):
+                    return res
+                if res.status_code == requests.codes.unauthorized and on_unauthorized:
+                    on_unauthorized()
+            time.sleep(self.retry_policy.delay(attempt))
+
+    def _check_circuit(self, endpoint):
+        try:
+            self.circuit_breaker.check(endpoint)
+        except CircuitOpenError:
+            metrics.STARHUB_RESPONSES.inc(endpoint, 'circuit_open')
+            raise
+
+    def _should_retry(self, endpoint, attempt, status_code):
+        """Record the outcome of an attempt, True if another one should follow
+
+        status_code is None when no response was received.
+        """
+        if status_code is None or status_code >= 500:
+            if self.circuit_breaker.record_failure():
+                self.logger.error('StarHub circuit opened after repeated failures')
+            reason = 'error' if status_code is None else 'server_error'
+        else:
+            # StarHub answered, even a 4xx means it is up
+            self.circuit_breaker.record_success()
+            if status_code != requests.codes.unauthorized:
+                return False
+            reason = 'unauthorized'
+
+        if attempt >= self.retry_policy.max_attempts or self.circuit_breaker.is_open:
+            return False
+        self.logger.warning('Retrying %s after attempt %d: %s', endpoint, attempt, reason)
+        metrics.STARHUB_RETRIES.inc(endpoint, reason)
+        return True
 
+    def _msso_login_request(self):
+        """Headers and JSON body for the MSSO login endpoint"""
+        headers = {
+            'User-Agent': self.user_agent_str,
+            'Accept': 'application/json'
+        }
         mapp_body_dict = {
             'site_id': 'mystarhub',
             'user_id': self.user_id,
             'user_password': self.user_password
         }
+        return headers, mapp_body_dict
 
+    def _esso_login_request(self, user_token):
+        """Headers and JSON body for the ESSO login endpoint"""
         headers = {
             'User-Agent': self.user_agent_str,
-            'Accept': 'application/json'
+            'Content-Type': 'application/json',
+            'Accept': 'application/json',
+            'x-sh-msa-version': self.x_sh_msa_version
+        }
+        esso_body_dict = {
+            'essoLogin': {
+                "loginId": self.user_id,
+                "siteId": "mystarhub",
+                "siteKey": "1q23TypKwgba7984",
+                "vctk3": user_token
+            }
         }
+        return headers, esso_body_dict
 
-        res = requests.post(self.msso_login_url,
-                            headers=headers,
-                            json=mapp_body_dict,
-                            timeout=10)
+    def _usage_headers(self, utoken):
+        """Headers for the fapi usage endpoints"""
+        return {
+            'Authorization': utoken,
+            'Accept': 'application/json',
+            'User-Agent': self.user_agent_str,
+            'x-sh-msa-version': self.x_sh_msa_version
+        }
+
+    def _store_user_token(self, res_json):
+        self.user_token = res_json.get('user_token', None)
+        self._save_tokens()
+        return self.user_token
+
+    def _store_utoken(self, res_json):
+        self.u_token = res_json['userDetails']['utoken']
+        self.u_token_issued_at = time.time()
+        self._save_tokens()
+        return self.u_token
+
+    def _load_tokens(self):
+        """Restore user_token and u_token persisted by a previous run"""
+        if not self.token_cache_path or not os.path.exists(self.token_cache_path):
+            return
+        try:
+            with open(self.token_cache_path, 'r') as f:
+                tokens = json.load(f)
+        except (OSError, ValueError) as ex:
+            self.logger.warning('Unable to load token cache: %s', ex)
+            return
+        # Tokens belonging to another StarHub ID are useless to us
+        if tokens.get('user_id') != self.user_id:
+            return
+        self.user_token = tokens.get('user_token')
+        self.u_token = tokens.get('u_token')
+        self.u_token_issued_at = tokens.get('u_token_issued_at')
+
+    def _adopt_shared_tokens(self):
+        """Take over newer tokens stored in the state backend by another replica
+
+        Returns:
+            True if a u_token was adopted
+        """
+        if self.state is None:
+            return False
+        tokens = self.state.get(self._tokens_key)
+        if not tokens:
+            return False
+        with self._token_lock:
+            if tokens.get('user_token'):
+                self.user_token = tokens['user_token']
+            if tokens.get('u_token') and (tokens.get('u_token_issued_at') or 0) > (self.u_token_issued_at or 0):
+                self.u_token = tokens['u_token']
+                self.u_token_issued_at = tokens['u_token_issued_at']
+                return True
+        return False
+
+    def _save_tokens(self):
+        """Persist the current tokens so a restarted bot does not re-login"""
+        tokens = {
+            'user_id': self.user_id,
+            'user_token': self.user_token,
+            'u_token': self.u_token,
+            'u_token_issued_at': self.u_token_issued_at
+        }
+        if self.state is not None:
+            self.state.set(self._tokens_key, tokens)
+        if not self.token_cache_path:
+            return
+        tmp_path = self.token_cache_path + '.tmp'
+        try:
+            directory = os.path.dirname(self.token_cache_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(tmp_path, 'w') as f:
+                json.dump(tokens, f)
+            # Atomic swap so a crash never leaves a half-written file behind
+            os.replace(tmp_path, self.token_cache_path)
+        except OSError as ex:
+            self.logger.warning('Unable to save token cache: %s', ex)
+
+    def get_valid_utoken(self):
+        """Return the cached u_token, logging in again only when required
+
+        A new login is performed when there is no u_token yet or when
+        the cached one is older than utoken_ttl. Concurrent refreshes
+        share a single login so they do not invalidate each other.
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        utoken = self._cached_utoken()
+        if utoken:
+            return utoken
+        return self._flight.do('utoken', self._refresh_utoken)
+
+    def _cached_utoken(self):
+        """The cached u_token if it is younger than utoken_ttl, else None
+
+        The state backend is only consulted when there is no valid local
+        u_token.
+        """
+        utoken = self._local_utoken()
+        if utoken is None and self._adopt_shared_tokens():
+            utoken = self._local_utoken()
+        return utoken
+
+    def _local_utoken(self):
+        with self._token_lock:
+            if self.u_token and self.u_token_issued_at is not None \
+                    and time.time() - self.u_token_issued_at < self.utoken_ttl:
+                return self.u_token
+            return None
+
+    def _refresh_utoken(self):
+        if not self._state_shared:
+            return self.get_utoken(self.get_user_token())
+
+        deadline = time.monotonic() + self.utoken_lease_ttl
+        while True:
+            acquired, utoken = self._try_utoken_lease(deadline)
+            if utoken:
+                return utoken
+            if acquired:
+                break
+            time.sleep(0.2)
+        try:
+            return self.get_utoken(self.get_user_token())
+        finally:
+            self.state.delete(self._lease_key, self._replica_id)
+
+    def _try_utoken_lease(self, deadline):
+        """One attempt at the lease allowing this replica to log in
+
+        Only the lease holder logs in, the other replicas wait for its
+        u_token instead of invalidating it with logins of their own.
+
+        Returns:
+            (acquired, utoken): utoken is set if a valid u_token became
+            available meanwhile, acquired if the lease is now held
+
+        Raises:
+            StarHubApiException: The lease holder did not log in in time
+        """
+        utoken = self._cached_utoken()
+        if utoken:
+            return False, utoken
+        if self.state.add(self._lease_key, self._replica_id, ttl=self.utoken_lease_ttl):
+            # The previous holder may have stored its u_token just before
+            utoken = self._cached_utoken()
+            if utoken:
+                self.state.delete(self._lease_key, self._replica_id)
+            return not utoken, utoken
+        if time.monotonic() >= deadline:
+            raise StarHubApiException(None, 'STATE/LEASE', None,
+                                      'Timed out waiting for another replica to log in')
+        return False, None
+
+    def invalidate_utoken(self, utoken):
+        """Drop utoken if it is still the cached one
+
+        Comparing against the rejected token avoids throwing away a
+        u_token that another request has just refreshed.
+        """
+        with self._token_lock:
+            if self.u_token == utoken:
+                self.u_token = None
+                self.u_token_issued_at = None
+        if self.state is not None:
+            tokens = self.state.get(self._tokens_key)
+            if tokens and tokens.get('u_token') == utoken:
+                tokens.update(u_token=None, u_token_issued_at=None)
+                self.state.set(self._tokens_key, tokens)
+
+    def get_user_token(self):
+        """Retrieve user_token from MSSO login endpoint
+
+        user_token will be cached as it will not expire
+        This is tested on 8 December 2019
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        if self.user_token:
+            return self.user_token
+
+        headers, mapp_body_dict = self._msso_login_request()
+        res = self._send_with_retry('msso_login', lambda: self._send(
+            'msso_login', 'POST', self.msso_login_url,
+            headers=headers,
+            json=mapp_body_dict))
 
         if res.status_code == requests.codes.ok:
-            res_json = res.json()
-            self.user_token = res_json.get('user_token', None)
-            return res_json.get('user_token', None)
+            return self._store_user_token(res.json())
         raise StarHubApiException(res.status_code, 'MSSO/MAPP/LOGIN',
                                   res.text, 'User token request failed')
 
@@ -80,77 +571,243 @@ class StarHubApi:
 
         If another u_token is generated, the previous one will be invalidated,
         causing a 401 Unauthorized error. To get around this issue,
-        if 401 error code is encountered, function will reattempt request.
+        if 401 error code is encountered, the request is reattempted with a
+        new user_token, up to retry_policy.max_attempts times.
 
         Raises:
             StarHubApiError: Error associated with accessing StarHub's API
         """
+        user_tokens = [user_token]
 
-        headers = {
-            'User-Agent': self.user_agent_str,
-            'Content-Type': 'application/json',
-            'Accept': 'application/json',
-            'x-sh-msa-version': self.x_sh_msa_version
-        }
+        def send():
+            headers, esso_body_dict = self._esso_login_request(user_tokens[-1])
+            return self._send('esso_login', 'POST', self.fapi_login_url,
+                              headers=headers,
+                              json=esso_body_dict)
 
-        esso_body_dict = {
-            'essoLogin': {
-                "loginId": self.user_id,
-                "siteId": "mystarhub",
-                "siteKey": "1q23TypKwgba7984",
-                "vctk3": user_token
-            }
-        }
+        def on_unauthorized():
+            # A persisted user_token may have been revoked, log in again
+            self.user_token = None
+            user_tokens.append(self.get_user_token())
 
-        res = requests.post(self.fapi_login_url,
-                            headers=headers,
-                            json=esso_body_dict,
-                            timeout=10)
+        res = self._send_with_retry('esso_login', send, on_unauthorized)
         if res.status_code == requests.codes.ok:
-            res_json = res.json()
-            self.u_token = res_json['userDetails']['utoken']
-            return self.u_token
-        if res.status_code != requests.codes.ok and \
-                res.status_code == requests.codes.unauthorized:
-            self.logger.warning(
-                'Retrying get_utoken. Status code: %d', res.status_code)
-            return self.get_utoken(self.get_user_token())
+            return self._store_utoken(res.json())
         raise StarHubApiException(res.status_code, 'FAPI/LOGIN/ESSO',
                                   res.text, 'UToken request failed')
 
-    def get_phone_data_usage(self, utoken, phone_number):
+    def get_phone_data_usage(self, phone_number, fresh=False, max_age=None):
         """Get a single phone number's data usage
 
-        If another u_token is generated, the previous one will be invalidated,
-        causing a 401 Unauthorized error. To get around this issue,
-        if 401 error code is encountered, function will reattempt request.
+        Data fetched within the last usage_cache_ttl (or max_age) seconds is
+        returned from cache unless fresh is True. Concurrent requests for the same
+        phone_number share one in-flight request and all callers receive
+        the same usage dict, which must therefore be treated as read-only.
+        While the circuit breaker is open, the last fetched data is returned
+        whatever its age, unless fresh is True.
 
         Raises:
             StarHubApiError: Error associated with accessing StarHub's API
         """
+        if fresh:
+            metrics.USAGE_CACHE_REQUESTS.inc('bypass')
+        else:
+            usage_dict = self._cached_usage(phone_number, max_age)
+            if usage_dict is not None:
+                return usage_dict
+        try:
+            return self._flight.do(('usage', str(phone_number)),
+                                   self._fetch_phone_data_usage, phone_number)
+        except CircuitOpenError:
+            usage_dict = None if fresh else self._last_known_usage(phone_number)
+            if usage_dict is None:
+                raise
+            return usage_dict
 
-        headers = {
-            'Authorization': utoken,
-            'Accept': 'application/json',
-            'User-Agent': self.user_agent_str,
-            'x-sh-msa-version': self.x_sh_msa_version
-        }
-        res = requests.get(
-            self.fapi_specific_usage_url.format(phone_number=phone_number),
-            headers=headers,
-            timeout=10)
+    def _cached_usage(self, phone_number, max_age):
+        """Usage from the local cache, or fetched by another replica"""
+        usage_dict = self.usage_cache.get(phone_number, max_age=max_age)
+        if usage_dict is not None:
+            metrics.USAGE_CACHE_REQUESTS.inc('hit')
+            return usage_dict
+        usage_dict = self._shared_usage(phone_number, self.usage_cache.ttl if max_age is None else max_age)
+        metrics.USAGE_CACHE_REQUESTS.inc('miss' if usage_dict is None else 'shared_hit')
+        return usage_dict
 
-        if res.status_code == requests.codes.ok:
-            res_json = res.json()
-            return res_json['mainContext']['present']['any'][0]['dataUsages']['usageDetail'][0]
+    def _shared_usage(self, phone_number, max_age):
+        """Usage stored in the state backend less than max_age seconds ago"""
+        if not self._state_shared:
+            return None
+        entry = self.state.get('usage:' + str(phone_number))
+        if entry is None:
+            return None
+        age = max(0., time.time() - entry['fetched_at'])
+        if age >= max_age:
+            return None
+        self.usage_cache.put(phone_number, entry['usage'], age=age)
+        return entry['usage']
+
+    def _last_known_usage(self, phone_number):
+        usage_dict = self.usage_cache.get(phone_number, max_age=float('inf')) \
+            or self._shared_usage(phone_number, float('inf'))
+        if usage_dict is not None:
+            metrics.USAGE_CACHE_REQUESTS.inc('stale')
+        return usage_dict
+
+    def get_phone_data_usage_batch(self, phone_numbers, fresh=False, timeout=None, max_age=None):
+        """Get the data usage of several phone numbers concurrently
+
+        At most batch_concurrency requests run at the same time. A failing
+        or slow number does not affect the others, it is reported in the
+        returned errors instead.
+
+        Args:
+            phone_numbers: Phone numbers to fetch
+            fresh: Bypass the usage cache
+            max_age: See get_phone_data_usage
+            timeout: Seconds to wait for the whole batch, numbers still
+                pending afterwards are reported as timed out. Every request
+                is additionally bounded by http_timeout.
+
+        Returns:
+            (usage_by_number, errors_by_number) tuple of dicts keyed by the
+            phone number as str. errors_by_number holds the exception
+            raised for that number.
+        """
+        executor = self._get_batch_executor()
+        futures = {executor.submit(self.get_phone_data_usage, phone_number, fresh, max_age): str(phone_number)
+                   for phone_number in phone_numbers}
 
-        if res.status_code != requests.codes.ok \
-                and res.status_code == requests.codes.unauthorized:
-            self.logger.warning(
-                'Retrying get_phone_data_usage. Status code: %d',
-                res.status_code)
-            utoken = self.get_utoken(self.get_user_token())
-            return self.get_phone_data_usage(utoken, phone_number)
+        usage_by_number = {}
+        errors_by_number = {}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                phone_number = futures[future]
+                try:
+                    usage_by_number[phone_number] = future.result()
+                except Exception as ex:
+                    self.logger.warning('Batch request for %s failed: %s', phone_number, ex)
+                    errors_by_number[phone_number] = ex
+        except FuturesTimeoutError:
+            for future, phone_number in futures.items():
+                if not future.done():
+                    future.cancel()
+                    errors_by_number[phone_number] = FuturesTimeoutError(
+                        'Data usage request for {} timed out'.format(phone_number))
+        return usage_by_number, errors_by_number
+
+    def shutdown(self):
+        """Release the connection pool and the batch threads
+
+        Requests already running complete, their connections are closed
+        instead of going back to the pool.
+        """
+        self.session.close()
+        with self._batch_executor_lock:
+            if self._batch_executor is not None:
+                self._batch_executor.shutdown(wait=False)
+                self._batch_executor = None
+
+    def _get_batch_executor(self):
+        with self._batch_executor_lock:
+            if self._batch_executor is None:
+                self._batch_executor = ThreadPoolExecutor(max_workers=self.batch_concurrency,
+                                                          thread_name_prefix='starhub_batch')
+            return self._batch_executor
+
+    def _fetch_phone_data_usage(self, phone_number):
+        """Request a single phone number's data usage from StarHub
+
+        The cached u_token is reused across calls. If another u_token is
+        generated, the previous one will be invalidated, causing a
+        401 Unauthorized error. To get around this issue, if 401 error code
+        is encountered, the u_token is refreshed and the request reattempted,
+        up to retry_policy.max_attempts times.
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        url = self.fapi_specific_usage_url.format(phone_number=phone_number)
+        utokens = []
+
+        def send():
+            utokens.append(self.get_valid_utoken())
+            return self._send('usage', 'GET', url, headers=self._usage_headers(utokens[-1]))
+
+        res = self._send_with_retry('usage', send, lambda: self.invalidate_utoken(utokens[-1]))
+        if res.status_code == requests.codes.ok:
+            usage_dict = self.parse_phone_data_usage(res.json())
+            self._on_usage_fetched(phone_number, usage_dict)
+            return usage_dict
 
         raise StarHubApiException(res.status_code, 'FAPI/USAGE/DATA',
                                   res.text, 'Data usage request failed')
+
+    def get_all_usage(self):
+        """Get the data usage of every line on the account in one request
+
+        Concurrent callers share one in-flight request. Records carrying
+        the full daily breakdown are also stored in the usage cache.
+
+        Returns:
+            dict mapping each phone number (str) to its usageDetail dict
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        return self._flight.do('all-usage', self._fetch_all_usage)
+
+    def _fetch_all_usage(self):
+        """Request the usage of every line from StarHub
+
+        Retries with a refreshed u_token on 401, like
+        _fetch_phone_data_usage.
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        utokens = []
+
+        def send():
+            utokens.append(self.get_valid_utoken())
+            return self._send('all_usage', 'GET', self.fapi_all_usage_url,
+                              headers=self._usage_headers(utokens[-1]))
+
+        res = self._send_with_retry('all_usage', send, lambda: self.invalidate_utoken(utokens[-1]))
+        if res.status_code == requests.codes.ok:
+            return self._store_all_usage(self.parse_all_usage(res.json()))
+
+        raise StarHubApiException(res.status_code, 'FAPI/USAGE',
+                                  res.text, 'All usage request failed')
+
+    def _store_all_usage(self, usage_by_number):
+        # Only records as complete as the specific usage endpoint's are
+        # cached, the handlers serve the cache for single numbers too
+        for phone_number, usage_dict in usage_by_number.items():
+            if all(usage_dict.get(key) for key in ('dailyUsage', 'fromDateTime', 'lastProcessedDateTime')):
+                self._on_usage_fetched(phone_number, usage_dict)
+        return usage_by_number
+
+    @staticmethod
+    def parse_phone_data_usage(res_json):
+        """Extract the usageDetail dict from the specific usage payload"""
+        return res_json['mainContext']['present']['any'][0]['dataUsages']['usageDetail'][0]
+
+    @staticmethod
+    def parse_all_usage(res_json):
+        """Split the all-usage payload into per phone number usageDetail dicts
+
+        Every entry of mainContext.present.any describes one subscription
+        and may carry several data usageDetail records, each identified by
+        its usageServiceId. Entries without data usage (e.g. voice/SMS
+        only) are skipped.
+        """
+        usage_by_number = {}
+        subscriptions = res_json.get('mainContext', {}).get('present', {}).get('any') or []
+        for subscription in subscriptions:
+            data_usages = (subscription or {}).get('dataUsages') or {}
+            for usage_dict in data_usages.get('usageDetail') or []:
+                phone_number = usage_dict.get('usageServiceId')
+                if phone_number is not None:
+                    usage_by_number[str(phone_number)] = usage_dict
+        return usage_by_number
@@ -0,0 +1,332 @@
+"""
+asyncio flavour of StarHubApi, requires aiohttp
+
+The bot itself does not use it: its handlers run on the dispatcher's
+worker threads and call StarHubApi. It is meant for callers that already
+run an asyncio loop.
+"""
+import asyncio
+import functools
+import json
+import time
+
+import aiohttp
+import requests
+
+import metrics
+from starhub_api import StarHubApi
+from starhub_api import StarHubApiException
+from starhub_api import CircuitOpenError
+
+
+class AsyncSingleFlight:
+    """asyncio counterpart of starhub_api.SingleFlight
+
+    The call is shielded so a cancelled waiter does not cancel the
+    request other waiters are sharing.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, coro_fn, *args, **kwargs):
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coro_fn(*args, **kwargs))
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        return await asyncio.shield(task)
+
+
+class AsyncStarHubApi(StarHubApi):
+    """StarHubApi whose requests run on one pooled aiohttp session
+
+    Offers the same methods as StarHubApi as coroutines. Connections to
+    login.starhubgee.com.sg and fapi.starhub.com are kept alive between
+    calls and capped at http_pool_size per host, so slow StarHub responses
+    only hold an idle coroutine rather than a worker thread.
+
+    Token persistence and the usage cache are shared with StarHubApi.
+    Calls to a shared state backend and the usage listeners block on
+    network or disk I/O, they run in the loop's default executor. Call
+    close() (or use ``async with``) to release the connection pool,
+    shutdown() does the same from outside the loop.
+    """
+
+    def __init__(self, user_id, user_password, utoken_ttl=1800, token_cache_path=None,
+                 usage_cache_ttl=300, usage_cache_size=64, http_timeout=10, http_pool_size=10,
+                 batch_concurrency=4, retry_max_attempts=3, retry_base_delay=0.5, retry_max_delay=4,
+                 circuit_failure_threshold=5, circuit_reset_timeout=60, state=None, utoken_lease_ttl=30):
+        super().__init__(user_id, user_password,
+                         utoken_ttl=utoken_ttl,
+                         token_cache_path=token_cache_path,
+                         usage_cache_ttl=usage_cache_ttl,
+                         usage_cache_size=usage_cache_size,
+                         http_timeout=http_timeout,
+                         http_pool_size=http_pool_size,
+                         batch_concurrency=batch_concurrency,
+                         retry_max_attempts=retry_max_attempts,
+                         retry_base_delay=retry_base_delay,
+                         retry_max_delay=retry_max_delay,
+                         circuit_failure_threshold=circuit_failure_threshold,
+                         circuit_reset_timeout=circuit_reset_timeout,
+                         state=state,
+                         utoken_lease_ttl=utoken_lease_ttl)
+        self.http_pool_size = http_pool_size
+        self._flight = AsyncSingleFlight()
+        self._client = None
+        self._client_loop = None
+
+    @staticmethod
+    def _create_session(pool_size):
+        # The aiohttp session has to be created inside the running loop,
+        # see _get_client
+        return None
+
+    def _get_client(self):
+        if self._client is None or self._client.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=self.http_pool_size,
+                                             keepalive_timeout=60)
+            timeout = aiohttp.ClientTimeout(total=self.http_timeout)
+            self._client = aiohttp.ClientSession(connector=connector,
+                                                 timeout=timeout)
+            self._client_loop = asyncio.get_running_loop()
+        return self._client
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+
+    def shutdown(self):
+        """Release the connection pool from outside the event loop
+
+        The session is closed on the loop it was created in, if that loop
+        is closed already its connections went with it.
+        """
+        client, self._client = self._client, None
+        if client is None or client.closed:
+            return
+        loop = self._client_loop
+        if loop.is_running():
+            asyncio.run_coroutine_threadsafe(client.close(), loop)
+        elif not loop.is_closed():
+            loop.run_until_complete(client.close())
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def _blocking(self, fn, *args, listeners=False):
+        """Call fn off the event loop if it may wait on a shared state backend
+
+        With listeners, also if it calls the usage listeners.
+        """
+        if not self._state_shared and not (listeners and self._usage_listeners):
+            return fn(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(fn, *args))
+
+    async def _request(self, endpoint, method, url, **kwargs):
+        """Perform a request and return its status code and body
+
+        The body is read inside the context manager so the connection goes
+        back to the pool before any retry is attempted.
+        """
+        started = time.perf_counter()
+        try:
+            async with self._get_client().request(method, url, **kwargs) as res:
+                status, text = res.status, await res.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            metrics.STARHUB_RESPONSES.inc(endpoint, 'error')
+            raise
+        finally:
+            metrics.STARHUB_REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+        metrics.STARHUB_RESPONSES.inc(endpoint, status)
+        return status, text
+
+    async def _send_with_retry(self, endpoint, send, on_unauthorized=None):
+        """Coroutine counterpart of StarHubApi._send_with_retry
+
+        send() is a coroutine function returning (status, text), and so is
+        on_unauthorized().
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            self._check_circuit(endpoint)
+            try:
+                status, text = await send()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not self._should_retry(endpoint, attempt, None):
+                    raise
+            else:
+                if not self._should_retry(endpoint, attempt, status):
+                    return status, text
+                if status == requests.codes.unauthorized and on_unauthorized:
+                    await on_unauthorized()
+            await asyncio.sleep(self.retry_policy.delay(attempt))
+
+    async def get_user_token(self):
+        """Retrieve user_token from MSSO login endpoint
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        if self.user_token:
+            return self.user_token
+
+        headers, mapp_body_dict = self._msso_login_request()
+        status, text = await self._send_with_retry('msso_login', lambda: self._request(
+            'msso_login', 'POST', self.msso_login_url,
+            headers=headers,
+            json=mapp_body_dict))
+        if status == requests.codes.ok:
+            return await self._blocking(self._store_user_token, json.loads(text))
+        raise StarHubApiException(status, 'MSSO/MAPP/LOGIN',
+                                  text, 'User token request failed')
+
+    async def get_utoken(self, user_token):
+        """Retrieves u_token from the ESSO login endpoint
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        user_tokens = [user_token]
+
+        def send():
+            headers, esso_body_dict = self._esso_login_request(user_tokens[-1])
+            return self._request('esso_login', 'POST', self.fapi_login_url,
+                                 headers=headers,
+                                 json=esso_body_dict)
+
+        async def on_unauthorized():
+            self.user_token = None
+            user_tokens.append(await self.get_user_token())
+
+        status, text = await self._send_with_retry('esso_login', send, on_unauthorized)
+        if status == requests.codes.ok:
+            return await self._blocking(self._store_utoken, json.loads(text))
+        raise StarHubApiException(status, 'FAPI/LOGIN/ESSO',
+                                  text, 'UToken request failed')
+
+    async def get_valid_utoken(self):
+        """Return the cached u_token, logging in again only when required
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        utoken = await self._blocking(self._cached_utoken)
+        if utoken:
+            return utoken
+        return await self._flight.do('utoken', self._refresh_utoken)
+
+    async def _refresh_utoken(self):
+        if not self._state_shared:
+            return await self.get_utoken(await self.get_user_token())
+
+        deadline = time.monotonic() + self.utoken_lease_ttl
+        while True:
+            acquired, utoken = await self._blocking(self._try_utoken_lease, deadline)
+            if utoken:
+                return utoken
+            if acquired:
+                break
+            await asyncio.sleep(0.2)
+        try:
+            return await self.get_utoken(await self.get_user_token())
+        finally:
+            await self._blocking(self.state.delete, self._lease_key, self._replica_id)
+
+    async def get_phone_data_usage(self, phone_number, fresh=False, max_age=None):
+        """Get a single phone number's data usage
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        if fresh:
+            metrics.USAGE_CACHE_REQUESTS.inc('bypass')
+        else:
+            usage_dict = await self._blocking(self._cached_usage, phone_number, max_age)
+            if usage_dict is not None:
+                return usage_dict
+        try:
+            return await self._flight.do(('usage', str(phone_number)),
+                                         self._fetch_phone_data_usage, phone_number)
+        except CircuitOpenError:
+            usage_dict = None if fresh else await self._blocking(self._last_known_usage, phone_number)
+            if usage_dict is None:
+                raise
+            return usage_dict
+
+    async def get_phone_data_usage_batch(self, phone_numbers, fresh=False, timeout=None, max_age=None):
+        """Coroutine counterpart of StarHubApi.get_phone_data_usage_batch
+
+        At most batch_concurrency requests run at the same time, numbers
+        still pending after timeout are reported with an asyncio.TimeoutError.
+        """
+        semaphore = asyncio.Semaphore(self.batch_concurrency)
+
+        async def fetch(phone_number):
+            async with semaphore:
+                return await self.get_phone_data_usage(phone_number, fresh, max_age)
+
+        tasks = {asyncio.ensure_future(fetch(phone_number)): str(phone_number)
+                 for phone_number in phone_numbers}
+        usage_by_number = {}
+        errors_by_number = {}
+        if not tasks:
+            return usage_by_number, errors_by_number
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in done:
+            phone_number = tasks[task]
+            try:
+                usage_by_number[phone_number] = task.result()
+            except Exception as ex:
+                self.logger.warning('Batch request for %s failed: %s', phone_number, ex)
+                errors_by_number[phone_number] = ex
+        for task in pending:
+            task.cancel()
+            errors_by_number[tasks[task]] = asyncio.TimeoutError(
+                'Data usage request for {} timed out'.format(tasks[task]))
+        return usage_by_number, errors_by_number
+
+    async def _usage_attempt(self, endpoint, url, utokens):
+        utokens.append(await self.get_valid_utoken())
+        return await self._request(endpoint, 'GET', url, headers=self._usage_headers(utokens[-1]))
+
+    async def _invalidate_last_utoken(self, utokens):
+        await self._blocking(self.invalidate_utoken, utokens[-1])
+
+    async def _fetch_phone_data_usage(self, phone_number):
+        url = self.fapi_specific_usage_url.format(phone_number=phone_number)
+        utokens = []
+        status, text = await self._send_with_retry(
+            'usage', lambda: self._usage_attempt('usage', url, utokens),
+            lambda: self._invalidate_last_utoken(utokens))
+        if status == requests.codes.ok:
+            usage_dict = self.parse_phone_data_usage(json.loads(text))
+            await self._blocking(self._on_usage_fetched, phone_number, usage_dict, listeners=True)
+            return usage_dict
+        raise StarHubApiException(status, 'FAPI/USAGE/DATA',
+                                  text, 'Data usage request failed')
+
+    async def get_all_usage(self):
+        """Get the data usage of every line on the account in one request
+
+        Raises:
+            StarHubApiError: Error associated with accessing StarHub's API
+        """
+        return await self._flight.do('all-usage', self._fetch_all_usage)
+
+    async def _fetch_all_usage(self):
+        utokens = []
+        status, text = await self._send_with_retry(
+            'all_usage', lambda: self._usage_attempt('all_usage', self.fapi_all_usage_url, utokens),
+            lambda: self._invalidate_last_utoken(utokens))
+        if status == requests.codes.ok:
+            return await self._blocking(self._store_all_usage, self.parse_all_usage(json.loads(text)),
+                                        listeners=True)
+        raise StarHubApiException(status, 'FAPI/USAGE',
+                                  text, 'All usage request failed')
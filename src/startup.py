@@ -0,0 +1,69 @@
+"""
+Startup time measurement
+
+Importing this module starts timing every import made from the importing
+thread, so it should be the first import of main.py.
+"""
+import builtins
+import sys
+import threading
+import time
+
+
+class StartupTimer:
+    """Records how long each startup phase and each first-time import takes"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = []
+        self.imports = {}
+        self._last_mark = self.started
+        self._thread_id = None
+        self._depth = 0
+        self._original_import = None
+
+    def start_import_profiling(self):
+        self._thread_id = threading.get_ident()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._timed_import
+
+    def stop_import_profiling(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(), level=0):
+        # Only time modules imported for the first time by main.py itself,
+        # their own nested imports are included in the measurement
+        if self._depth or level or name in sys.modules or threading.get_ident() != self._thread_id:
+            return self._original_import(name, globals, locals, fromlist, level)
+        self._depth += 1
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, globals, locals, fromlist, level)
+        finally:
+            self._depth -= 1
+            self.imports[name] = time.perf_counter() - start
+
+    def mark(self, phase):
+        """Close the current phase, naming it phase"""
+        now = time.perf_counter()
+        self.phases.append((phase, now - self._last_mark))
+        self._last_mark = now
+
+    @property
+    def total(self):
+        return self._last_mark - self.started
+
+    def summary(self, top_imports=8):
+        text = ['Startup took {:.0f} ms'.format(self.total * 1000)]
+        for phase, seconds in self.phases:
+            text.append('  {}: {:.0f} ms'.format(phase, seconds * 1000))
+        slowest = sorted(self.imports.items(), key=lambda item: item[1], reverse=True)
+        for name, seconds in slowest[:top_imports]:
+            text.append('  import {}: {:.0f} ms'.format(name, seconds * 1000))
+        return '\n'.join(text)
+
+
+startup_timer = StartupTimer()
+startup_timer.start_import_profiling()
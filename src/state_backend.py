@@ -0,0 +1,332 @@
+"""
+Key-value state shared by bot replicas: tokens, cached usage, rate limits
+"""
+import json
+import os
+import select
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+
+def create_backend(url='memory'):
+    """Backend described by url
+
+    'memory' (default) keeps the state in this process,
+    'sqlite:///path/to/state.sqlite3' shares it through a SQLite file
+    (replicas on one host or a shared volume) and
+    'redis://[:password@]host[:port][/db]' through a server speaking the
+    Redis protocol.
+    """
+    parsed = urlparse(url or 'memory')
+    if not url or url == 'memory':
+        backend = MemoryBackend()
+    elif parsed.scheme == 'sqlite':
+        # sqlite:///relative/path and sqlite:////absolute/path, as SQLAlchemy
+        backend = SQLiteBackend(parsed.netloc + parsed.path if parsed.netloc else parsed.path[1:])
+    elif parsed.scheme == 'redis':
+        backend = RedisBackend(host=parsed.hostname or 'localhost',
+                               port=parsed.port or 6379,
+                               db=int(parsed.path.lstrip('/') or 0),
+                               password=parsed.password)
+    else:
+        raise ValueError('Unsupported state backend: {}'.format(url))
+    # Lets worker processes (e.g. account shards) connect to the same state
+    backend.url = url or 'memory'
+    return backend
+
+
+class MemoryBackend:
+    """Process-local state, the default for a single replica
+
+    Every backend stores JSON-serializable values under str keys, with an
+    optional time to live in seconds.
+    """
+    # Whether other processes see the state
+    shared = False
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def _live(self, key, now):
+        entry = self._entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, time.time())
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries[key] = (value, None if ttl is None else time.time() + ttl)
+
+    def add(self, key, value, ttl=None):
+        """Set key only if it does not exist, True if it was set"""
+        with self._lock:
+            now = time.time()
+            if self._live(key, now) is not None:
+                return False
+            self._entries[key] = (value, None if ttl is None else now + ttl)
+            return True
+
+    def incr(self, key, ttl=None):
+        """Increment the counter at key, ttl applies from its creation"""
+        with self._lock:
+            now = time.time()
+            entry = self._live(key, now)
+            if entry is None:
+                entry = (0, None if ttl is None else now + ttl)
+            self._entries[key] = (entry[0] + 1, entry[1])
+            return entry[0] + 1
+
+    def decr(self, key):
+        """Take back an incr, a counter that is gone is left alone"""
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is not None:
+                self._entries[key] = (entry[0] - 1, entry[1])
+
+    def delete(self, key, value=None):
+        """Delete key, only if it holds value when value is given"""
+        with self._lock:
+            entry = self._live(key, time.time())
+            if entry is not None and (value is None or entry[0] == value):
+                del self._entries[key]
+
+
+class SQLiteBackend:
+    """State in a SQLite file shared by every process opening it
+
+    Read-modify-write operations run in IMMEDIATE transactions, so they
+    are atomic across processes.
+
+    Args:
+        path: SQLite database file
+    """
+    shared = True
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                expires_at REAL
+            ) WITHOUT ROWID''')
+
+    def _transaction(self, fn):
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = fn(self._conn, time.time())
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    @staticmethod
+    def _select(conn, key, now):
+        row = conn.execute('SELECT value, expires_at FROM state WHERE key = ?', (key,)).fetchone()
+        if row is None or (row[1] is not None and row[1] <= now):
+            return None
+        return json.loads(row[0])
+
+    def get(self, key):
+        with self._lock:
+            return self._select(self._conn, key, time.time())
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                               (key, json.dumps(value), None if ttl is None else time.time() + ttl))
+
+    def add(self, key, value, ttl=None):
+        def add(conn, now):
+            if self._select(conn, key, now) is not None:
+                return False
+            conn.execute('INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), None if ttl is None else now + ttl))
+            return True
+        return self._transaction(add)
+
+    def incr(self, key, ttl=None):
+        def incr(conn, now):
+            row = conn.execute('SELECT value, expires_at FROM state WHERE key = ?', (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                value, expires_at = 1, None if ttl is None else now + ttl
+            else:
+                value, expires_at = json.loads(row[0]) + 1, row[1]
+            conn.execute('INSERT OR REPLACE INTO state (key, value, expires_at) VALUES (?, ?, ?)',
+                         (key, json.dumps(value), expires_at))
+            return value
+        return self._transaction(incr)
+
+    def decr(self, key):
+        def decr(conn, now):
+            value = self._select(conn, key, now)
+            if value is not None:
+                conn.execute('UPDATE state SET value = ? WHERE key = ?', (json.dumps(value - 1), key))
+        self._transaction(decr)
+
+    def delete(self, key, value=None):
+        with self._lock:
+            if value is None:
+                self._conn.execute('DELETE FROM state WHERE key = ?', (key,))
+            else:
+                self._conn.execute('DELETE FROM state WHERE key = ? AND value = ?', (key, json.dumps(value)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RedisError(Exception):
+    """Error reply from the Redis server"""
+
+
+class RedisBackend:
+    """State on a server speaking the Redis protocol (RESP)
+
+    Only GET, SET (with PX/NX), INCR, DECR, PEXPIRE and DEL are used, so any
+    Redis-compatible server works. One connection is shared under a lock
+    and re-established after a network error, commands that are not
+    idempotent (INCR, DECR, SET NX) are not sent twice.
+    """
+    shared = True
+
+    def __init__(self, host='localhost', port=6379, db=0, password=None, timeout=5):
+        self.host = host
+        self.port = port
+        self.db = db
+        self.password = password
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        self._reader = self._sock.makefile('rb')
+        if self.password:
+            self._send('AUTH', self.password)
+        if self.db:
+            self._send('SELECT', self.db)
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._reader.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = self._reader = None
+
+    def _send(self, *args):
+        self._write(*args)
+        return self._read_reply()
+
+    def _write(self, *args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        self._sock.sendall(b''.join(parts))
+
+    def _is_stale(self):
+        """True if the server closed the idle connection (or sent something unasked)"""
+        readable, _, _ = select.select([self._sock], [], [], 0)
+        return bool(readable)
+
+    def _read_reply(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by the Redis server')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode('utf-8')
+        if prefix == b'-':
+            raise RedisError(payload.decode('utf-8'))
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2]
+        if prefix == b'*':
+            count = int(payload)
+            return None if count < 0 else [self._read_reply() for _ in range(count)]
+        raise RedisError('Unexpected reply: {!r}'.format(line))
+
+    def _command(self, *args, idempotent=True):
+        """Run a command, once more on a new connection after a network error
+
+        A command that is not idempotent is only sent again if it failed
+        before being written, once written a lost reply may hide that the
+        server applied it.
+        """
+        with self._lock:
+            for attempt in range(2):
+                written = False
+                try:
+                    if self._sock is not None and self._is_stale():
+                        self._close()
+                    if self._sock is None:
+                        self._connect()
+                    self._write(*args)
+                    written = True
+                    return self._read_reply()
+                except OSError:
+                    self._close()
+                    if attempt or (written and not idempotent):
+                        raise
+
+    def get(self, key):
+        value = self._command('GET', key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        args = ['SET', key, json.dumps(value)]
+        if ttl is not None:
+            args += ['PX', int(ttl * 1000)]
+        self._command(*args)
+
+    def add(self, key, value, ttl=None):
+        args = ['SET', key, json.dumps(value)]
+        if ttl is not None:
+            args += ['PX', int(ttl * 1000)]
+        return self._command(*(args + ['NX']), idempotent=False) is not None
+
+    def incr(self, key, ttl=None):
+        value = self._command('INCR', key, idempotent=False)
+        if value == 1 and ttl is not None:
+            self._command('PEXPIRE', key, int(ttl * 1000))
+        return value
+
+    def decr(self, key):
+        # A counter that expired meanwhile would be recreated without a ttl
+        if self._command('DECR', key, idempotent=False) <= 0:
+            self._command('DEL', key)
+
+    def delete(self, key, value=None):
+        # GET then DEL is not atomic, a lease could expire and be taken by
+        # another replica in between, which only costs an extra login
+        if value is None or self.get(key) == value:
+            self._command('DEL', key)
+
+    def close(self):
+        with self._lock:
+            self._close()
@@ -0,0 +1,79 @@
+"""
+In-process cache for StarHub usage data
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+def last_processed_key(usage_dict):
+    """Hashable representation of usage_dict's lastProcessedDateTime"""
+    date_json = usage_dict.get('lastProcessedDateTime') or {}
+    return tuple(date_json.get(field) for field in
+                 ('year', 'month', 'day', 'hour', 'minute', 'second'))
+
+
+class UsageCache:
+    """Thread-safe TTL cache with LRU eviction for usageDetail dicts
+
+    Entries are keyed by phone number and remember the
+    lastProcessedDateTime of the data they hold, so callers can tell
+    whether a refresh actually brought in new data.
+
+    Args:
+        ttl: Seconds for which a cached entry is considered fresh
+        max_entries: Number of phone numbers kept before the least
+            recently used one is evicted
+    """
+
+    def __init__(self, ttl=300, max_entries=64):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, phone_number, max_age=None):
+        """Return the cached usage dict, or None if missing or expired
+
+        Args:
+            phone_number: Phone number to look up
+            max_age: Seconds after which the entry is considered expired,
+                defaults to ttl
+        """
+        if max_age is None:
+            max_age = self.ttl
+        key = str(phone_number)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            stored_at, _, usage_dict = entry
+            if time.monotonic() - stored_at >= max_age:
+                return None
+            self._entries.move_to_end(key)
+            return usage_dict
+
+    def put(self, phone_number, usage_dict, age=0):
+        """Store usage_dict for phone_number
+
+        Args:
+            phone_number: Phone number the usage belongs to
+            usage_dict: usageDetail dict
+            age: Seconds since usage_dict was fetched
+
+        Returns:
+            True if the lastProcessedDateTime differs from the entry
+            being replaced (or there was none), False otherwise
+        """
+        key = str(phone_number)
+        processed = last_processed_key(usage_dict)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            self._entries[key] = (time.monotonic() - age, processed, usage_dict)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return previous is None or previous[1] != processed
+
+    def invalidate(self, phone_number):
+        with self._lock:
+            self._entries.pop(str(phone_number), None)
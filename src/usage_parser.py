@@ -0,0 +1,101 @@
+"""
+Typed records parsed from StarHub's usageDetail payload
+"""
+from datetime import date, datetime, timedelta, timezone
+
+# StarHub reports every date in Singapore time, which has no DST
+SGT = timezone(timedelta(hours=8))
+
+MB_PER_UNIT = {
+    'KB': 1. / 1024,
+    'MB': 1.,
+    'GB': 1024.
+}
+
+
+def to_mb(value, uom):
+    """Convert value expressed in uom to MB, None if either is missing"""
+    if value is None or uom is None:
+        return None
+    return float(value) * MB_PER_UNIT.get(uom, 1.)
+
+
+def parse_datetime(date_json):
+    """Build a (Singapore local, naive) datetime from a StarHub date object"""
+    return datetime(date_json['year'], date_json['month'], date_json['day'],
+                    date_json['hour'], date_json['minute'], date_json['second'])
+
+
+def parse_date(date_json):
+    return date(date_json['year'], date_json['month'], date_json['day'])
+
+
+def sg_today():
+    return datetime.now(SGT).date()
+
+
+class DailyUsage:
+    """Data used on a single day
+
+    Attributes:
+        date: datetime.date of the usage
+        usage_mb: Usage as reported in the 'usage' field (MB)
+        volume_mb: totalVolumeUsage converted to MB
+    """
+    __slots__ = ('date', 'usage_mb', 'volume_mb')
+
+    def __init__(self, date, usage_mb, volume_mb):
+        self.date = date
+        self.usage_mb = usage_mb
+        self.volume_mb = volume_mb
+
+    @classmethod
+    def from_json(cls, usage):
+        usage_mb = float(usage['usage'])
+        volume_mb = to_mb(usage.get('totalVolumeUsage'), usage.get('totalVolumeUsageUOM'))
+        return cls(parse_date(usage['usageDate']), usage_mb,
+                   usage_mb if volume_mb is None else volume_mb)
+
+
+class UsageRecord:
+    """A phone number's usageDetail with MB-normalized figures
+
+    The raw values and units are kept next to the MB figures since the
+    messages display them as StarHub reported them.
+
+    Raises:
+        KeyError: usage_dict lacks fromDateTime, lastProcessedDateTime or
+            one of the totals
+    """
+    __slots__ = ('service_id', 'from_datetime', 'last_processed', 'usage_percentage',
+                 'total_free_units', 'total_free_units_uom', 'total_free_mb',
+                 'total_usage', 'total_usage_uom', 'total_usage_mb',
+                 'usage_difference', 'difference_uom', 'usage_difference_mb',
+                 'daily')
+
+    def __init__(self, usage_dict):
+        self.service_id = str(usage_dict['usageServiceId'])
+        self.from_datetime = parse_datetime(usage_dict['fromDateTime'])
+        self.last_processed = parse_datetime(usage_dict['lastProcessedDateTime'])
+        self.usage_percentage = usage_dict.get('usagePercentage')
+
+        self.total_free_units = usage_dict['totalFreeUnits']
+        self.total_free_units_uom = usage_dict['totalFreeUnitsUOM']
+        self.total_free_mb = to_mb(self.total_free_units, self.total_free_units_uom)
+        self.total_usage = usage_dict['totalUsage']
+        self.total_usage_uom = usage_dict['totalUsageUOM']
+        self.total_usage_mb = to_mb(self.total_usage, self.total_usage_uom)
+        self.usage_difference = usage_dict.get('usageDifference')
+        self.difference_uom = usage_dict.get('differenceUOM')
+        self.usage_difference_mb = to_mb(self.usage_difference, self.difference_uom)
+
+        daily_usage = (usage_dict.get('dailyUsage') or {}).get('day') or []
+        self.daily = [DailyUsage.from_json(usage) for usage in daily_usage]
+
+    @property
+    def today_usage_mb(self):
+        return self.daily[-1].usage_mb if self.daily else 0.
+
+
+def parse_usage_detail(usage_dict):
+    return UsageRecord(usage_dict)
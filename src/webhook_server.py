@@ -0,0 +1,139 @@
+"""
+Webhook server acknowledging Telegram updates before they are processed
+"""
+import asyncio
+import collections
+import logging
+import queue
+import signal
+import threading
+import time
+
+from aiohttp import web
+from telegram import Update
+
+
+class WebhookServer:
+    """aiohttp webhook endpoint in front of a bounded pool of worker threads
+
+    Updates are acknowledged as soon as they are queued, so slow StarHub
+    requests never make Telegram time out and resend them. When the queue
+    is full the server answers 429 and Telegram retries later. Update ids
+    already received are acknowledged without being queued again.
+
+    On SIGTERM/SIGINT the server stops accepting updates, lets the workers
+    drain the queue for up to drain_timeout seconds and returns from run().
+
+    Args:
+        dispatcher: telegram.ext.Dispatcher processing the updates
+        url_path: Path Telegram posts updates to
+        host: Interface to listen on
+        port: Port to listen on
+        workers: Number of threads processing updates
+        queue_size: Updates waiting for a worker before backpressure applies
+        drain_timeout: Seconds allowed to finish queued updates on shutdown
+    """
+
+    def __init__(self, dispatcher, url_path, host='0.0.0.0', port=80, workers=4, queue_size=100,
+                 drain_timeout=30):
+        self.logger = logging.getLogger('webhook_server')
+        self.dispatcher = dispatcher
+        self.url_path = '/' + url_path.lstrip('/')
+        self.host = host
+        self.port = port
+        self.drain_timeout = drain_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._workers = [threading.Thread(target=self._work, name='webhook_worker_{}'.format(i), daemon=True)
+                         for i in range(workers)]
+        self._seen_update_ids = collections.deque(maxlen=1000)
+        self._seen_lock = threading.Lock()
+        self._draining = False
+
+        self.app = web.Application()
+        self.app.router.add_post(self.url_path, self.handle_update)
+        self.app.router.add_get('/healthz', self.handle_healthz)
+
+    def _work(self):
+        while True:
+            update = self._queue.get()
+            try:
+                if update is None:
+                    return
+                self.dispatcher.process_update(update)
+            except Exception:
+                self.logger.exception('Unable to process update')
+            finally:
+                self._queue.task_done()
+
+    def _is_duplicate(self, update_id):
+        with self._seen_lock:
+            if update_id in self._seen_update_ids:
+                return True
+            self._seen_update_ids.append(update_id)
+            return False
+
+    async def handle_update(self, request):
+        if self._draining:
+            return web.Response(status=503)
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+
+        update = Update.de_json(data, self.dispatcher.bot)
+        if update is None or self._is_duplicate(update.update_id):
+            return web.Response()
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            with self._seen_lock:
+                # Let Telegram's retry through once there is room
+                self._seen_update_ids.remove(update.update_id)
+            self.logger.warning('Update queue full, asking Telegram to retry')
+            return web.Response(status=429)
+        return web.Response()
+
+    async def handle_healthz(self, request):
+        alive = sum(worker.is_alive() for worker in self._workers)
+        healthy = alive == len(self._workers) and not self._draining
+        return web.json_response({
+            'status': 'ok' if healthy else 'unavailable',
+            'workers': alive,
+            'queued': self._queue.qsize(),
+        }, status=200 if healthy else 503)
+
+    def run(self):
+        """Serve until SIGTERM/SIGINT, then drain the queue and return"""
+        for worker in self._workers:
+            worker.start()
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        runner = web.AppRunner(self.app)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self.logger.info('Webhook server listening on %s:%d', self.host, self.port)
+
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, stop.set)
+        await stop.wait()
+
+        self.logger.info('Draining %d queued updates', self._queue.qsize())
+        self._draining = True
+        await loop.run_in_executor(None, self._drain)
+        await runner.cleanup()
+
+    def _drain(self):
+        deadline = time.monotonic() + self.drain_timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+        if self._queue.unfinished_tasks:
+            self.logger.warning('%d updates left unprocessed', self._queue.unfinished_tasks)
+        for _ in self._workers:
+            # Blocking put, the sentinels queue up behind pending updates
+            try:
+                self._queue.put(None, timeout=1)
+            except queue.Full:
+                break
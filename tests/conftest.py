@@ -0,0 +1,16 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'src'), os.path.join(ROOT, 'bench')]
+
+import pytest  # noqa: E402
+
+from mock_starhub import MockStarHub  # noqa: E402
+
+
+@pytest.fixture
+def mock_starhub():
+    mock = MockStarHub([91234567, 92345678, 93456789], latency=0.01).start()
+    yield mock
+    mock.stop()
@@ -0,0 +1,124 @@
+"""
+In-memory server speaking the part of RESP state_backend.RedisBackend uses
+"""
+import socket
+import socketserver
+import threading
+import time
+
+
+class FakeRedis:
+    """GET, SET (PX/NX), INCR, DECR, PEXPIRE and DEL on 127.0.0.1
+
+    drop(command) closes the connection once the next such command was
+    applied, instead of replying. close_connections() closes every client
+    connection, as a server timing out idle clients would.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.commands = []
+        self._drop = set()
+        self._connections = set()
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                with fake.lock:
+                    fake._connections.add(self.request)
+                try:
+                    while True:
+                        args = fake._read_command(self.rfile)
+                        if args is None:
+                            return
+                        reply = fake._execute(args)
+                        with fake.lock:
+                            if args[0].upper() in fake._drop:
+                                fake._drop.discard(args[0].upper())
+                                return
+                        self.wfile.write(reply)
+                except OSError:
+                    return
+                finally:
+                    with fake.lock:
+                        fake._connections.discard(self.request)
+
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), name='fake_redis', daemon=True).start()
+        return self
+
+    def stop(self):
+        self.close_connections()
+        self._server.shutdown()
+        self._server.server_close()
+
+    def drop(self, command):
+        with self.lock:
+            self._drop.add(command.upper())
+
+    def close_connections(self):
+        with self.lock:
+            for connection in self._connections:
+                connection.shutdown(socket.SHUT_RDWR)
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2].decode('utf-8'))
+        return args
+
+    def _live(self, key, now):
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= now:
+            del self.entries[key]
+            return None
+        return entry
+
+    def _execute(self, args):
+        command, args = args[0].upper(), args[1:]
+        with self.lock:
+            self.commands.append(command)
+            now = time.time()
+            if command in ('AUTH', 'SELECT'):
+                return b'+OK\r\n'
+            if command == 'GET':
+                entry = self._live(args[0], now)
+                return b'$-1\r\n' if entry is None else _bulk(entry[0])
+            if command == 'SET':
+                options = [option.upper() for option in args[2:]]
+                if 'NX' in options and self._live(args[0], now) is not None:
+                    return b'$-1\r\n'
+                expires_at = None
+                if 'PX' in options:
+                    expires_at = now + int(args[2 + options.index('PX') + 1]) / 1000.
+                self.entries[args[0]] = (args[1], expires_at)
+                return b'+OK\r\n'
+            if command in ('INCR', 'DECR'):
+                entry = self._live(args[0], now) or ('0', None)
+                value = int(entry[0]) + (1 if command == 'INCR' else -1)
+                self.entries[args[0]] = (str(value), entry[1])
+                return b':%d\r\n' % value
+            if command == 'PEXPIRE':
+                entry = self._live(args[0], now)
+                if entry is None:
+                    return b':0\r\n'
+                self.entries[args[0]] = (entry[0], now + int(args[1]) / 1000.)
+                return b':1\r\n'
+            if command == 'DEL':
+                return b':%d\r\n' % sum(self.entries.pop(key, None) is not None for key in args)
+            return b'-ERR unknown command\r\n'
+
+
+def _bulk(value):
+    value = value.encode('utf-8')
+    return b'$%d\r\n%s\r\n' % (len(value), value)
@@ -0,0 +1,80 @@
+import pytest
+
+import accounts
+from accounts import AccountRegistry, account_settings
+
+
+def settings(*accounts):
+    return account_settings({'accounts': [{'name': name, 'user_id': name, 'user_password': 'password',
+                                           'phone_numbers': phone_numbers}
+                                          for name, phone_numbers in accounts]})
+
+
+def test_reload_keeps_unchanged_accounts_and_shuts_down_the_others(mock_starhub):
+    registry = AccountRegistry(settings(('a', [91234567]), ('b', [92345678])))
+    kept, dropped = registry.accounts['a'], registry.accounts['b']
+    shut_down = []
+    dropped.shutdown = lambda: shut_down.append('b')
+
+    registry.reload(settings(('a', [91234567, 93456789])))
+
+    assert registry.accounts == {'a': kept}
+    assert registry.phone_numbers == [91234567, 93456789]
+    assert registry.has_number(93456789) and not registry.has_number(92345678)
+    assert shut_down == ['b']
+    registry.shutdown()
+
+
+def test_reload_grows_the_fan_out_pool(mock_starhub):
+    registry = AccountRegistry(settings(('a', [91234567])))
+
+    registry.reload(settings(('a', [91234567]), ('b', [92345678]), ('c', [93456789])))
+    for api in registry.accounts.values():
+        mock_starhub.point(api)
+    usage_by_number, errors_by_number = registry.get_phone_data_usage_batch([91234567, 92345678, 93456789])
+
+    assert registry._fan_out_size == 3
+    assert sorted(usage_by_number) == ['91234567', '92345678', '93456789']
+    assert errors_by_number == {}
+    registry.shutdown()
+
+
+def test_batch_reports_unknown_numbers(mock_starhub):
+    registry = AccountRegistry(settings(('a', [91234567])))
+    mock_starhub.point(registry.accounts['a'])
+
+    usage_by_number, errors_by_number = registry.get_phone_data_usage_batch([91234567, 92345678])
+
+    assert list(usage_by_number) == ['91234567']
+    assert isinstance(errors_by_number['92345678'], KeyError)
+    registry.shutdown()
+
+
+def test_failed_reload_applies_nothing(mock_starhub, monkeypatch):
+    registry = AccountRegistry(settings(('a', [91234567])))
+    kept = registry.accounts['a']
+    created = []
+
+    def starhub_api(**kwargs):
+        if kwargs['user_id'] == 'c':
+            raise TypeError('bad setting')
+        api = real_starhub_api(**kwargs)
+        api.shutdown = lambda: created.remove(api)
+        created.append(api)
+        return api
+    real_starhub_api = accounts.StarHubApi
+    monkeypatch.setattr(accounts, 'StarHubApi', starhub_api)
+
+    new_settings = settings(('a', [91234567]), ('b', [92345678]), ('c', [93456789]))
+    with pytest.raises(TypeError):
+        registry.reload(new_settings)
+    assert registry.accounts == {'a': kept}
+    assert registry.phone_numbers == [91234567]
+    assert created == []
+
+    # Retried in full once the setting is fixed
+    monkeypatch.setattr(accounts, 'StarHubApi', real_starhub_api)
+    registry.reload(new_settings)
+    assert sorted(registry.accounts) == ['a', 'b', 'c']
+    assert registry.account_for(93456789) is registry.accounts['c']
+    registry.shutdown()
@@ -0,0 +1,98 @@
+from datetime import date
+
+import pytest
+
+import alerts
+from mock_starhub import usage_detail
+
+# A Wednesday
+TODAY = date(2026, 6, 10)
+
+
+class FakeBot:
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, chat_id, text):
+        self.messages.append((chat_id, text))
+
+
+def usage(used_mb, hour=6, cycle_start=date(2026, 6, 1), today_mb=100.):
+    """20 GB plan with used_mb used so far, today_mb of it today"""
+    usage_dict = usage_detail(91234567, today=TODAY)
+    usage_dict['fromDateTime'].update(year=cycle_start.year, month=cycle_start.month, day=cycle_start.day)
+    usage_dict['lastProcessedDateTime']['hour'] = hour
+    usage_dict['dailyUsage']['day'][-1].update(usage=today_mb, totalVolumeUsage=today_mb)
+    usage_dict.update(totalUsage=used_mb, totalUsageUOM='MB',
+                      usageDifference=20 * 1024. - used_mb, differenceUOM='MB')
+    return usage_dict
+
+
+@pytest.fixture
+def engine(tmp_path, monkeypatch):
+    monkeypatch.setattr(alerts, 'sg_today', lambda: TODAY)
+    return alerts.AlertEngine(str(tmp_path / 'alerts.json'))
+
+
+def test_quota_alert_fires_once_per_cycle(engine):
+    engine.set_rule(1, 91234567, alerts.QUOTA, 80.)
+    bot = FakeBot()
+
+    engine.on_usage(91234567, usage(0.7 * 20 * 1024))
+    engine.flush(bot)
+    assert bot.messages == []
+
+    engine.on_usage(91234567, usage(0.85 * 20 * 1024, hour=7))
+    engine.on_usage(91234567, usage(0.9 * 20 * 1024, hour=8))
+    engine.flush(bot)
+    assert bot.messages == [(1, '⚠️ Data usage alert\n91234567 has used 85% of its 20 GB data')]
+
+    # The next billing cycle is a new period
+    engine.on_usage(91234567, usage(0.95 * 20 * 1024, hour=9, cycle_start=date(2026, 7, 1)))
+    engine.flush(bot)
+    assert len(bot.messages) == 2
+
+
+def test_unchanged_snapshot_is_not_evaluated(engine):
+    engine.set_rule(1, 91234567, alerts.QUOTA, 50.)
+    evaluated = []
+    evaluate = engine._evaluate
+    engine._evaluate = lambda *args: evaluated.append(args) or evaluate(*args)
+
+    engine.on_usage(91234567, usage(1024.))
+    engine.on_usage(91234567, usage(2048.))
+    assert len(evaluated) == 1
+    # A new rule re-evaluates the number
+    engine.set_rule(2, 91234567, alerts.QUOTA, 50.)
+    engine.on_usage(91234567, usage(2048.))
+    assert len(evaluated) == 3
+
+
+def test_daily_alert(engine):
+    engine.set_rule(1, 91234567, alerts.DAILY)
+    bot = FakeBot()
+
+    # About 19 GB left over 15 working days, roughly 1.4 GB a day
+    engine.on_usage(91234567, usage(1024., today_mb=1000.))
+    engine.flush(bot)
+    assert bot.messages == []
+
+    engine.on_usage(91234567, usage(1024., hour=7, today_mb=2000.))
+    engine.flush(bot)
+    assert len(bot.messages) == 1
+    assert bot.messages[0][1].startswith('⚠️ Data usage alert\n91234567 used 2000.00 MB today')
+
+
+def test_rules_and_fired_alerts_persist(engine, tmp_path, monkeypatch):
+    engine.set_rule(1, 91234567, alerts.QUOTA, 80.)
+    engine.on_usage(91234567, usage(0.9 * 20 * 1024))
+
+    restarted = alerts.AlertEngine(str(tmp_path / 'alerts.json'))
+    assert restarted.rules_for(1) == {'91234567': {alerts.QUOTA: 80.}}
+    bot = FakeBot()
+    restarted.on_usage(91234567, usage(0.95 * 20 * 1024, hour=7))
+    restarted.flush(bot)
+    assert bot.messages == []
+
+    restarted.remove_rules(1)
+    assert restarted.rules_for(1) == {}
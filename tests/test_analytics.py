@@ -0,0 +1,61 @@
+from datetime import date, timedelta
+
+import pytest
+
+from analytics import forecast_cycle, rolling_mean
+from usage_parser import DailyUsage
+
+# A Monday
+TODAY = date(2026, 6, 8)
+
+
+def history(days, weekday_mb, weekend_mb):
+    """DailyUsage of the days before TODAY, oldest first"""
+    dates = [TODAY - timedelta(days=offset) for offset in range(days, 0, -1)]
+    return [DailyUsage(day, 0., weekday_mb if day.weekday() < 5 else weekend_mb) for day in dates]
+
+
+def test_rolling_mean_of_a_linear_series():
+    assert list(rolling_mean([1., 2., 3., 4., 5., 6.], 3)) == [2., 3., 4., 5.]
+    # Shorter series use all their values
+    assert list(rolling_mean([1., 2.], 7)) == [1.5]
+
+
+def test_forecast_models_weekdays_and_weekends():
+    # Today's usage is still being counted and must be ignored
+    daily_usage = history(14, 100., 40.) + [DailyUsage(TODAY, 0., 5000.)]
+
+    forecast = forecast_cycle(daily_usage, used_mb=1000., quota_mb=1300., today=TODAY,
+                              cycle_end=TODAY + timedelta(days=7))
+
+    assert forecast.weekday_avg_mb == 100.
+    assert forecast.weekend_avg_mb == 40.
+    assert forecast.rolling_avg_mb == pytest.approx((5 * 100. + 2 * 40.) / 7)
+    # 5 weekdays and 2 weekend days left, no spread in the samples
+    assert forecast.projected_total_mb == 1000. + 5 * 100. + 2 * 40.
+    assert forecast.projected_low_mb == forecast.projected_high_mb == forecast.projected_total_mb
+    # 1100 on Monday, 1200 on Tuesday, 1300 on Wednesday
+    assert forecast.exhausted_on == TODAY + timedelta(days=2)
+
+
+def test_forecast_interval_and_quota():
+    daily_usage = [DailyUsage(TODAY - timedelta(days=offset), 0., 50. + 10 * (offset % 2))
+                   for offset in range(14, 0, -1)]
+
+    forecast = forecast_cycle(daily_usage, used_mb=100., quota_mb=10000., today=TODAY,
+                              cycle_end=TODAY + timedelta(days=10))
+
+    assert forecast.projected_low_mb < forecast.projected_total_mb < forecast.projected_high_mb
+    assert forecast.exhausted_on is None
+
+    exhausted = forecast_cycle(daily_usage, used_mb=10000., quota_mb=10000., today=TODAY,
+                               cycle_end=TODAY + timedelta(days=10))
+    assert exhausted.exhausted_on == TODAY
+
+
+def test_forecast_without_history():
+    forecast = forecast_cycle([], used_mb=0., quota_mb=1000., today=TODAY, cycle_end=TODAY + timedelta(days=3))
+
+    assert forecast.rolling_avg_mb == 0.
+    assert forecast.projected_total_mb == 0.
+    assert forecast.exhausted_on is None
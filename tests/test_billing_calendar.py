@@ -0,0 +1,53 @@
+from datetime import date, timedelta
+
+import pytest
+
+from billing_calendar import SG_PUBLIC_HOLIDAYS, BillingCycle, add_months, count_weekday_holidays, count_weekdays
+
+
+def days(start, end):
+    return [start + timedelta(days=offset) for offset in range((end - start).days + 1)]
+
+
+@pytest.mark.parametrize('start', days(date(2024, 1, 1), date(2024, 1, 7)))
+def test_count_weekdays_matches_brute_force(start):
+    for length in range(-1, 60):
+        end = start + timedelta(days=length)
+        assert count_weekdays(start, end) == sum(1 for day in days(start, end) if day.weekday() < 5)
+
+
+def test_count_weekday_holidays_matches_brute_force():
+    for start in days(date(2023, 12, 1), date(2027, 1, 31))[::11]:
+        for length in (-1, 0, 6, 30, 400):
+            end = start + timedelta(days=length)
+            expected = sum(1 for day in days(start, end) if day in SG_PUBLIC_HOLIDAYS and day.weekday() < 5)
+            assert count_weekday_holidays(start, end) == expected
+
+
+def test_sunday_holidays_have_a_monday_in_lieu():
+    for holiday in SG_PUBLIC_HOLIDAYS:
+        if holiday.weekday() == 6:
+            assert holiday + timedelta(days=1) in SG_PUBLIC_HOLIDAYS
+
+
+def test_add_months_clamps_to_month_end():
+    assert add_months(date(2024, 1, 31), 1) == date(2024, 2, 29)
+    assert add_months(date(2025, 1, 31), 1) == date(2025, 2, 28)
+    assert add_months(date(2024, 12, 15), 1) == date(2025, 1, 15)
+
+
+def test_billing_cycle_working_days():
+    # 10/05/2026 to 09/06/2026, Vesak Day (27/05) and its Monday in lieu (01/06) fall on weekdays
+    cycle = BillingCycle(date(2026, 5, 10))
+    with_holidays = BillingCycle(date(2026, 5, 10), exclude_holidays=True)
+
+    assert cycle.end == date(2026, 6, 10)
+    assert cycle.total_working_days == 22
+    assert with_holidays.total_working_days == 20
+    assert cycle.working_days_left(date(2026, 5, 10)) == 22
+    assert cycle.working_days_left(date(2026, 6, 9)) == 1
+    # 01/06 is itself a holiday
+    assert with_holidays.working_days_left(date(2026, 6, 1)) == 6
+    # Today's usage is only added back on a working day
+    assert cycle.daily_limit_mb(900, 100, date(2026, 6, 9)) == 1000
+    assert cycle.daily_limit_mb(900, 100, date(2026, 6, 7)) == 900 / 2
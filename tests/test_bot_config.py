@@ -0,0 +1,58 @@
+import json
+
+from bot_config import BotConfig, ConfigWatcher
+
+
+def write(path, phone_numbers):
+    path.write_text(json.dumps({'telegram_token': 'token', 'whitelisted_user_names': [1],
+                                'user_id': 'user', 'user_password': 'password',
+                                'phone_numbers': phone_numbers}))
+
+
+def test_failed_apply_is_retried(tmp_path):
+    path = tmp_path / 'config.json'
+    write(path, [91234567])
+    applied = []
+    failures = [RuntimeError('reload failed')]
+
+    def on_change(config):
+        if failures:
+            raise failures.pop()
+        applied.append(config.phone_numbers)
+
+    watcher = ConfigWatcher(str(path), on_change)
+    write(path, [91234567, 92345678])
+    watcher.check()
+    assert applied == []
+    watcher.check()
+    assert applied == [[91234567, 92345678]]
+    watcher.check()
+    assert len(applied) == 1
+
+
+def test_invalid_file_keeps_current_config(tmp_path):
+    path = tmp_path / 'config.json'
+    write(path, [91234567])
+    applied = []
+    watcher = ConfigWatcher(str(path), applied.append)
+
+    path.write_text('{')
+    watcher.check()
+    assert applied == []
+    write(path, [92345678])
+    watcher.check()
+    assert applied[0].has_number('92345678')
+
+
+def test_reload_keeps_restart_keys():
+    base = {'telegram_token': 'token', 'whitelisted_user_names': [1], 'user_id': 'user',
+            'user_password': 'password', 'phone_numbers': [91234567]}
+    running = BotConfig(dict(base, exclude_public_holidays=True, batch_timeout=30))
+    new = BotConfig(dict(base, phone_numbers=[92345678], batch_timeout=10))
+
+    applied = new.with_restart_keys_of(running)
+
+    assert running.restart_required(new) == ['exclude_public_holidays']
+    assert applied.get('exclude_public_holidays') is True
+    assert applied.get('batch_timeout') == 10
+    assert applied.has_number(92345678)
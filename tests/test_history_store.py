@@ -0,0 +1,53 @@
+import sqlite3
+from datetime import date
+
+from history_store import UsageHistoryStore
+from mock_starhub import usage_detail
+
+TODAY = date(2026, 6, 3)
+
+
+def usage(hour=6):
+    """Three days of usage, totalVolumeUsage in GB and differing from 'usage'"""
+    usage_dict = usage_detail(91234567, today=TODAY)
+    usage_dict['lastProcessedDateTime']['hour'] = hour
+    for index, day in enumerate(usage_dict['dailyUsage']['day']):
+        day.update(usage=100. * (index + 1), totalVolumeUsage=0.5 * (index + 1), totalVolumeUsageUOM='GB')
+    return usage_dict
+
+
+def test_both_daily_figures_are_kept(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    store = UsageHistoryStore(path)
+
+    assert store.ingest(91234567, usage()) == 3
+    # Same lastProcessedDateTime, skipped; same figures, nothing rewritten
+    assert store.ingest(91234567, usage()) == 0
+    assert store.ingest(91234567, usage(hour=7)) == 0
+    store.close()
+
+    history = UsageHistoryStore(path).query(91234567, date(2026, 6, 1), date(2026, 6, 2))
+    assert [(day.date, day.usage_mb, day.volume_mb) for day in history] == [
+        (date(2026, 6, 1), 100., 512.), (date(2026, 6, 2), 200., 1024.)]
+
+
+def test_stores_without_volume_are_upgraded(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.execute('''
+            CREATE TABLE daily_usage (
+                phone_number TEXT NOT NULL,
+                usage_date TEXT NOT NULL,
+                usage_mb REAL NOT NULL,
+                PRIMARY KEY (phone_number, usage_date)
+            ) WITHOUT ROWID''')
+        conn.execute("INSERT INTO daily_usage VALUES ('91234567', '2026-05-31', 42.0)")
+    conn.close()
+
+    store = UsageHistoryStore(path)
+    store.ingest(91234567, usage())
+    history = store.query(91234567, date(2026, 5, 31), date(2026, 6, 1))
+    store.close()
+
+    assert [(day.usage_mb, day.volume_mb) for day in history] == [(42., 42.), (100., 512.)]
@@ -0,0 +1,74 @@
+from types import SimpleNamespace
+
+import pytest
+
+import alerts
+import main
+from mock_starhub import usage_detail
+from rate_limit import RateLimiter
+
+
+class FakeMessage:
+    def __init__(self):
+        self.replies = []
+
+    def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+
+
+class FakeAccounts:
+    phone_numbers = [91234567]
+
+    def has_number(self, phone_number):
+        return str(phone_number) == '91234567'
+
+
+@pytest.fixture
+def alert_engine(tmp_path, monkeypatch):
+    engine = alerts.AlertEngine(str(tmp_path / 'alerts.json'))
+    monkeypatch.setattr(main, 'alert_engine', engine)
+    monkeypatch.setattr(main, 'accounts', FakeAccounts())
+    return engine
+
+
+def alert(*args):
+    update = SimpleNamespace(effective_chat=SimpleNamespace(id=1), message=FakeMessage())
+    main.alert_handler(update, SimpleNamespace(args=list(args)))
+    return update.message.replies
+
+
+@pytest.mark.parametrize('threshold', ['abc', 'nan', '-1', '100.5'])
+def test_alert_rejects_invalid_threshold(alert_engine, threshold):
+    assert alert('91234567', 'quota', threshold) == [main.ALERT_USAGE]
+    assert alert_engine.rules_for(1) == {}
+
+
+def test_alert_sets_quota_threshold(alert_engine):
+    alert('all', 'quota', '90')
+    assert alert_engine.rules_for(1) == {'91234567': {alerts.QUOTA: 90.}}
+
+
+def test_throttle_ignores_users_outside_the_whitelist(monkeypatch):
+    limiter = RateLimiter(user_rate=1, user_burst=1, number_rate=1, number_burst=1)
+    monkeypatch.setattr(main, 'rate_limiter', limiter)
+    monkeypatch.setattr(main, 'config', SimpleNamespace(is_whitelisted=lambda user: user.id == 1))
+    message = FakeMessage()
+    update = SimpleNamespace(effective_user=SimpleNamespace(id=2), callback_query=None,
+                             message=SimpleNamespace(text='/usage 91234567', reply_text=message.reply_text))
+
+    for _ in range(3):
+        main.throttle_handler(update, None)
+
+    assert message.replies == []
+    assert limiter.allow(1, 91234567) == 0
+
+
+def test_all_usage_summary_survives_incomplete_records(monkeypatch):
+    monkeypatch.setattr(main, 'accounts', SimpleNamespace(phone_numbers=[91234567, 92345678]))
+    incomplete = usage_detail(92345678)
+    del incomplete['fromDateTime']
+
+    text = main.format_all_usage_message({'91234567': usage_detail(91234567), '92345678': incomplete})
+
+    assert text.split('*92345678*')[1].strip() == 'Unable to retrieve data usage'
+    assert 'Used:' in text.split('*92345678*')[0]
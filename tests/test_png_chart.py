@@ -0,0 +1,65 @@
+import struct
+import zlib
+
+import png_chart
+
+
+def decode(png):
+    """(width, height, rows of palette indices), checking every chunk"""
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    chunks = []
+    offset = 8
+    while offset < len(png):
+        length, = struct.unpack('>I', png[offset:offset + 4])
+        kind, data = png[offset + 4:offset + 8], png[offset + 8:offset + 8 + length]
+        crc, = struct.unpack('>I', png[offset + 8 + length:offset + 12 + length])
+        assert crc == zlib.crc32(kind + data) & 0xffffffff
+        chunks.append((kind, data))
+        offset += 12 + length
+
+    assert [kind for kind, _ in chunks] == [b'IHDR', b'PLTE', b'IDAT', b'IEND']
+    width, height, bit_depth, color_type, _, _, _ = struct.unpack('>IIBBBBB', chunks[0][1])
+    assert (bit_depth, color_type) == (8, 3)
+    assert chunks[1][1] == png_chart.PALETTE
+    raw = zlib.decompress(chunks[2][1])
+    assert len(raw) == height * (width + 1)
+    rows = [raw[y * (width + 1):(y + 1) * (width + 1)] for y in range(height)]
+    # No filtering, every row starts with filter type 0
+    assert all(row[0] == 0 for row in rows)
+    return width, height, [row[1:] for row in rows]
+
+
+def bar_heights(width, rows):
+    """Height of each bar, from left to right"""
+    columns = [sum(row[x] == png_chart.BAR for row in rows) for x in range(width)]
+    heights = []
+    previous = 0
+    for column in columns:
+        if column and not previous:
+            heights.append(column)
+        previous = column
+    return heights
+
+
+def test_bars_are_proportional():
+    width, height, rows = decode(png_chart.render_bar_chart('Usage', ['01/06', '02/06', '03/06', '04/06'],
+                                                            [100., 50., 0., 25.], height=300))
+
+    assert height == 300
+    tallest, half, quarter = bar_heights(width, rows)
+    assert abs(half - tallest / 2.) <= 1
+    assert abs(quarter - tallest / 4.) <= 1
+    assert any(pixel == png_chart.TEXT for row in rows for pixel in row)
+
+
+def test_empty_chart():
+    width, height, rows = decode(png_chart.render_bar_chart('No usage', [], []))
+
+    assert width >= 160
+    assert bar_heights(width, rows) == []
+
+
+def test_text_width():
+    assert png_chart.text_width('') == 0
+    assert png_chart.text_width('AB') == 7
+    assert png_chart.text_width('AB', scale=2) == 14
@@ -0,0 +1,69 @@
+from prefetch import UsagePrefetcher
+
+
+class FakeApi:
+    http_timeout = 10
+
+    def __init__(self):
+        self.failing = set()
+        self.timeouts = []
+
+    def get_phone_data_usage_batch(self, phone_numbers, fresh=False, timeout=None, max_age=None):
+        self.timeouts.append(timeout)
+        usage_by_number = {str(number): {} for number in phone_numbers if str(number) not in self.failing}
+        errors_by_number = {str(number): RuntimeError('failed') for number in phone_numbers
+                            if str(number) in self.failing}
+        return usage_by_number, errors_by_number
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.scheduled = []
+
+    def run_once(self, callback, when, name=None):
+        self.scheduled.append((callback, when))
+
+
+class FakeContext:
+    def __init__(self):
+        self.job_queue = FakeJobQueue()
+
+
+def test_snapshot_age_follows_each_number_last_refresh():
+    api = FakeApi()
+    prefetcher = UsagePrefetcher(api, [91234567, 92345678], batch_timeout=12)
+
+    assert prefetcher.snapshot_max_age([91234567]) is None
+
+    prefetcher._refresh(FakeContext())
+    assert api.timeouts == [12]
+    assert 0 <= prefetcher.snapshot_max_age([91234567, 92345678]) < 1
+
+    api.failing.add('92345678')
+    prefetcher._refresh(FakeContext())
+    assert prefetcher.snapshot_max_age([91234567]) is not None
+    assert prefetcher.snapshot_max_age([92345678]) is None
+    assert prefetcher.snapshot_max_age([91234567, 92345678]) is None
+
+
+def test_overdue_refresh_falls_back_to_cache_ttl():
+    prefetcher = UsagePrefetcher(FakeApi(), [91234567], max_interval=600)
+    prefetcher._refresh(FakeContext())
+
+    prefetcher._refreshed_at['91234567'] -= 600 * 1.1 + 20 + 1
+
+    assert prefetcher.snapshot_max_age([91234567]) is None
+
+
+def test_refresh_is_rescheduled_after_an_exception():
+    api = FakeApi()
+    prefetcher = UsagePrefetcher(api, [91234567], min_interval=300, jitter=0)
+
+    def fail(*args, **kwargs):
+        raise KeyError('91234567')
+    api.get_phone_data_usage_batch = fail
+    context = FakeContext()
+    prefetcher._refresh(context)
+
+    assert context.job_queue.scheduled == [(prefetcher._refresh, 300)]
+    assert prefetcher.snapshot_max_age([91234567]) is None
@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from rate_limit import RateLimiter
+from state_backend import MemoryBackend, SQLiteBackend
+
+
+@pytest.fixture
+def replicas(tmp_path, monkeypatch):
+    """Two limiters sharing a SQLite backend, in the middle of a minute"""
+    now = 60 * 100000 + 30.
+    monkeypatch.setattr(time, 'time', lambda: now)
+    path = str(tmp_path / 'state.sqlite3')
+    backends = [SQLiteBackend(path), SQLiteBackend(path)]
+    yield [RateLimiter(user_rate=2, number_rate=3, duplicate_window=3, state=backend)
+           for backend in backends]
+    for backend in backends:
+        backend.close()
+
+
+def test_user_window_is_shared(replicas):
+    first, second = replicas
+    assert first.allow(1) == 0
+    assert second.allow(1) == 0
+    assert first.allow(1) == 30.
+    assert second.allow(2) == 0
+
+
+def test_number_window_is_shared(replicas):
+    first, second = replicas
+    assert first.allow(1, 91234567) == 0
+    assert second.allow(2, 91234567) == 0
+    assert first.allow(3, 91234567) == 0
+    assert second.allow(4, 91234567) == 30.
+    assert second.allow(4, 92345678) == 0
+
+
+def test_refused_number_gives_the_user_request_back(replicas):
+    first, second = replicas
+    for user_id in (1, 2, 3):
+        assert first.allow(user_id, 91234567) == 0
+    # Refused by the number's window, user 4 keeps its own two requests
+    assert second.allow(4, 91234567) == 30.
+    assert second.allow(4, 92345678) == 0
+    assert second.allow(4, 92345678) == 0
+    assert second.allow(4, 92345678) == 30.
+
+
+def test_duplicate_callback_is_shared(replicas):
+    first, second = replicas
+    assert not first.is_duplicate_callback(1, 'u-91234567')
+    assert second.is_duplicate_callback(1, 'u-91234567')
+    assert not second.is_duplicate_callback(2, 'u-91234567')
+    assert not second.is_duplicate_callback(1, 'h-91234567')
+
+
+def test_local_state_uses_token_buckets():
+    limiter = RateLimiter(user_rate=60, user_burst=2, state=MemoryBackend())
+    assert limiter.state is None
+    assert limiter.allow(1) == 0
+    assert limiter.allow(1) == 0
+    assert 0 < limiter.allow(1) <= 1
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+import requests
+
+from starhub_api import CircuitOpenError, StarHubApi, StarHubApiException
+from state_backend import SQLiteBackend
+
+
+class FakeResponse:
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakeSend:
+    """send() replaying the given status codes, exceptions are raised"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def __call__(self):
+        outcome = self.outcomes[min(self.calls, len(self.outcomes) - 1)]
+        self.calls += 1
+        if isinstance(outcome, Exception):
+            raise outcome
+        return FakeResponse(outcome)
+
+
+def create_api(**kwargs):
+    settings = dict(retry_max_attempts=3, retry_base_delay=0.001, retry_max_delay=0.001,
+                    circuit_failure_threshold=5, circuit_reset_timeout=60)
+    settings.update(kwargs)
+    return StarHubApi('user@example.com', 'password', **settings)
+
+
+def test_unauthorized_logs_in_again():
+    api = create_api()
+    send = FakeSend(401, 200)
+    logins = []
+
+    res = api._send_with_retry('usage', send, on_unauthorized=lambda: logins.append(1))
+
+    assert res.status_code == 200
+    assert send.calls == 2
+    assert logins == [1]
+
+
+def test_client_error_is_not_retried():
+    api = create_api()
+    send = FakeSend(404, 200)
+
+    assert api._send_with_retry('usage', send).status_code == 404
+    assert send.calls == 1
+
+
+def test_server_errors_exhaust_attempts():
+    api = create_api()
+    send = FakeSend(503)
+
+    assert api._send_with_retry('usage', send).status_code == 503
+    assert send.calls == 3
+
+
+def test_network_errors_exhaust_attempts():
+    api = create_api()
+    send = FakeSend(requests.ConnectionError('refused'))
+
+    with pytest.raises(requests.ConnectionError):
+        api._send_with_retry('usage', send)
+    assert send.calls == 3
+
+
+def test_circuit_opens_and_fails_fast():
+    api = create_api(circuit_failure_threshold=2)
+    send = FakeSend(503)
+
+    # Retries stop as soon as the circuit opens
+    assert api._send_with_retry('usage', send).status_code == 503
+    assert send.calls == 2
+    assert api.circuit_breaker.is_open
+
+    with pytest.raises(CircuitOpenError):
+        api._send_with_retry('usage', send)
+    assert send.calls == 2
+
+
+def test_half_open_trial():
+    api = create_api(circuit_failure_threshold=1, circuit_reset_timeout=0.05)
+    api._send_with_retry('usage', FakeSend(503))
+    assert api.circuit_breaker.is_open
+
+    # A failed trial keeps the circuit open for another reset_timeout
+    time.sleep(0.06)
+    failed_trial = FakeSend(503)
+    assert api._send_with_retry('usage', failed_trial).status_code == 503
+    assert failed_trial.calls == 1
+    with pytest.raises(CircuitOpenError):
+        api._send_with_retry('usage', FakeSend(200))
+
+    # A successful trial closes it
+    time.sleep(0.06)
+    assert api._send_with_retry('usage', FakeSend(200)).status_code == 200
+    assert not api.circuit_breaker.is_open
+    assert api._send_with_retry('usage', FakeSend(200)).status_code == 200
+
+
+@pytest.fixture
+def replicas(tmp_path):
+    """Two replicas of one account sharing a SQLite backend"""
+    path = str(tmp_path / 'state.sqlite3')
+    backends = [SQLiteBackend(path), SQLiteBackend(path)]
+    yield [create_api(state=backend, utoken_lease_ttl=0.05) for backend in backends]
+    for backend in backends:
+        backend.close()
+
+
+def test_utoken_lease_is_exclusive(replicas):
+    first, second = replicas
+    deadline = time.monotonic() + 60
+
+    assert first._try_utoken_lease(deadline) == (True, None)
+    assert second._try_utoken_lease(deadline) == (False, None)
+    with pytest.raises(StarHubApiException):
+        second._try_utoken_lease(time.monotonic())
+
+    # The holder's u_token is adopted instead of logging in again
+    first._store_utoken({'userDetails': {'utoken': 'abc'}})
+    first.state.delete(first._lease_key, first._replica_id)
+    assert second._try_utoken_lease(deadline) == (False, 'abc')
+
+
+def test_utoken_lease_expires(replicas):
+    first, second = replicas
+    deadline = time.monotonic() + 60
+
+    assert first._try_utoken_lease(deadline) == (True, None)
+    # A holder that died without logging in blocks the others for utoken_lease_ttl at most
+    time.sleep(0.06)
+    assert second._try_utoken_lease(deadline) == (True, None)
+    # Releasing an expired lease leaves the new holder's in place
+    first.state.delete(first._lease_key, first._replica_id)
+    assert first._try_utoken_lease(deadline) == (False, None)
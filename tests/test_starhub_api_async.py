@@ -0,0 +1,88 @@
+import asyncio
+import threading
+
+from accounts import account_settings
+from starhub_api_async import AsyncStarHubApi
+from state_backend import create_backend
+
+
+def test_batch_returns_usage_and_errors(mock_starhub):
+    async def run():
+        async with mock_starhub.point(AsyncStarHubApi('user', 'password', batch_concurrency=2)) as api:
+            return await api.get_phone_data_usage_batch([91234567, 92345678, 93456789, 99999999])
+
+    usage_by_number, errors_by_number = asyncio.run(run())
+
+    assert sorted(usage_by_number) == ['91234567', '92345678', '93456789']
+    assert all(isinstance(usage, dict) for usage in usage_by_number.values())
+    assert list(errors_by_number) == ['99999999']
+    assert mock_starhub.calls['esso_login'] == 1
+
+
+def test_batch_timeout_reports_pending_numbers(mock_starhub):
+    mock_starhub.latency = 0.5
+
+    async def run():
+        async with mock_starhub.point(AsyncStarHubApi('user', 'password')) as api:
+            return await api.get_phone_data_usage_batch([91234567], timeout=0.1)
+
+    usage_by_number, errors_by_number = asyncio.run(run())
+
+    assert usage_by_number == {}
+    assert isinstance(errors_by_number['91234567'], asyncio.TimeoutError)
+
+
+def test_built_from_account_settings():
+    settings = account_settings({'user_id': 'user', 'user_password': 'password', 'phone_numbers': [91234567],
+                                 'batch_concurrency': 8, 'http_pool_size': 2})
+
+    api = AsyncStarHubApi(**settings[0]['api'])
+
+    assert api.batch_concurrency == 8
+    assert api.http_pool_size == 2
+
+
+def test_replicas_sharing_state_log_in_once(mock_starhub, tmp_path):
+    url = 'sqlite:///' + str(tmp_path / 'state.sqlite3')
+
+    async def run():
+        apis = [mock_starhub.point(AsyncStarHubApi('user', 'password', state=create_backend(url)))
+                for _ in range(3)]
+        try:
+            return await asyncio.gather(*(api.get_phone_data_usage(91234567) for api in apis))
+        finally:
+            for api in apis:
+                await api.close()
+
+    results = asyncio.run(run())
+
+    assert all(usage['usageServiceId'] == '91234567' for usage in results)
+    assert mock_starhub.calls['esso_login'] == 1
+
+
+def test_usage_listeners_run_off_the_loop(mock_starhub):
+    threads = []
+
+    async def run():
+        async with mock_starhub.point(AsyncStarHubApi('user', 'password')) as api:
+            api.add_usage_listener(lambda phone_number, usage_dict: threads.append(threading.get_ident()))
+            await api.get_phone_data_usage(91234567)
+            return threading.get_ident()
+
+    loop_thread = asyncio.run(run())
+
+    assert len(threads) == 1 and threads[0] != loop_thread
+
+
+def test_shutdown_closes_the_session(mock_starhub):
+    loop = asyncio.new_event_loop()
+    api = mock_starhub.point(AsyncStarHubApi('user', 'password'))
+    loop.run_until_complete(api.get_phone_data_usage(91234567))
+    client = api._client
+
+    api.shutdown()
+
+    assert client.closed
+    loop.close()
+    # Nothing left to release
+    api.shutdown()
@@ -0,0 +1,129 @@
+import time
+
+import pytest
+
+from fake_redis import FakeRedis
+from state_backend import MemoryBackend, RedisBackend, SQLiteBackend, create_backend
+
+
+@pytest.fixture
+def fake_redis():
+    server = FakeRedis().start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        backend = create_backend('memory')
+    elif request.param == 'sqlite':
+        backend = create_backend('sqlite:///' + str(tmp_path / 'state.sqlite3'))
+    else:
+        backend = create_backend('redis://127.0.0.1:{}'.format(request.getfixturevalue('fake_redis').port))
+    yield backend
+    if hasattr(backend, 'close'):
+        backend.close()
+
+
+def test_create_backend(tmp_path):
+    assert isinstance(create_backend(None), MemoryBackend)
+    backend = create_backend('sqlite:///' + str(tmp_path / 'state.sqlite3'))
+    assert isinstance(backend, SQLiteBackend)
+    backend.close()
+    assert (tmp_path / 'state.sqlite3').exists()
+    with pytest.raises(ValueError):
+        create_backend('ftp://localhost')
+
+
+def test_set_and_get(backend):
+    assert backend.get('tokens') is None
+    backend.set('tokens', {'u_token': 'abc', 'issued_at': 1.5})
+    assert backend.get('tokens') == {'u_token': 'abc', 'issued_at': 1.5}
+    backend.set('ttl', 1, ttl=0.05)
+    time.sleep(0.06)
+    assert backend.get('ttl') is None
+
+
+def test_add(backend):
+    assert backend.add('lease', 'a', ttl=0.05)
+    assert not backend.add('lease', 'b', ttl=0.05)
+    assert backend.get('lease') == 'a'
+    # An expired key can be added again
+    time.sleep(0.06)
+    assert backend.add('lease', 'b')
+    assert backend.get('lease') == 'b'
+
+
+def test_incr(backend):
+    assert [backend.incr('counter', ttl=0.05) for _ in range(3)] == [1, 2, 3]
+    # The ttl runs from the counter's creation, increments do not extend it
+    time.sleep(0.06)
+    assert backend.incr('counter', ttl=0.05) == 1
+    assert backend.incr('forever') == 1
+    assert backend.incr('forever') == 2
+
+
+def test_decr(backend):
+    backend.incr('counter', ttl=0.05)
+    backend.incr('counter', ttl=0.05)
+    backend.decr('counter')
+    assert backend.incr('counter', ttl=0.05) == 2
+    # A counter that expired is not recreated
+    time.sleep(0.06)
+    backend.decr('counter')
+    assert backend.get('counter') is None
+
+
+def test_delete(backend):
+    backend.set('lease', 'a')
+    backend.delete('lease', 'b')
+    assert backend.get('lease') == 'a'
+    backend.delete('lease', 'a')
+    assert backend.get('lease') is None
+    backend.set('lease', 'a')
+    backend.delete('lease')
+    assert backend.get('lease') is None
+    backend.delete('missing')
+
+
+def test_sqlite_is_shared(tmp_path):
+    path = str(tmp_path / 'state.sqlite3')
+    first, second = SQLiteBackend(path), SQLiteBackend(path)
+    assert first.shared
+    assert first.add('lease', 'first')
+    assert not second.add('lease', 'second')
+    assert second.incr('counter') == 1
+    assert first.incr('counter') == 2
+    first.close()
+    second.close()
+
+
+def test_redis_retries_idempotent_commands(fake_redis):
+    backend = RedisBackend(port=fake_redis.port)
+    backend.set('tokens', {'u_token': 'abc'})
+    fake_redis.drop('GET')
+    assert backend.get('tokens') == {'u_token': 'abc'}
+    backend.close()
+
+
+def test_redis_never_applies_incr_twice(fake_redis):
+    backend = RedisBackend(port=fake_redis.port)
+    assert backend.incr('counter') == 1
+    # The reply is lost once the server applied the INCR
+    fake_redis.drop('INCR')
+    with pytest.raises(OSError):
+        backend.incr('counter')
+    assert backend.get('counter') == 2
+    assert fake_redis.commands.count('INCR') == 2
+    backend.close()
+
+
+def test_redis_reconnects_before_writing_to_a_closed_connection(fake_redis):
+    backend = RedisBackend(port=fake_redis.port)
+    assert backend.incr('counter') == 1
+    fake_redis.close_connections()
+    time.sleep(0.05)
+    assert backend.incr('counter') == 2
+    assert fake_redis.commands.count('INCR') == 2
+    backend.close()
@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from webhook_server import WebhookServer
+
+
+class FakeDispatcher:
+    bot = None
+
+    def __init__(self):
+        self.processed = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def process_update(self, update):
+        self.release.wait(5)
+        self.processed.append(update.update_id)
+
+
+def update(update_id):
+    return {'update_id': update_id,
+            'message': {'message_id': 1, 'date': 0, 'chat': {'id': 1, 'type': 'private'}, 'text': '/usage'}}
+
+
+def serve(server, scenario):
+    """Run scenario(client) against server.app"""
+    async def run():
+        async with TestClient(TestServer(server.app)) as client:
+            await scenario(client)
+    asyncio.run(run())
+
+
+def test_full_queue_asks_telegram_to_retry():
+    # Workers are not started, updates stay queued
+    server = WebhookServer(FakeDispatcher(), 'token', workers=1, queue_size=1)
+
+    async def scenario(client):
+        assert (await client.post('/token', json=update(1))).status == 200
+        # Already received, acknowledged without being queued again
+        assert (await client.post('/token', json=update(1))).status == 200
+        assert (await client.post('/token', json=update(2))).status == 429
+        assert server._queue.qsize() == 1
+
+        server._queue.get()
+        server._queue.task_done()
+        # The refused update was not recorded as seen, its retry is queued
+        assert (await client.post('/token', json=update(2))).status == 200
+        assert server._queue.get().update_id == 2
+
+    serve(server, scenario)
+
+
+def test_invalid_body():
+    server = WebhookServer(FakeDispatcher(), 'token')
+
+    async def scenario(client):
+        assert (await client.post('/token', data=b'{')).status == 400
+        assert server._queue.qsize() == 0
+
+    serve(server, scenario)
+
+
+def test_healthz_and_drain():
+    dispatcher = FakeDispatcher()
+    dispatcher.release.clear()
+    server = WebhookServer(dispatcher, 'token', workers=2, queue_size=10, drain_timeout=5)
+
+    async def scenario(client):
+        assert (await client.get('/healthz')).status == 503
+        for worker in server._workers:
+            worker.start()
+        for update_id in range(5):
+            assert (await client.post('/token', json=update(update_id))).status == 200
+        res = await client.get('/healthz')
+        assert res.status == 200
+        assert (await res.json())['workers'] == 2
+
+        # What _serve does on SIGTERM
+        server._draining = True
+        assert (await client.post('/token', json=update(5))).status == 503
+        assert (await client.get('/healthz')).status == 503
+        threading.Timer(0.1, dispatcher.release.set).start()
+        await asyncio.get_running_loop().run_in_executor(None, server._drain)
+
+    serve(server, scenario)
+
+    assert sorted(dispatcher.processed) == [0, 1, 2, 3, 4]
+    for worker in server._workers:
+        worker.join(1)
+        assert not worker.is_alive()